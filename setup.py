@@ -15,12 +15,15 @@ setup(
     packages=find_packages(include=['thinbox', 'thinbox.*']),
     scripts=[
         "bin/thinbox",
+        "bin/thinboxd",
     ],
     install_requires=[
-        "scp",
         "argcomplete",
         "beautifulsoup4",
         "requests",
         "paramiko",
-    ]
+    ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
 )
@@ -0,0 +1,201 @@
+"""Benchmark of the create pipeline with stub tools
+
+qemu-img, virt-sysprep and virt-install are replaced by the stubs in
+tests/stubs through THINBOX_TOOLS, and domains are looked up on libvirt's
+test driver, so no KVM is needed. It measures what create costs on top of
+the tools it runs, sequentially and with concurrent creates, and checks that
+failed creates leave no overlay nor backing index entry behind.
+
+    python -m tests.bench_create [-n 20] [-j 4] [-l 0.05] [-f 0.2]
+"""
+import os
+import io
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from time import monotonic
+from unittest import mock
+
+from thinbox.utils import ThreadPoolExecutor
+
+STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+BASE_IMAGE = "fedora-35.qcow2"
+
+
+def setup(tmpdir):
+    """Write a config using the stubs and an empty base image
+
+    :param tmpdir: Directory of the config and cache
+    :type tmpdir: str
+    """
+    config_dir = os.path.join(tmpdir, "config", "thinbox")
+    base_dir = os.path.join(tmpdir, "cache", "thinbox", "base")
+    os.makedirs(config_dir)
+    os.makedirs(base_dir)
+    tools = {t: os.path.join(STUBS, t)
+             for t in ("qemu-img", "virt-sysprep", "virt-install")}
+    with open(os.path.join(config_dir, "config.json"), "w") as file:
+        json.dump({"THINBOX_TOOLS": tools}, file)
+    open(os.path.join(base_dir, BASE_IMAGE), "w").close()
+
+
+def read_log(path):
+    """Return the calls logged by the stubs and empty the log"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        calls = [json.loads(line) for line in file]
+    os.remove(path)
+    return calls
+
+
+def stub_startup(runs=5):
+    """Return the mean seconds a stub takes to start and exit
+
+    It is part of every tool call but not of create, so it is taken out of
+    the overhead.
+    """
+    env = dict(os.environ, THINBOX_STUB_LATENCY="0", THINBOX_STUB_FAIL_RATE="0")
+    env.pop("THINBOX_STUB_LOG", None)
+    start = monotonic()
+    for _ in range(runs):
+        subprocess.run([os.path.join(STUBS, "virt-install")], env=env)
+    return (monotonic() - start) / runs
+
+
+def max_concurrency(calls):
+    """Return the highest number of tools running at once"""
+    events = sorted([(c["start"], 1) for c in calls] + [(c["end"], -1) for c in calls])
+    running = peak = 0
+    for _, step in events:
+        running += step
+        peak = max(peak, running)
+    return peak
+
+
+def scenario(name, count, jobs, uri, log, startup):
+    """Create count domains with up to jobs at once
+
+    :return: Results of the scenario
+    :rtype: dict
+    """
+    from thinbox.core import Thinbox
+
+    def create(i):
+        tb = Thinbox(readonly=False, uri=uri)
+        try:
+            tb.create(BASE_IMAGE, "{}-{}".format(name, i))
+        except SystemExit:
+            return False
+        return True
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            created = list(executor.map(create, range(count)))
+        wall = monotonic() - start
+    calls = read_log(log)
+    # wall time of the tools alone, were jobs creates always running at once
+    tool_time = sum(c["end"] - c["start"] + startup for c in calls) / jobs
+    return {
+        "scenario": name,
+        "creates": count,
+        "failed": created.count(False),
+        "wall": wall,
+        "throughput": count / wall,
+        "overhead": max(wall - tool_time, 0) / count,
+        "concurrency": max_concurrency(calls),
+        "created": created,
+    }
+
+
+def leftovers(results, tmpdir):
+    """Return the overlays and index entries left by failed creates"""
+    image_dir = os.path.join(tmpdir, "cache", "thinbox", "images")
+    index_path = os.path.join(tmpdir, "cache", "thinbox", "backing.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+    indexed = {o for overlays in index.values() for o in overlays}
+    left = []
+    for result in results:
+        for i, ok in enumerate(result["created"]):
+            overlay = "{}-{}.qcow2".format(result["scenario"], i)
+            if not ok and (os.path.exists(os.path.join(image_dir, overlay))
+                           or overlay in indexed):
+                left.append(overlay)
+    return left
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark create with stub tools on libvirt's test driver.")
+    parser.add_argument(
+        "-n", "--count", type=int, default=20,
+        help="domains created per scenario, defaults to 20")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4,
+        help="concurrent creates of the bulk scenarios, defaults to 4")
+    parser.add_argument(
+        "-l", "--latency", type=float, default=0.05,
+        help="seconds every stub tool takes, defaults to 0.05")
+    parser.add_argument(
+        "-f", "--fail-rate", type=float, default=0.2,
+        help="probability of a stub failing in the failure scenario, defaults to 0.2")
+    parser.add_argument(
+        "--uri", default="test:///default",
+        help="libvirt URI, defaults to test:///default")
+    parser.add_argument(
+        "--json", action="store_true",
+        help="print results as JSON")
+    args = parser.parse_args()
+
+    # failed creates log errors by design
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+            os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+            XDG_CONFIG_HOME=os.path.join(tmpdir, "config"),
+            THINBOX_STUB_LATENCY=str(args.latency),
+            THINBOX_STUB_LOG=os.path.join(tmpdir, "stub.log")):
+        setup(tmpdir)
+        log = os.environ["THINBOX_STUB_LOG"]
+        startup = stub_startup()
+        results = [
+            scenario("single", args.count, 1, args.uri, log, startup),
+            scenario("bulk", args.count, args.jobs, args.uri, log, startup),
+        ]
+        os.environ["THINBOX_STUB_FAIL_RATE"] = str(args.fail_rate)
+        results.append(
+            scenario("failing", args.count, args.jobs, args.uri, log, startup))
+        left = leftovers(results, tmpdir)
+
+    if args.json:
+        print(json.dumps({
+            "results": [{k: v for k, v in r.items() if k != "created"}
+                        for r in results],
+            "stub_startup": startup,
+            "leftovers": left}, indent=4))
+    else:
+        print_format = "{:<10} {:>7} {:>6} {:>8} {:>10} {:>13} {:>11}"
+        print(print_format.format("SCENARIO", "CREATES", "FAILED", "WALL",
+                                  "CREATES/S", "OVERHEAD/MS", "CONCURRENCY"))
+        for r in results:
+            print(print_format.format(
+                r["scenario"], r["creates"], r["failed"], "{:.2f}".format(r["wall"]),
+                "{:.2f}".format(r["throughput"]),
+                "{:.1f}".format(r["overhead"] * 1000), r["concurrency"]))
+        print("Overhead excludes {:.1f}ms of stub startup per tool call.".format(
+            startup * 1000))
+    if left:
+        print("Failed creates left behind: {}".format(", ".join(left)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
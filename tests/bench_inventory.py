@@ -0,0 +1,191 @@
+"""Scale benchmark of inventory operations on libvirt's test driver
+
+Domains are generated in a test driver node XML, so no KVM is needed. For
+every domain count, the wall time and the libvirt calls of each operation are
+measured and compared with the baseline in bench_inventory.json.
+
+    python -m tests.bench_inventory [-s 10,100,1000] [-r 3] [--save]
+
+It exits with 1 when an operation makes more libvirt calls than in the
+baseline, or is slower than the baseline by more than --tolerance times.
+Wall times depend on the machine, record the baseline with --save on the
+machine that compares against it.
+"""
+import os
+import io
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import contextlib
+from time import monotonic
+from unittest import mock
+
+from thinbox import inventory
+from thinbox import rpc
+
+BASELINE = os.path.join(os.path.dirname(__file__), "bench_inventory.json")
+
+DOMAIN_XML = """  <domain type='test'>
+    <name>{name}</name>
+    <uuid>{uuid}</uuid>
+    <memory>65536</memory>
+    <os><type>hvm</type></os>
+  </domain>
+"""
+
+
+def node_xml(count):
+    """Return a test driver node with count domains named bench0..
+
+    :param count: Number of domains
+    :type count: int
+
+    :rtype: str
+    """
+    domains = [DOMAIN_XML.format(
+        name="bench{}".format(i),
+        uuid="00000000-0000-4000-8000-{:012d}".format(i)) for i in range(count)]
+    return "<node>\n" + "".join(domains) + "</node>\n"
+
+
+def operations(uri):
+    """Return the benchmarked operations, as name and function pairs
+
+    Every function builds its own Thinbox, the test driver reloads the node
+    on every connection so operations do not see each other's changes.
+
+    :param uri: test driver URI of the node
+    :type uri: str
+
+    :rtype: list
+    """
+    from thinbox.core import Thinbox
+
+    def lookup():
+        tb = Thinbox(uri=uri)
+        tb._get_dom_from_name(tb.doms[-1].name)
+
+    return [
+        ("init", lambda: Thinbox(uri=uri)),
+        ("list", lambda: Thinbox(uri=uri).list()),
+        ("list_running", lambda: Thinbox(uri=uri).list(fil="running")),
+        ("lookup", lookup),
+        ("complete", lambda: inventory.domain_completer("bench")),
+        ("remove_all", lambda: Thinbox(readonly=False, uri=uri).remove_all()),
+    ]
+
+
+def measure(func, repeat):
+    """Return the libvirt calls and the best wall time of func
+
+    :param func: Operation
+    :type func: callable
+
+    :param repeat: Number of runs
+    :type repeat: int
+
+    :rtype: dict
+    """
+    best = None
+    for _ in range(repeat):
+        with rpc.record(report=False) as stats, \
+                contextlib.redirect_stdout(io.StringIO()):
+            start = monotonic()
+            func()
+            elapsed = monotonic() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"calls": stats.count(), "seconds": round(best, 6)}
+
+
+def run(sizes, repeat):
+    """Benchmark every operation with every domain count
+
+    :return: Results by domain count and operation
+    :rtype: dict
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+            os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+            XDG_CONFIG_HOME=os.path.join(tmpdir, "config")):
+        for size in sizes:
+            node = os.path.join(tmpdir, "node{}.xml".format(size))
+            with open(node, "w") as file:
+                file.write(node_xml(size))
+            results[str(size)] = {
+                name: measure(func, repeat)
+                for name, func in operations("test://" + node)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print results next to the baseline and return the regressions
+
+    :rtype: list
+    """
+    regressions = []
+    print_format = "{:>6} {:<14} {:>7} {:>7} {:>10} {:>10}"
+    print(print_format.format(
+        "DOMS", "OPERATION", "CALLS", "BASE", "SECONDS", "BASE"))
+    for size, ops in results.items():
+        for name, result in ops.items():
+            base = baseline.get(size, {}).get(name)
+            print(print_format.format(
+                size, name, result["calls"], base["calls"] if base else "-",
+                "{:.4f}".format(result["seconds"]),
+                "{:.4f}".format(base["seconds"]) if base else "-"))
+            if base is None:
+                continue
+            if result["calls"] > base["calls"]:
+                regressions.append("{} with {} domains: {} libvirt calls, {} in baseline".format(
+                    name, size, result["calls"], base["calls"]))
+            # small absolute slack, timer noise dominates fast operations
+            if result["seconds"] > base["seconds"] * tolerance + 0.01:
+                regressions.append("{} with {} domains: {:.4f}s, {:.4f}s in baseline".format(
+                    name, size, result["seconds"], base["seconds"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark inventory operations on libvirt's test driver.")
+    parser.add_argument(
+        "-s", "--sizes", default="10,100,1000",
+        help="comma separated domain counts, defaults to 10,100,1000")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="runs per operation, the fastest counts, defaults to 3")
+    parser.add_argument(
+        "-t", "--tolerance", type=float, default=1.5,
+        help="slowdown over the baseline reported as regression, defaults to 1.5")
+    parser.add_argument(
+        "--save", action="store_true",
+        help="save results as the new baseline")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    # remove_all warns about every missing overlay
+    logging.disable(logging.WARNING)
+    results = run(sizes, args.repeat)
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, "w") as file:
+            json.dump(baseline, file, indent=4, sort_keys=True)
+            file.write("\n")
+        print("Baseline saved to {}".format(BASELINE))
+    elif regressions:
+        for regression in regressions:
+            print("Regression: {}".format(regression), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
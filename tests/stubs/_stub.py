@@ -0,0 +1,50 @@
+"""Stand-ins of the external tools of create, for tests and benchmarks
+
+Every stub sleeps, may fail, then exits. They are set up with THINBOX_TOOLS
+and configured with environment variables:
+
+THINBOX_STUB_LATENCY: seconds every tool takes, defaults to 0
+THINBOX_STUB_LATENCY_<TOOL>: seconds of one tool, e.g.
+    THINBOX_STUB_LATENCY_VIRT_INSTALL
+THINBOX_STUB_FAIL: comma separated tools that always fail
+THINBOX_STUB_FAIL_RATE: probability of any call failing, defaults to 0
+THINBOX_STUB_LOG: file a JSON line is appended to for every call, with
+    tool, arguments, start and end time and exit code
+"""
+import os
+import sys
+import json
+import time
+import random
+
+
+def main(tool, create=None):
+    """Run the stub of tool
+
+    :param tool: Name of the tool, e.g. "virt-install"
+    :type tool: str
+
+    :param create: Called with the arguments to create the files the real
+        tool would, on success
+    :type create: callable, optional
+    """
+    start = time.time()
+    key = "THINBOX_STUB_LATENCY_" + tool.upper().replace("-", "_")
+    latency = float(os.environ.get(key, os.environ.get("THINBOX_STUB_LATENCY", 0)))
+    time.sleep(latency)
+
+    failing = os.environ.get("THINBOX_STUB_FAIL", "").split(",")
+    rate = float(os.environ.get("THINBOX_STUB_FAIL_RATE", 0))
+    code = 1 if tool in failing or random.random() < rate else 0
+    if code:
+        print("{}: injected failure".format(tool), file=sys.stderr)
+    elif create is not None:
+        create(sys.argv[1:])
+
+    log = os.environ.get("THINBOX_STUB_LOG")
+    if log:
+        with open(log, "a") as file:
+            file.write(json.dumps({
+                "tool": tool, "args": sys.argv[1:], "start": start,
+                "end": time.time(), "code": code}) + "\n")
+    sys.exit(code)
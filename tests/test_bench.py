@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+
+from thinbox.bench import boot_report, measure_boot, percentile
+
+
+class _Domain(object):
+    """Running domain leased an IP on the third lookup"""
+
+    name = "vm1"
+    state = "running"
+    ip = ""
+
+    def __init__(self):
+        self.lookups = []
+
+    def address(self, lease=False):
+        self.lookups.append(lease)
+        if len(self.lookups) < 3:
+            return "", ""
+        return "192.168.122.10", "52:54:00:00:00:01"
+
+    def use_address(self, ip, mac=""):
+        self.ip = ip
+
+
+class TestBench(unittest.TestCase):
+
+    def test_percentile(self):
+        """Percentiles interpolate between ranks
+        """
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(percentile([1, 2, 3, 4], 100), 4)
+        self.assertAlmostEqual(percentile(list(range(1, 101)), 99), 99.01)
+        self.assertIsNone(percentile([], 50))
+
+    def test_measure_boot(self):
+        """The lease phase waits for a DHCP lease, later phases use its IP
+        """
+        dom = _Domain()
+        with mock.patch("thinbox.bench.probe_address", return_value=True) as probe, \
+                mock.patch("thinbox.bench._first_command", return_value=True) as command:
+            phases = measure_boot(dom, timeout=5, poll=0)
+        self.assertEqual(list(phases), ["running", "lease", "sshd", "command"])
+        self.assertEqual(dom.lookups, [True, True, True])
+        probe.assert_called_once_with("192.168.122.10", timeout=1)
+        command.assert_called_once_with("192.168.122.10")
+
+    def test_boot_report(self):
+        """Failed boots are counted but left out of percentiles
+        """
+        vms = [
+            {"name": "a", "create": 10, "running": 1, "lease": 4,
+             "sshd": 2, "command": 1},
+            {"name": "b", "error": "create failed"},
+        ]
+        report = boot_report(vms, 30)
+        self.assertEqual(report["booted"], 1)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual(report["throughput"], 2)
+        self.assertEqual(report["summary"]["to_ip"]["p50"], 15)
+        self.assertEqual(report["summary"]["total"]["p99"], 18)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from thinbox.cache import ImageCache
+from thinbox.config import Env
+
+
+class _Index(object):
+    """Backing index of overlays given by name, an error is raised"""
+
+    def __init__(self, bases):
+        self._bases = bases
+        self.removed = []
+
+    def base_of(self, overlay_name):
+        base = self._bases.get(overlay_name)
+        if isinstance(base, Exception):
+            raise base
+        return base
+
+    def remove_overlay(self, overlay_name):
+        self._bases.pop(overlay_name, None)
+
+    def remove_base(self, base_name):
+        self.removed.append(base_name)
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patch = mock.patch.dict(
+            os.environ, XDG_CACHE_HOME=os.path.join(self.tmpdir.name, "cache"),
+            XDG_CONFIG_HOME=os.path.join(self.tmpdir.name, "config"))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.env = Env()
+        self.env['THINBOX_CACHE_SIZE'] = "150K"
+
+    def _write(self, directory, name, size=64 * 1024):
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(size))
+
+    def _cache(self, bases, overlays=None):
+        """Return a cache of base images used in the order of bases"""
+        for name in bases:
+            self._write(self.env.THINBOX_BASE_DIR, name)
+        for name in overlays or {}:
+            self._write(self.env.THINBOX_IMAGE_DIR, name, 4096)
+        image_cache = ImageCache(self.env, index=_Index(dict(overlays or {})))
+        for i, name in enumerate(bases):
+            with mock.patch("time.time", return_value=1000.0 + i):
+                image_cache.touch(name)
+        return image_cache
+
+    def test_touch_order(self):
+        """Least recently used base images are evicted first, down to the cap
+        """
+        image_cache = self._cache(["c.qcow2", "a.qcow2", "b.qcow2"])
+        self.assertLess(image_cache.last_used("c.qcow2"), image_cache.last_used("b.qcow2"))
+        with mock.patch("builtins.print"):
+            image_cache.gc([])
+        self.assertEqual(image_cache.bases(), ["a.qcow2", "b.qcow2"])
+        self.assertLessEqual(image_cache.size(), image_cache.cap)
+
+        with mock.patch("time.time", return_value=2000.0):
+            image_cache.touch("a.qcow2")
+        self.env['THINBOX_CACHE_SIZE'] = "100K"
+        with mock.patch("builtins.print"):
+            image_cache.gc([])
+        self.assertEqual(image_cache.bases(), ["a.qcow2"])
+
+    def test_touch_shared(self):
+        """Uses recorded by another cache object are kept
+        """
+        image_cache = self._cache(["a.qcow2", "b.qcow2"])
+        other = ImageCache(self.env, index=_Index({}))
+        with mock.patch("time.time", return_value=3000.0):
+            other.touch("a.qcow2")
+        with mock.patch("time.time", return_value=3001.0):
+            image_cache.touch("b.qcow2")
+        self.assertEqual(ImageCache(self.env, index=_Index({})).last_used("a.qcow2"), 3000.0)
+
+    def test_no_cap(self):
+        """Nothing is evicted without a size cap
+        """
+        self.env['THINBOX_CACHE_SIZE'] = "0"
+        image_cache = self._cache(["a.qcow2", "b.qcow2", "c.qcow2"])
+        with mock.patch("builtins.print"):
+            self.assertEqual(image_cache.gc([]), 0)
+        self.assertEqual(len(image_cache.bases()), 3)
+
+    def test_in_use(self):
+        """Base images backing an overlay are kept even when over the cap
+        """
+        image_cache = self._cache(["a.qcow2", "b.qcow2", "c.qcow2"],
+                                  {"vm1.qcow2": "a.qcow2", "vm2.qcow2": "b.qcow2"})
+        self.env['THINBOX_CACHE_SIZE'] = "100K"
+        with mock.patch("builtins.print"), self.assertLogs(level="WARNING"):
+            image_cache.gc(["vm1", "vm2"])
+        self.assertEqual(image_cache.bases(), ["a.qcow2", "b.qcow2"])
+
+    def test_unknown_dependency(self):
+        """No base image is evicted while an overlay cannot be read
+        """
+        image_cache = self._cache(["a.qcow2", "b.qcow2", "c.qcow2"],
+                                  {"vm1.qcow2": PermissionError("vm1.qcow2")})
+        with mock.patch("builtins.print"), self.assertLogs(level="WARNING"):
+            self.assertEqual(image_cache.gc(["vm1"]), 0)
+        self.assertEqual(len(image_cache.bases()), 3)
+
+    def test_normalizing(self):
+        """Images being normalized are not base images yet
+        """
+        image_cache = self._cache(["a.qcow2"])
+        self._write(self.env.THINBOX_BASE_DIR, "b.qcow2.normalizing")
+        self.assertEqual(image_cache.bases(), ["a.qcow2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    import libvirt
+    from thinbox.core import CreateError, Thinbox
+except ImportError:
+    libvirt = None
+
+
+@unittest.skipIf(libvirt is None, "needs libvirt-python")
+class TestCreate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patch = mock.patch.dict(
+            os.environ, XDG_CACHE_HOME=os.path.join(self.tmpdir.name, "cache"),
+            XDG_CONFIG_HOME=os.path.join(self.tmpdir.name, "config"))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.tb = Thinbox(readonly=False, uri="test:///default")
+        self.tb.env["THINBOX_OVERCOMMIT"] = 0
+        with open(os.path.join(self.tb.env.THINBOX_BASE_DIR, "a.qcow2"), "wb") as f:
+            f.write(b"base")
+
+    def test_create_failed(self):
+        """A failed create raises with nothing left, the CLI exits
+        """
+        self.tb.env["THINBOX_TOOLS"] = '{"qemu-img": "false"}'
+        with mock.patch("builtins.print"):
+            with self.assertRaises(CreateError) as cm:
+                self.tb._create("a.qcow2", "bench-1")
+            self.assertIn("qemu-img failed", str(cm.exception))
+            self.assertEqual(os.listdir(self.tb.env.THINBOX_IMAGE_DIR), [])
+
+            with self.assertLogs(level="ERROR"), self.assertRaises(SystemExit):
+                self.tb.create("b.qcow2", "bench-1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import argparse
+import tempfile
+import unittest
+import contextvars
+from unittest import mock
+
+from thinbox import qemu
+from thinbox.config import Env
+
+try:
+    import libvirt
+    from thinbox.daemon import _absolute_paths, DaemonThinbox, Server
+    from thinbox.core import ssh_pool
+except ImportError:
+    libvirt = None
+
+
+@unittest.skipIf(libvirt is None, "needs libvirt-python")
+class TestDaemon(unittest.TestCase):
+
+    def test_absolute_paths(self):
+        """Local copy paths resolve in the working directory of the CLI
+        """
+        args = argparse.Namespace(
+            command="copy", file=["build/out", "/etc/hosts"], dest="vm1:/root")
+        _absolute_paths(args, "/home/user/src", ["vm1"])
+        self.assertEqual(args.file, ["/home/user/src/build/out", "/etc/hosts"])
+        self.assertEqual(args.dest, "vm1:/root")
+
+        args = argparse.Namespace(command="cp", file=["vm1:/var/log"], dest="logs")
+        _absolute_paths(args, "/home/user", ["vm1"])
+        self.assertEqual(args.file, ["vm1:/var/log"])
+        self.assertEqual(args.dest, "/home/user/logs")
+
+        args = argparse.Namespace(command="copy", file=["a"], dest="vm1")
+        _absolute_paths(args, "/home/user", ["vm1"])
+        self.assertEqual(args.dest, "vm1")
+
+    def test_refused_commands(self):
+        """Only the commands of client.COMMANDS are served
+        """
+        server = mock.Mock()
+        for args in ({"command": "create"}, {"command": "list", "watch": True}):
+            with mock.patch("sys.stderr"):
+                self.assertEqual(Server.execute(server, {"args": args}), 2)
+
+    def test_request_env(self):
+        """Tools and the ssh idle time follow the environment of the request
+        """
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+                os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+                XDG_CONFIG_HOME=os.path.join(tmpdir, "config")), \
+                mock.patch.object(ssh_pool, "idle", 600):
+            tb = DaemonThinbox.__new__(DaemonThinbox)
+            tb._env = Env()
+            env = Env()
+            env["THINBOX_TOOLS"] = '{"qemu-img": "/opt/bin/qemu-img"}'
+            env["THINBOX_SSH_PERSIST"] = 60
+
+            def request():
+                tb.use_env(env)
+                return tb.tools["qemu-img"], qemu._tool("qemu-img")
+
+            self.assertEqual(contextvars.Context().run(request),
+                             ("/opt/bin/qemu-img", "/opt/bin/qemu-img"))
+            self.assertEqual(ssh_pool.idle, 60)
+            self.assertEqual(tb.tools["qemu-img"], "qemu-img")
+            self.assertEqual(qemu._tool("qemu-img"), "qemu-img")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -40,6 +40,19 @@ class TestEnv(unittest.TestCase):
             os.path.expanduser('~/.cache/thinbox/hash')
         )
 
+    def test_defaults_loaded(self):
+        """Every default is set by load_defaults, getters set nothing
+        """
+        keys = dict(self.env.copy())
+        self.assertEqual(self.env.THINBOX_SSH_DIR,
+                         os.path.expanduser('~/.cache/thinbox/ssh'))
+        self.assertEqual(self.env.THINBOX_MIRRORS, [])
+        self.assertEqual(self.env.THINBOX_DISK_PROFILE, "default")
+        self.assertEqual(self.env.THINBOX_CACHE_SIZE, "0")
+        self.assertEqual(self.env.THINBOX_SSH_PERSIST, 600)
+        self.assertFalse(self.env.THINBOX_NORMALIZE["enabled"])
+        self.assertEqual(self.env.copy(), keys)
+
 
     def test_config_file(self):
         """Run when config file exists
@@ -139,6 +152,72 @@ class TestEnv(unittest.TestCase):
         self.assertEqual(ex.args[0], 'THINBOX_MEMORY')
 
 
+    def test_ssh_defaults(self):
+        """ssh sockets live in a private dir of the cache
+        """
+        self.assertEqual(
+            self.env.THINBOX_SSH_DIR,
+            os.path.expanduser('~/.cache/thinbox/ssh')
+        )
+        self.assertEqual(os.stat(self.env.THINBOX_SSH_DIR).st_mode & 0o777, 0o700)
+        self.assertEqual(self.env.THINBOX_SSH_PERSIST, 600)
+
+    def test_mirrors(self):
+        """Mirrors default to empty and split comma separated strings
+        """
+        self.assertEqual(self.env.THINBOX_MIRRORS, [])
+
+        self.env.set("THINBOX_MIRRORS", "/mnt/nfs/base, http://cache:8000/")
+        self.assertEqual(
+            self.env.THINBOX_MIRRORS,
+            ["/mnt/nfs/base", "http://cache:8000/"]
+        )
+
+    def test_tools(self):
+        """Tools default to their command and can be overridden, also as JSON
+        """
+        self.assertEqual(self.env.THINBOX_TOOLS["qemu-img"], "qemu-img")
+
+        self.env.set("THINBOX_TOOLS", '{"virt-install": "~/bin/virt-install"}')
+        self.assertEqual(
+            self.env.THINBOX_TOOLS["virt-install"],
+            os.path.expanduser("~/bin/virt-install")
+        )
+        self.assertEqual(self.env.THINBOX_TOOLS["qemu-img"], "qemu-img")
+
+    def test_normalize(self):
+        """Normalization is off by default and can be set as JSON
+        """
+        self.assertFalse(self.env.THINBOX_NORMALIZE["enabled"])
+
+        self.env.set("THINBOX_NORMALIZE", '{"enabled": true}')
+        self.assertTrue(self.env.THINBOX_NORMALIZE["enabled"])
+        self.assertEqual(self.env.THINBOX_NORMALIZE["cluster_size"], "64k")
+
+    def test_disk_profiles(self):
+        """Built-in profiles are kept when more are set as JSON
+        """
+        self.assertIn("lazy", self.env.THINBOX_DISK_PROFILES)
+
+        self.env.set("THINBOX_DISK_PROFILES", '{"big": {"cluster_size": "2M"}}')
+        self.assertEqual(
+            self.env.THINBOX_DISK_PROFILES["big"], {"cluster_size": "2M"})
+        self.assertIn("lazy", self.env.THINBOX_DISK_PROFILES)
+
+    def test_memory(self):
+        """Memory and CPUs of domains default and read back as numbers
+        """
+        self.assertEqual(self.env.THINBOX_MEMORY, 1024)
+        self.assertEqual(self.env.THINBOX_VCPUS, 1)
+        self.assertEqual(self.env.THINBOX_OVERCOMMIT, 1.0)
+
+        # as set by `thinbox env set`
+        self.env.set("THINBOX_MEMORY", "2048")
+        self.env.set("THINBOX_OVERCOMMIT", "1.5")
+        self.assertEqual(self.env.THINBOX_MEMORY, 2048)
+        self.assertEqual(self.env.THINBOX_OVERCOMMIT, 1.5)
+
+
     def tearDown(self):
         if os.path.exists(test_homedir):
             shutil.rmtree(test_homedir)
@@ -0,0 +1,129 @@
+import time
+import threading
+import unittest
+
+try:
+    import libvirt
+    from thinbox import domain
+    from thinbox import events
+except ImportError:
+    libvirt = None
+
+
+class _Dom(object):
+
+    def __init__(self, name, state, addr=None):
+        self._name = name
+        self._state = state
+        self.addr = addr or {}
+
+    def name(self):
+        return self._name
+
+    def ID(self):
+        return 1
+
+    def UUIDString(self):
+        return "uuid-" + self._name
+
+    def isActive(self):
+        return int(self._state == libvirt.VIR_DOMAIN_RUNNING)
+
+    def state(self):
+        return [self._state, 1]
+
+    def interfaceAddresses(self, source):
+        return self.addr
+
+
+class _Conn(object):
+
+    def domainEventRegisterAny(self, dom, event, callback, opaque):
+        self.callback = callback
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.conn = _Conn()
+
+    def fire(self, dom, event):
+        self.conn.callback(self.conn, dom, event, 0, None)
+
+
+ADDR = {"vnet0": {"hwaddr": "52:54:00:00:00:01",
+                  "addrs": [{"addr": "192.168.122.10"}]}}
+
+
+@unittest.skipIf(libvirt is None, "needs libvirt-python")
+class TestEvents(unittest.TestCase):
+
+    def test_event_name(self):
+        self.assertEqual(events.event_name(libvirt.VIR_DOMAIN_EVENT_STARTED), "started")
+        self.assertEqual(events.event_name(99), "unknown")
+
+    def test_started_then_address(self):
+        """A started domain is looked up, its address polled until found
+        """
+        connection = _Connection()
+        watcher = events.Watcher(connection, [], {}, interval=0.01)
+        changes = watcher.changes()
+
+        dom = _Dom("vm1", libvirt.VIR_DOMAIN_RUNNING)
+        connection.fire(dom, libvirt.VIR_DOMAIN_EVENT_STARTED)
+        event, d = next(changes)
+        self.assertEqual((event, d.name, d.state, d.ip), ("started", "vm1", "running", ""))
+
+        dom.addr = ADDR
+        event, d = next(changes)
+        self.assertEqual((event, d.ip), ("address", "192.168.122.10"))
+        self.assertEqual(list(watcher.doms), ["uuid-vm1"])
+
+    def test_poll_during_events(self):
+        """Addresses are polled on time while events keep coming
+        """
+        connection = _Connection()
+        dom = _Dom("vm1", libvirt.VIR_DOMAIN_RUNNING)
+        watcher = events.Watcher(connection, [domain.Domain(dom)],
+                                 {"uuid-vm1": ("running", "1")}, interval=0.05)
+        dom.addr = ADDR
+        busy = _Dom("vm2", libvirt.VIR_DOMAIN_RUNNING, ADDR)
+        done = threading.Event()
+
+        def feed():
+            while not done.is_set():
+                connection.fire(busy, libvirt.VIR_DOMAIN_EVENT_RESUMED)
+                time.sleep(0.005)
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        try:
+            start = time.monotonic()
+            for event, d in watcher.changes():
+                if event == "address" or time.monotonic() - start > 2:
+                    break
+        finally:
+            done.set()
+            feeder.join()
+        self.assertEqual((event, d.name), ("address", "vm1"))
+
+    def test_undefined(self):
+        """An undefined domain is forgotten
+        """
+        connection = _Connection()
+        dom = _Dom("vm1", libvirt.VIR_DOMAIN_SHUTOFF)
+        watcher = events.Watcher(connection, [domain.Domain(dom)],
+                                 {"uuid-vm1": ("shutoff", "1")}, interval=0.01)
+        connection.fire(dom, libvirt.VIR_DOMAIN_EVENT_UNDEFINED)
+        event, d = next(watcher.changes())
+        self.assertEqual((event, d.name), ("undefined", "vm1"))
+        # still known while the removal is printed
+        self.assertEqual(watcher.states["uuid-vm1"][0], "shutoff")
+        self.assertEqual(watcher.doms, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
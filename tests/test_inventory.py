@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+
+from thinbox import inventory
+
+
+class TestInventory(unittest.TestCase):
+
+    def test_update(self):
+        """Kinds are updated independently and kept sorted
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertEqual(inventory.load(tmpdir), {})
+            inventory.update(tmpdir, domains=["vm2", "vm1"])
+            inventory.update(tmpdir, images=["fedora.qcow2"])
+            self.assertEqual(inventory.load(tmpdir), {
+                "domains": ["vm1", "vm2"], "images": ["fedora.qcow2"]})
+
+    def test_unchanged(self):
+        """The snapshot is not written again when nothing changed
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inventory.update(tmpdir, domains=["vm1"])
+            path = os.path.join(tmpdir, inventory.INVENTORY_FILE)
+            os.utime(path, (0, 0))
+            inventory.update(tmpdir, domains=["vm1"])
+            self.assertEqual(os.stat(path).st_mtime, 0)
+
+    def test_unwritable(self):
+        """A snapshot that can not be written is reported and left as is
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            missing = os.path.join(tmpdir, "missing")
+            with self.assertLogs(level="WARNING"):
+                inventory.update(missing, domains=["vm1"])
+            self.assertEqual(inventory.load(missing), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
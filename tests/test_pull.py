@@ -0,0 +1,86 @@
+import os
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+try:
+    import libvirt
+    from thinbox.core import Thinbox
+except ImportError:
+    libvirt = None
+
+
+def _download_file(url, filepath, limiter=None, progress=None):
+    with open(filepath, "wb") as f:
+        f.write(b"partial")
+    if "broken" in url:
+        raise requests.ConnectionError("connection reset")
+    return True
+
+
+@unittest.skipIf(libvirt is None, "needs libvirt-python")
+class TestPull(unittest.TestCase):
+
+    def test_failed_download(self):
+        """A failed download is logged and removed, the others are verified
+        """
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+                os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+                XDG_CONFIG_HOME=os.path.join(tmpdir, "config")):
+            tb = Thinbox(uri="test:///default")
+            with mock.patch("thinbox.core.download_file", _download_file), \
+                    mock.patch.object(tb, "_verify_image") as verify, \
+                    mock.patch("builtins.print"), \
+                    self.assertLogs(level="ERROR"), \
+                    self.assertRaises(SystemExit):
+                tb.pull_urls(["http://example.com/good.qcow2",
+                              "http://example.com/broken.qcow2"],
+                             normalize=False)
+            verify.assert_called_once_with("good.qcow2")
+            self.assertEqual(os.listdir(tb.env.THINBOX_BASE_DIR), ["good.qcow2"])
+            self.assertFalse(os.path.exists(os.path.join(
+                tb.env.THINBOX_HASH_DIR, "broken.qcow2.SHA256SUM")))
+
+    def test_normalized_verified(self):
+        """A normalized image is verified through its original digest
+        """
+        def hash_file(path, data):
+            with open(path, "w") as f:
+                f.write("# a.qcow2: {} bytes\n".format(len(data)))
+                f.write("SHA256 (a.qcow2) = {}\n".format(
+                    hashlib.sha256(data).hexdigest()))
+
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+                os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+                XDG_CONFIG_HOME=os.path.join(tmpdir, "config")):
+            tb = Thinbox(uri="test:///default")
+            hashdir = tb.env.THINBOX_HASH_DIR
+            with open(os.path.join(tb.env.THINBOX_BASE_DIR, "a.qcow2"), "wb") as f:
+                f.write(b"normalized")
+            hash_file(os.path.join(hashdir, "a.qcow2.SHA256SUM"), b"original")
+            hash_file(os.path.join(hashdir, "a.qcow2.ORIGINAL.SHA256SUM"), b"original")
+            hash_file(os.path.join(hashdir, "a.qcow2.NORMALIZED.SHA256SUM"), b"normalized")
+            self.assertTrue(tb.check_hash("a.qcow2", "sha256"))
+
+            hash_file(os.path.join(hashdir, "a.qcow2.ORIGINAL.SHA256SUM"), b"other")
+            os.remove(os.path.join(hashdir, "a.qcow2.SHA256SUM.OK"))
+            self.assertFalse(tb.check_hash("a.qcow2", "sha256"))
+
+    def test_normalizing_hidden(self):
+        """Images still being normalized are not listed as base images
+        """
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+                os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+                XDG_CONFIG_HOME=os.path.join(tmpdir, "config")):
+            tb = Thinbox(uri="test:///default")
+            for name in ("a.qcow2", "b.qcow2.normalizing"):
+                with open(os.path.join(tb.env.THINBOX_BASE_DIR, name), "wb") as f:
+                    f.write(b"image")
+            self.assertEqual(tb._get_base_images(), ["a.qcow2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
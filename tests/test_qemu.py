@@ -0,0 +1,51 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from thinbox.qemu import QCOW2_MAGIC, read_backing_file
+
+
+class TestQemu(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def _write(self, name, header, tail=b""):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as file:
+            file.write(header + tail)
+        return path
+
+    def test_backing_file(self):
+        """Read backing file from qcow2 header
+        """
+        backing = b"/var/lib/thinbox/base/rhel-8.6.qcow2"
+        header = QCOW2_MAGIC + struct.pack(">IQI", 3, 72, len(backing))
+        header += b"\0" * (72 - len(header))
+        path = self._write("overlay.qcow2", header, backing)
+
+        self.assertEqual(read_backing_file(path), backing.decode())
+
+    def test_no_backing_file(self):
+        """Base images have no backing file
+        """
+        header = QCOW2_MAGIC + struct.pack(">IQI", 3, 0, 0)
+        path = self._write("base.qcow2", header)
+
+        self.assertIsNone(read_backing_file(path))
+
+    def test_not_qcow2(self):
+        """Raw images are not parsed
+        """
+        path = self._write("base.raw", b"\0" * 512)
+
+        self.assertIsNone(read_backing_file(path))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
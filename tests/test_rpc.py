@@ -0,0 +1,130 @@
+import io
+import os
+import json
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+
+from thinbox import rpc
+
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+DOMAIN_XML = """<domain type='test'>
+  <name>{}</name>
+  <memory>65536</memory>
+  <os><type>hvm</type></os>
+</domain>"""
+
+
+class _Dom(object):
+
+    def name(self):
+        return "vm1"
+
+    def isActive(self):
+        return 1
+
+
+class _Conn(object):
+
+    def listAllDomains(self, flags=0):
+        return [_Dom(), _Dom()]
+
+    def getAllDomainStats(self, stats, flags=0):
+        return [(d, {}) for d in self.listAllDomains()]
+
+
+class TestRPC(unittest.TestCase):
+
+    def test_proxy(self):
+        """Calls are counted by method, local accessors are not
+        """
+        conn = rpc.Proxy(_Conn(), "virConnect", {"listAllDomains": "virDomain"})
+        with rpc.record(report=False) as stats:
+            doms = conn.listAllDomains()
+            for d in doms:
+                d.name()
+                d.isActive()
+        self.assertEqual(stats.count("virConnect.listAllDomains"), 1)
+        self.assertEqual(stats.count("virDomain.isActive"), 2)
+        self.assertEqual(stats.count("virDomain.name"), 0)
+        self.assertEqual(stats.count(), 3)
+
+        # nothing is accounted outside of record
+        conn.listAllDomains()
+        self.assertEqual(stats.count(), 3)
+
+    def test_report(self):
+        """The report lists every method
+        """
+        out = io.StringIO()
+        conn = rpc.Proxy(_Conn(), "virConnect")
+        with rpc.record(file=out):
+            conn.listAllDomains()
+        self.assertIn("virConnect.listAllDomains", out.getvalue())
+
+    @unittest.skipIf(libvirt is None, "needs libvirt-python")
+    def test_doms_listed_once(self):
+        """Domains are listed once per Thinbox, not on every lookup
+        """
+        from thinbox.core import Thinbox
+
+        # domains of test:///default live while a connection is open
+        conn = libvirt.open("test:///default")
+        names = ["bench{}".format(i) for i in range(500)]
+        doms = [conn.defineXML(DOMAIN_XML.format(n)) for n in names]
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+                    os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+                    XDG_CONFIG_HOME=os.path.join(tmpdir, "config")):
+                with rpc.record(report=False) as stats:
+                    tb = Thinbox(uri="test:///default")
+                    for name in names[:10]:
+                        tb._get_dom_from_name(name)
+            self.assertEqual(stats.count("virConnect.openReadOnly"), 1)
+            self.assertEqual(stats.count("virConnect.listAllDomains"), 1)
+        finally:
+            for d in doms:
+                d.undefine()
+            conn.close()
+
+    @unittest.skipIf(libvirt is None, "needs libvirt-python")
+    def test_list_projected(self):
+        """Listing names and states costs the same few calls for any count,
+        and leaves no state on the shared Domains
+        """
+        from thinbox.core import Thinbox
+
+        conn = libvirt.open("test:///default")
+        names = ["bench{}".format(i) for i in range(500)]
+        doms = [conn.defineXML(DOMAIN_XML.format(n)) for n in names]
+        out = io.StringIO()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+                    os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "cache"),
+                    XDG_CONFIG_HOME=os.path.join(tmpdir, "config")):
+                with rpc.record(report=False) as stats, \
+                        contextlib.redirect_stdout(out):
+                    tb = Thinbox(uri="test:///default")
+                    tb.list(fil="stopped", fmt="ndjson", fields=["name", "state"])
+            rows = [json.loads(line) for line in out.getvalue().splitlines()]
+            self.assertEqual({r["name"] for r in rows} & set(names), set(names))
+            self.assertTrue(all(r["state"] == "shutoff" for r in rows))
+            self.assertLessEqual(stats.count(), 5)
+            # the Domains, shared by thinboxd, keep no state
+            with rpc.record(report=False) as stats:
+                tb.doms[0].state
+            self.assertEqual(stats.count("virDomain.state"), 1)
+        finally:
+            for d in doms:
+                d.undefine()
+            conn.close()
+
+
+
+if __name__ == "__main__":
+    unittest.main()
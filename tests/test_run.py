@@ -0,0 +1,80 @@
+import io
+import socket
+import contextlib
+import unittest
+from unittest import mock
+
+try:
+    import libvirt
+    from thinbox import core
+except ImportError:
+    libvirt = None
+
+
+class _Domain(object):
+
+    def __init__(self, name, address=("", "")):
+        self.name = name
+        self.uuid = "uuid-" + name
+        self.active = 1
+        self.ip = "192.168.122.{}".format(len(name))
+        self.mac = ""
+        self._address = address
+
+    def address(self, lease=False):
+        return self._address
+
+    def use_address(self, ip, mac=""):
+        self.ip = ip
+        self.mac = mac
+
+
+def _run_ssh_command(ssh, cmd, prefix=""):
+    if prefix.startswith("broken"):
+        raise socket.error("Connection reset by peer")
+    return 3
+
+
+@unittest.skipIf(libvirt is None, "needs libvirt-python")
+class TestRun(unittest.TestCase):
+
+    def test_fan_out_errors(self):
+        """A dropped connection counts as 255 for its domain only
+        """
+        tb = mock.Mock()
+        tb._get_doms_from_patterns.return_value = [_Domain("vm1"), _Domain("broken")]
+        tb._run_on = lambda dom, cmd, prefix="": core.Thinbox._run_on(tb, dom, cmd, prefix)
+        out = io.StringIO()
+        with mock.patch.object(core.ssh_pool, "lease") as lease, \
+                mock.patch.object(core, "run_ssh_command", _run_ssh_command), \
+                contextlib.redirect_stdout(out), \
+                self.assertLogs(level="ERROR") as logs:
+            code = core.Thinbox.run(tb, ["vm1", "broken"], ["true"])
+        self.assertEqual(code, 255)
+        self.assertEqual(lease.call_count, 2)
+        self.assertEqual(logs.output,
+                         ["ERROR:root:broken | Connection reset by peer"])
+        rows = out.getvalue().splitlines()[-2:]
+        self.assertEqual([r.split()[:2] for r in rows],
+                         [["vm1", "3"], ["broken", "255"]])
+
+    def test_stale_address(self):
+        """An address that stopped answering is replaced or forgotten
+        """
+        tb = mock.Mock()
+        tb.address_cache.get.return_value = {"ip": "192.168.122.10", "mac": "m1"}
+        moved = _Domain("vm1", ("192.168.122.20", "m1"))
+        moved.use_address("192.168.122.10", "m1")
+        gone = _Domain("vm2")
+        gone.use_address("192.168.122.10", "m1")
+        with mock.patch.object(core, "probe_address", return_value=False):
+            core.Thinbox._resolve_address(tb, moved)
+            core.Thinbox._resolve_address(tb, gone)
+        self.assertEqual(moved.ip, "192.168.122.20")
+        tb.address_cache.set.assert_called_once_with("uuid-vm1", "192.168.122.20", "m1")
+        self.assertEqual(gone.ip, "")
+        tb.address_cache.forget.assert_called_once_with("uuid-vm2")
+
+
+if __name__ == "__main__":
+    unittest.main()
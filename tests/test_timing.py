@@ -0,0 +1,45 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from thinbox import timing
+
+
+class TestTiming(unittest.TestCase):
+
+    def test_span_not_recorded(self):
+        """Spans outside of a recorded command cost nothing
+        """
+        with timing.span("create.qemu-img") as attrs:
+            attrs["bytes"] = 1
+        self.assertIsNone(timing._recorder.get())
+
+    def test_record(self):
+        """Spans are summed by phase and appended to the trace
+        """
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trace = os.path.join(tmpdir, "trace.jsonl")
+            with timing.record("pull", trace=trace, file=out) as recorder:
+                with timing.span("pull.download", file="a") as attrs:
+                    attrs["bytes"] = 10
+                with timing.span("pull.download", file="b"):
+                    pass
+                with timing.span("pull.hash"):
+                    pass
+            with open(trace) as file:
+                spans = [json.loads(line) for line in file]
+
+        self.assertEqual([(n, c) for n, c, _ in recorder.breakdown()],
+                         [("pull.download", 2), ("pull.hash", 1)])
+        self.assertEqual(len(spans), 3)
+        self.assertEqual(spans[0]["command"], "pull")
+        self.assertEqual(spans[0]["bytes"], 10)
+        self.assertIn("pull.download", out.getvalue())
+        self.assertIsNone(timing._recorder.get())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from thinbox.transfer import TransferEngine, choose_mode
+
+
+class _Channel(object):
+    """exec channel of a remote command, its output given in chunks"""
+
+    def __init__(self, stdout=(), stderr=(), code=0):
+        self._stdout = list(stdout)
+        self._stderr = list(stderr)
+        self._code = code
+        self.sent = b""
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+
+    def sendall(self, data):
+        self.sent += data
+
+    def shutdown_write(self):
+        pass
+
+    def recv(self, size):
+        return self._stdout.pop(0) if self._stdout else b""
+
+    def recv_stderr(self, size):
+        return self._stderr.pop(0) if self._stderr else b""
+
+    def recv_exit_status(self):
+        return self._code
+
+    def close(self):
+        pass
+
+
+class _Transport(object):
+
+    def __init__(self, *channels):
+        self.channels = list(channels)
+
+    def open_session(self):
+        return self.channels.pop(0)
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, "src", "sub"))
+        for f in ["src/a", "src/sub/b", "c"]:
+            with open(os.path.join(self.tmpdir, f), "w") as file:
+                file.write(f)
+
+    def test_plan_put(self):
+        """Plan remote dirs and files of a recursive put
+        """
+        engine = TransferEngine(None)
+        src = os.path.join(self.tmpdir, "src")
+        c = os.path.join(self.tmpdir, "c")
+        dirs, tasks = engine.plan_put([src + "/", c], "/root")
+
+        self.assertEqual(dirs, ["/root/src", "/root/src/sub"])
+        self.assertEqual(tasks, [
+            (os.path.join(src, "a"), "/root/src/a"),
+            (os.path.join(src, "sub", "b"), "/root/src/sub/b"),
+            (c, "/root/c"),
+        ])
+
+    def test_choose_mode(self):
+        """Stream many small files, send few or big files one by one
+        """
+        self.assertEqual(choose_mode([1024] * 300, 256, 256 * 1024), "tar")
+        self.assertEqual(choose_mode([1024] * 10, 256, 256 * 1024), "sftp")
+        self.assertEqual(choose_mode([1024 * 1024] * 300, 256, 256 * 1024), "sftp")
+        self.assertEqual(choose_mode([], 0, 0), "sftp")
+
+    def test_put_tar_errors(self):
+        """Every error of a failed remote tar is read and reported
+        """
+        channel = _Channel(stderr=[b"tar: a: Cannot open\ntar: b: Cannot open\n"] * 100,
+                           code=2)
+        engine = TransferEngine(_Transport(channel))
+        with self.assertLogs(level="ERROR") as logs:
+            failed = engine.put_tar([os.path.join(self.tmpdir, "src")], "/root",
+                                    compression="none")
+        self.assertEqual(failed, 2)
+        self.assertEqual(len(logs.output), 200)
+        self.assertIn(b"src/sub/b", channel.sent)
+
+    def _sync(self, remote, delete):
+        """Sync src into /root against the remote find output remote"""
+        out = "".join("{} {} {} {}\0".format(*e) for e in remote).encode()
+        # the listing arrives in small chunks
+        channel = _Channel(stdout=[out[i:i + 7] for i in range(0, len(out), 7)])
+        sftp = mock.Mock()
+        sftp.stat.side_effect = IOError("No such file")
+        with mock.patch.object(TransferEngine, "sftp", new_callable=mock.PropertyMock,
+                               return_value=sftp), \
+                mock.patch("builtins.print"):
+            failed = TransferEngine(_Transport(channel), jobs=1).sync(
+                [os.path.join(self.tmpdir, "src")], "/root", delete=delete)
+        self.assertEqual(failed, 0)
+        return sftp
+
+    def test_sync_manifest(self):
+        """Files with the same size and mtime remotely are not sent
+        """
+        a = os.path.join(self.tmpdir, "src", "a")
+        mtime = os.stat(a).st_mtime
+        sftp = self._sync([
+            ("d", 4096, mtime, "/root/src"),
+            ("f", 5, mtime, "/root/src/a"),
+            ("d", 4096, mtime, "/root/src/sub"),
+            ("f", 1, mtime, "/root/src/old"),
+        ], delete=False)
+        sftp.put.assert_called_once_with(
+            os.path.join(self.tmpdir, "src", "sub", "b"), "/root/src/sub/b")
+        sftp.mkdir.assert_not_called()
+        sftp.remove.assert_not_called()
+
+    def test_sync_delete(self):
+        """Remote paths missing locally are removed, deepest first
+        """
+        sftp = self._sync([
+            ("d", 4096, 0, "/root/src"),
+            ("f", 1, 0, "/root/src/old"),
+            ("d", 4096, 0, "/root/src/olddir"),
+            ("f", 1, 0, "/root/src/olddir/x"),
+        ], delete=True)
+        self.assertEqual(sftp.put.call_count, 2)
+        sftp.mkdir.assert_called_with("/root/src/sub")
+        self.assertEqual(
+            [c for c in sftp.method_calls if c[0] in ("remove", "rmdir")],
+            [mock.call.remove("/root/src/olddir/x"),
+             mock.call.rmdir("/root/src/olddir"),
+             mock.call.remove("/root/src/old")])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
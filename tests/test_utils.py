@@ -0,0 +1,275 @@
+import io
+import os
+import socket
+import functools
+import subprocess
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+import requests
+from unittest import mock
+from http.server import ThreadingHTTPServer
+
+from thinbox.utils import (
+    download_file, inject_options, memory_shortfall, parse_inject, parse_share, parse_size,
+    probe_address, run_ssh_command, share_options, fstab_command, BandwidthLimiter,
+    ReadOnlyRequestHandler, SSHPool)
+
+
+class _Channel(object):
+    """exec channel of a finished command, reads recorded in order"""
+
+    def __init__(self, stdout, stderr):
+        self._stdout = list(stdout)
+        self._stderr = list(stderr)
+        self.reads = []
+        self.eof_received = True
+        self.closed = False
+
+    def exec_command(self, cmd):
+        pass
+
+    def shutdown_write(self):
+        pass
+
+    def recv_ready(self):
+        return bool(self._stdout)
+
+    def recv(self, size):
+        self.reads.append("stdout")
+        return self._stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self._stderr)
+
+    def recv_stderr(self, size):
+        self.reads.append("stderr")
+        return self._stderr.pop(0)
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return 0
+
+
+class _Transport(object):
+
+    def __init__(self, channel=None):
+        self._channel = channel
+
+    def is_active(self):
+        return True
+
+    def open_session(self):
+        return self._channel
+
+
+class _Client(object):
+
+    def __init__(self, channel=None):
+        self.closed = False
+        self._channel = channel
+
+    def get_transport(self):
+        return _Transport(self._channel)
+
+    def close(self):
+        self.closed = True
+
+
+class TestUtils(unittest.TestCase):
+
+    def test_parse_size(self):
+        """Parse plain numbers and binary suffixes
+        """
+        self.assertEqual(parse_size("512"), 512)
+        self.assertEqual(parse_size("512K"), 512 * 1024)
+        self.assertEqual(parse_size("10M"), 10 * 1024 ** 2)
+        self.assertEqual(parse_size("1.5GiB"), 3 * 1024 ** 3 // 2)
+        self.assertEqual(parse_size(4096), 4096)
+
+        with self.assertRaises(ValueError):
+            parse_size("ten megs")
+
+    def test_memory_shortfall(self):
+        """Domains fit within the overcommit ratio, free memory is advisory
+        """
+        host = {"total": 16384, "free": 1024, "committed": 12288}
+        self.assertIsNone(memory_shortfall(2048, host, 1.0))
+        self.assertIn("exceed", memory_shortfall(8192, host, 1.0))
+        self.assertIsNone(memory_shortfall(8192, host, 2.0))
+        self.assertIsNone(memory_shortfall(8192, host, 0))
+
+    def test_limiter_chunk_size(self):
+        """Limited transfers use smaller chunks
+        """
+        self.assertEqual(BandwidthLimiter().chunk_size(1024 ** 2), 1024 ** 2)
+        self.assertEqual(
+            BandwidthLimiter(1024 ** 2).chunk_size(1024 ** 2), 128 * 1024)
+
+    def test_parse_share(self):
+        """Parse shares, the tag defaults to the directory name
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertEqual(parse_share(tmpdir + ":src"), (tmpdir, "src"))
+            self.assertEqual(parse_share(tmpdir + "/"),
+                             (tmpdir, os.path.basename(tmpdir)))
+
+            with self.assertRaises(ValueError):
+                parse_share(os.path.join(tmpdir, "missing") + ":src")
+            with self.assertRaises(ValueError):
+                parse_share(tmpdir + ":bad tag")
+
+    def test_share_options(self):
+        """Shares need shared memory backing and an fstab entry
+        """
+        install, sysprep = share_options([("/srv/src", "src")])
+        self.assertEqual(install, [
+            "--memorybacking", "source.type=memfd,access.mode=shared",
+            "--filesystem", "source.dir=/srv/src,target.dir=src,driver.type=virtiofs"])
+        self.assertEqual(sysprep, [
+            "--mkdir", "/mnt/src",
+            "--append-line", "/etc/fstab:src /mnt/src virtiofs defaults,nofail 0 0"])
+        self.assertEqual(share_options(None), ([], []))
+
+    def test_fstab_command(self):
+        """Sharing a tag twice adds its fstab entry once
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fstab = os.path.join(tmpdir, "fstab")
+            with open(fstab, "w") as f:
+                f.write("/dev/vda1 / xfs defaults 0 0\n")
+            cmd = fstab_command("src").replace("/etc/fstab", fstab).replace(
+                "mkdir -p /mnt/", "mkdir -p " + tmpdir + "/mnt/")
+            for _ in range(2):
+                subprocess.run(["sh", "-c", cmd], check=True)
+            with open(fstab) as f:
+                self.assertEqual(f.read().splitlines(), [
+                    "/dev/vda1 / xfs defaults 0 0",
+                    "src /mnt/src virtiofs defaults,nofail 0 0"])
+            self.assertTrue(os.path.isdir(os.path.join(tmpdir, "mnt", "src")))
+
+    def test_serve_hidden(self):
+        """Hidden files are not found, the others are served
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ("a.qcow2", "b.qcow2"):
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(name)
+            handler = functools.partial(
+                ReadOnlyRequestHandler, directory=tmpdir,
+                hidden=lambda name: name == "b.qcow2")
+            with ThreadingHTTPServer(("127.0.0.1", 0), handler) as httpd:
+                threading.Thread(target=httpd.serve_forever, daemon=True).start()
+                url = "http://127.0.0.1:{}/".format(httpd.server_address[1])
+                try:
+                    with urllib.request.urlopen(url + "a.qcow2") as response:
+                        self.assertEqual(response.read(), b"a.qcow2")
+                    with self.assertRaises(urllib.error.HTTPError) as cm:
+                        urllib.request.urlopen(url + "b.qcow2")
+                    self.assertEqual(cm.exception.code, 404)
+                    cm.exception.close()
+                finally:
+                    httpd.shutdown()
+
+    def test_download_file_error(self):
+        """An error status raises instead of saving the error page
+        """
+        with tempfile.TemporaryDirectory() as srvdir, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            handler = functools.partial(ReadOnlyRequestHandler, directory=srvdir)
+            with ThreadingHTTPServer(("127.0.0.1", 0), handler) as httpd:
+                threading.Thread(target=httpd.serve_forever, daemon=True).start()
+                url = "http://127.0.0.1:{}/missing.qcow2".format(
+                    httpd.server_address[1])
+                try:
+                    with self.assertRaises(requests.HTTPError):
+                        download_file(url, os.path.join(tmpdir, "missing.qcow2"))
+                finally:
+                    httpd.shutdown()
+
+    def test_run_ssh_command_streams(self):
+        """stderr is read while stdout keeps coming, nothing is left behind
+        """
+        channel = _Channel([b"out\n"] * 3, [b"err\n"] * 3)
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as out, \
+                mock.patch("sys.stderr", new_callable=io.StringIO) as err, \
+                mock.patch("select.select") as select:
+            self.assertEqual(run_ssh_command(_Client(channel), "true", prefix="vm1: "), 0)
+        self.assertEqual(channel.reads, ["stdout", "stderr"] * 3)
+        self.assertEqual(out.getvalue(), "vm1: out\n" * 3)
+        self.assertEqual(err.getvalue(), "vm1: err\n" * 3)
+        select.assert_not_called()
+
+    def test_parse_inject(self):
+        """Injections copy an existing local path into a guest directory
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertEqual(parse_inject(tmpdir + ":/opt/payload"),
+                             (tmpdir, "/opt/payload"))
+            self.assertEqual(
+                inject_options([(tmpdir, "/opt/payload")]),
+                ["--mkdir", "/opt/payload",
+                 "--copy-in", tmpdir + ":/opt/payload"])
+
+            with self.assertRaises(ValueError):
+                parse_inject(tmpdir + ":opt")
+            with self.assertRaises(ValueError):
+                parse_inject(os.path.join(tmpdir, "missing") + ":/opt")
+
+    def test_probe_address(self):
+        """Probe succeeds only while something listens
+        """
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        self.assertTrue(probe_address("127.0.0.1", port=port))
+        server.close()
+        self.assertFalse(probe_address("127.0.0.1", port=port))
+
+    @mock.patch("thinbox.utils.create_ssh_connection",
+                side_effect=lambda *args: _Client())
+    def test_ssh_pool_lease(self, connect):
+        """Held connections are never expired, released ones once idle
+        """
+        pool = SSHPool(idle=0)
+        held = pool.acquire("vm1")
+        pool.acquire("vm2")
+        self.assertFalse(held.closed)
+        self.assertIs(pool.acquire("vm1"), held)
+
+        pool.release(held)
+        pool.release(held)
+        pool.acquire("vm2")
+        self.assertTrue(held.closed)
+
+    def test_ssh_pool_concurrent_connect(self):
+        """Concurrent connections to one host keep one, close the other
+        """
+        barrier = threading.Barrier(2)
+        clients = []
+
+        def connect(*args):
+            barrier.wait()
+            clients.append(_Client())
+            return clients[-1]
+
+        pool = SSHPool()
+        got = []
+        with mock.patch("thinbox.utils.create_ssh_connection", side_effect=connect):
+            threads = [threading.Thread(target=lambda: got.append(pool.acquire("vm1")))
+                       for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertIs(got[0], got[1])
+        self.assertEqual(sorted(c.closed for c in clients), [False, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -22,9 +22,9 @@ Requires:       python3-argcomplete
 Requires:       python3-beautifulsoup4
 Requires:       python3-paramiko
 Requires:       python3-requests
-Requires:       python3-scp
 Requires:       util-linux
 Requires:       libvirt-client
+Recommends:     python3-zstandard
 
 %description
 
@@ -43,6 +43,7 @@ install -Dm0644 build/man/%{name}.1 %{buildroot}/%{_mandir}/man1/%{name}.1
 
 %files -f INSTALLED_FILES
 %{_bindir}/%{name}
+%{_bindir}/%{name}d
 %license LICENSE
 %defattr(-,root,root)
 %{_mandir}/man1/%{name}.1*
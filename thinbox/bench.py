@@ -0,0 +1,240 @@
+import os
+import logging
+
+from time import monotonic, sleep
+
+from thinbox import qemu
+from thinbox.utils import (
+    probe_address, run_ssh_command, sizeof_fmt, ssh_pool)
+
+# phases of a boot, after create defined and started the domain
+BOOT_PHASES = ["create", "running", "lease", "sshd", "command"]
+
+# times from the start of create
+BOOT_TOTALS = ["to_ip", "to_ssh", "total"]
+
+
+def bench_disk(base, workdir, profiles, size=256 * 1024 * 1024,
+               bufsize=1024 * 1024, ops=2000, seed=0):
+    """Benchmark overlays created with each disk profile
+
+    For every profile an overlay backed by base is created in workdir and
+    measured with, in order, sequential writes and reads of `size` bytes
+    and `ops` random 4KiB writes and reads. Writes go first so that reads
+    see the clusters allocated in the overlay as well as the backing file.
+    Overlays are removed afterwards.
+
+    :param base: Path of the backing qcow2 image
+    :type base: str
+
+    :param workdir: Directory where overlays are created
+    :type workdir: str
+
+    :param profiles: Disk profiles by name, see thinbox.config.DISK_PROFILES
+    :type profiles: dict
+
+    :param size: Bytes of sequential I/O, defaults to 256MiB
+    :type size: int, optional
+
+    :param bufsize: Size of sequential requests, defaults to 1MiB
+    :type bufsize: int, optional
+
+    :param ops: Number of random requests, defaults to 2000
+    :type ops: int, optional
+
+    :param seed: Seed of random offsets, same for every profile
+    :type seed: int, optional
+
+    :return: One dict per profile with bytes/s for seq_write, seq_read and
+        IOPS for rand_write, rand_read, None when a measure failed
+    :rtype: list
+    """
+    def rate(amount, elapsed):
+        if not elapsed:
+            return None
+        return amount / elapsed
+
+    count = max(size // bufsize, 1)
+    results = []
+    for name, profile in profiles.items():
+        overlay = os.path.join(workdir, name + ".qcow2")
+        if not qemu.create_overlay(base, overlay, **profile):
+            logging.error("Could not create overlay for profile '{}'.".format(name))
+            continue
+        print("Benchmarking profile '{}'".format(name))
+        try:
+            results.append({
+                "profile": name,
+                "seq_write": rate(count * bufsize, qemu.bench(
+                    overlay, count, bufsize=bufsize, write=True)),
+                "seq_read": rate(count * bufsize, qemu.bench(
+                    overlay, count, bufsize=bufsize)),
+                "rand_write": rate(ops, qemu.random_io(
+                    overlay, ops, write=True, seed=seed)),
+                "rand_read": rate(ops, qemu.random_io(
+                    overlay, ops, seed=seed)),
+            })
+        finally:
+            os.remove(overlay)
+    return results
+
+
+def print_disk_results(results):
+    """Print disk benchmark results as a table
+
+    :param results: Results of bench_disk
+    :type results: list
+    """
+    def fmt_rate(value):
+        return "-" if value is None else sizeof_fmt(value) + "/s"
+
+    def fmt_iops(value):
+        return "-" if value is None else "{:.0f} IOPS".format(value)
+
+    print_format = "{:<16} {:>14} {:>14} {:>14} {:>14}"
+    print(print_format.format(
+        "PROFILE", "SEQ WRITE", "SEQ READ", "RAND WRITE", "RAND READ"))
+    for r in results:
+        print(print_format.format(
+            r["profile"],
+            fmt_rate(r["seq_write"]), fmt_rate(r["seq_read"]),
+            fmt_iops(r["rand_write"]), fmt_iops(r["rand_read"])))
+
+
+def measure_boot(dom, timeout=300, poll=.2):
+    """Wait for a started domain to boot, timing each phase
+
+    :param dom: Domain just started, its address is set from the lease
+    :type dom: thinbox.domain.Domain
+
+    :param timeout: Seconds to wait for the whole boot, defaults to 300
+    :type timeout: int, optional
+
+    :param poll: Seconds between checks, defaults to 0.2
+    :type poll: float, optional
+
+    :raises TimeoutError: If a phase is not reached in time
+
+    :return: Seconds each phase took, "running" until libvirt reports the
+        domain running, "lease" until its network has a DHCP lease for it,
+        "sshd" until port 22 of the leased IP accepts connections and
+        "command" until a first command ran
+    :rtype: dict
+    """
+    start = monotonic()
+    deadline = start + timeout
+    phases = {}
+
+    def wait(phase, ready):
+        begin = monotonic()
+        while not ready():
+            if monotonic() >= deadline:
+                raise TimeoutError("'{}' did not reach {} within {} seconds".format(
+                    dom.name, phase, timeout))
+            sleep(poll)
+        phases[phase] = monotonic() - begin
+
+    def leased():
+        # the lease, the ARP table lags until the guest sends traffic
+        ip, mac = dom.address(lease=True)
+        if ip == "":
+            return False
+        dom.use_address(ip, mac)
+        return True
+
+    wait("running", lambda: dom.state == "running")
+    wait("lease", leased)
+    wait("sshd", lambda: probe_address(dom.ip, timeout=1))
+    wait("command", lambda: _first_command(dom.ip))
+    return phases
+
+
+def _first_command(ip):
+    """Return True once a command runs over ssh"""
+    try:
+        with ssh_pool.lease(ip) as ssh:
+            return run_ssh_command(ssh, "true") == 0
+    except Exception as e:
+        # sshd may accept connections before keys are in place
+        logging.debug("ssh to {}: {}".format(ip, e))
+        ssh_pool.discard(ip)
+        return False
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values, interpolated
+
+    :param values: Numbers
+    :type values: list
+
+    :param p: Percentile, between 0 and 100
+    :type p: float
+
+    :return: None if values is empty
+    :rtype: float
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def boot_report(vms, wall):
+    """Summarize the boots of bench boot
+
+    :param vms: One dict per domain with the seconds of each phase of
+        BOOT_PHASES, or an "error"
+    :type vms: list
+
+    :param wall: Seconds the whole benchmark took
+    :type wall: float
+
+    :return: p50, p90, p99 and mean of phases and totals, booted domains
+        per minute and the number of failed boots
+    :rtype: dict
+    """
+    booted = [vm for vm in vms if "error" not in vm]
+    for vm in booted:
+        vm["to_ip"] = vm["create"] + vm["running"] + vm["lease"]
+        vm["to_ssh"] = vm["to_ip"] + vm["sshd"]
+        vm["total"] = vm["to_ssh"] + vm["command"]
+    summary = {}
+    for metric in BOOT_PHASES + BOOT_TOTALS:
+        values = [vm[metric] for vm in booted]
+        summary[metric] = {
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None,
+        }
+    return {
+        "wall": wall,
+        "booted": len(booted),
+        "failed": len(vms) - len(booted),
+        "throughput": len(booted) * 60 / wall if wall else None,
+        "summary": summary,
+        "vms": vms,
+    }
+
+
+def print_boot_results(report):
+    """Print boot benchmark results as a table
+
+    :param report: Report of boot_report
+    :type report: dict
+    """
+    def fmt(value):
+        return "-" if value is None else "{:.2f}s".format(value)
+
+    print_format = "{:<10} {:>9} {:>9} {:>9} {:>9}"
+    print(print_format.format("PHASE", "P50", "P90", "P99", "MEAN"))
+    for metric in BOOT_PHASES + BOOT_TOTALS:
+        s = report["summary"][metric]
+        print(print_format.format(
+            metric, fmt(s["p50"]), fmt(s["p90"]), fmt(s["p99"]), fmt(s["mean"])))
+    print("{} booted, {} failed in {:.1f}s, {} VMs/min".format(
+        report["booted"], report["failed"], report["wall"],
+        "-" if report["throughput"] is None else "{:.1f}".format(report["throughput"])))
@@ -0,0 +1,458 @@
+import os
+import json
+import glob
+import time
+import fcntl
+import logging
+import threading
+import contextlib
+
+from thinbox import qemu
+from thinbox.utils import parse_size, sizeof_fmt
+
+
+class BackingIndex(object):
+    """Index of the overlays backed by each base image
+
+    Kept in THINBOX_CACHE_DIR/backing.json as base name to overlay names,
+    updated by create and remove. When the file is missing, or for overlays
+    it does not know yet, it is rebuilt by reading qcow2 headers, without
+    spawning qemu-img.
+
+    :param env: Thinbox environment
+    :type env: thinbox.config.Env
+    """
+
+    def __init__(self, env):
+        super().__init__()
+        self._env = env
+        self._index_file = os.path.join(env.THINBOX_CACHE_DIR, 'backing.json')
+        self._index = _load_json(self._index_file)
+        if self._index is None:
+            self.rebuild()
+
+    def add(self, base_name, overlay_name):
+        """Record that an overlay is backed by a base image
+
+        :param base_name: Name of the base image
+        :type base_name: str
+
+        :param overlay_name: File name of the overlay in THINBOX_IMAGE_DIR
+        :type overlay_name: str
+        """
+        with locked(self._index_file):
+            self._reload()
+            overlays = self._index.setdefault(base_name, [])
+            if overlay_name not in overlays:
+                overlays.append(overlay_name)
+                self._save()
+
+    def remove_overlay(self, overlay_name):
+        """Forget an overlay
+
+        :param overlay_name: File name of the overlay in THINBOX_IMAGE_DIR
+        :type overlay_name: str
+        """
+        with locked(self._index_file):
+            self._reload()
+            changed = False
+            for base_name in list(self._index):
+                if overlay_name in self._index[base_name]:
+                    self._index[base_name].remove(overlay_name)
+                    changed = True
+                if self._index[base_name] == []:
+                    del self._index[base_name]
+            if changed:
+                self._save()
+
+    def remove_base(self, base_name):
+        """Forget a base image and its overlays
+
+        :param base_name: Name of the base image
+        :type base_name: str
+        """
+        with locked(self._index_file):
+            self._reload()
+            if self._index.pop(base_name, None) is not None:
+                self._save()
+
+    def dependents(self, base_name):
+        """Return overlays backed by a base image
+
+        Overlays whose file no longer exists are left out.
+
+        :param base_name: Name of the base image
+        :type base_name: str
+
+        :return: File names of overlays in THINBOX_IMAGE_DIR
+        :rtype: list
+        """
+        return [o for o in self._index.get(base_name, [])
+                if os.path.exists(self._overlay_path(o))]
+
+    def base_of(self, overlay_name):
+        """Return the base image of an overlay
+
+        Overlays not in the index are looked up in their qcow2 header and
+        added.
+
+        :param overlay_name: File name of the overlay in THINBOX_IMAGE_DIR
+        :type overlay_name: str
+
+        :return: Name of the base image, None if not in THINBOX_BASE_DIR
+        :rtype: str
+
+        :raises OSError: If the qcow2 header cannot be read
+        """
+        for base_name, overlays in self._index.items():
+            if overlay_name in overlays:
+                return base_name
+        base_name = self._read_base(overlay_name)
+        if base_name is not None:
+            self.add(base_name, overlay_name)
+        return base_name
+
+    def rebuild(self):
+        """Rebuild the index from the qcow2 headers of all overlays
+        """
+        self._index = {}
+        for overlay in sorted(glob.glob(
+                os.path.join(self._env.THINBOX_IMAGE_DIR, '*.qcow2'))):
+            overlay_name = os.path.basename(overlay)
+            try:
+                base_name = self._read_base(overlay_name)
+            except OSError as e:
+                # left out, base_of reads it again when asked
+                logging.warning("Cannot read {}: {}".format(overlay_name, e))
+                continue
+            if base_name is not None:
+                self._index.setdefault(base_name, []).append(overlay_name)
+        self._save()
+        logging.debug("Rebuilt backing index {}.".format(self._index_file))
+
+    def _read_base(self, overlay_name):
+        backing = qemu.read_backing_file(self._overlay_path(overlay_name))
+        if backing is None:
+            return None
+        base_dir = os.path.realpath(self._env.THINBOX_BASE_DIR)
+        backing = os.path.join(self._env.THINBOX_IMAGE_DIR, backing)
+        if os.path.dirname(os.path.realpath(backing)) != base_dir:
+            return None
+        return os.path.basename(backing)
+
+    def _overlay_path(self, overlay_name):
+        return os.path.join(self._env.THINBOX_IMAGE_DIR, overlay_name)
+
+    def _reload(self):
+        """Read changes saved by other processes since the index was loaded"""
+        index = _load_json(self._index_file)
+        if index is not None:
+            self._index = index
+
+    def _save(self):
+        _save_json(self._index_file, self._index)
+
+
+class ImageCache(object):
+    """Size-capped cache of base images and overlays
+
+    Last-used times of base images are kept in THINBOX_CACHE_DIR/usage.json
+    and updated by create and pull. A garbage collection pass removes
+    overlays without a domain, then evicts least recently used base images
+    that no overlay depends on until the cache fits in THINBOX_CACHE_SIZE.
+
+    :param env: Thinbox environment
+    :type env: thinbox.config.Env
+
+    :param index: Backing index, defaults to a new one
+    :type index: thinbox.cache.BackingIndex, optional
+
+    :param grace: Seconds an overlay is protected after its last change, so
+        that a create still running is not collected, defaults to 600
+    :type grace: int, optional
+    """
+
+    def __init__(self, env, index=None, grace=600):
+        super().__init__()
+        self._env = env
+        self._index = index or BackingIndex(env)
+        self._grace = grace
+        self._usage_file = os.path.join(env.THINBOX_CACHE_DIR, 'usage.json')
+        self._usage = _load_json(self._usage_file) or {}
+
+    @property
+    def cap(self):
+        """Return the cache size cap in bytes
+
+        :return: 0 if unlimited
+        :rtype: int
+        """
+        return parse_size(self._env.THINBOX_CACHE_SIZE)
+
+    def touch(self, base_name):
+        """Mark a base image as used now
+
+        :param base_name: Name of the base image
+        :type base_name: str
+        """
+        with locked(self._usage_file):
+            self._reload()
+            self._usage[base_name] = time.time()
+            self._save()
+
+    def forget(self, base_name):
+        """Drop usage of a removed base image
+
+        :param base_name: Name of the base image
+        :type base_name: str
+        """
+        with locked(self._usage_file):
+            self._reload()
+            if self._usage.pop(base_name, None) is not None:
+                self._save()
+
+    def last_used(self, base_name):
+        """Return when a base image was last used
+
+        Base images never used by create fall back to their mtime.
+
+        :param base_name: Name of the base image
+        :type base_name: str
+
+        :return: Seconds since epoch
+        :rtype: float
+        """
+        if base_name in self._usage:
+            return self._usage[base_name]
+        return os.path.getmtime(self._base_path(base_name))
+
+    def bases(self):
+        """Return names of base images
+
+        Images still being normalized by a pull are left out.
+
+        :rtype: list
+        """
+        return sorted(
+            f for f in os.listdir(self._env.THINBOX_BASE_DIR)
+            if os.path.isfile(self._base_path(f))
+            and not f.endswith(".normalizing"))
+
+    def overlays(self):
+        """Return paths of overlays
+
+        :rtype: list
+        """
+        return sorted(glob.glob(
+            os.path.join(self._env.THINBOX_IMAGE_DIR, '*.qcow2')))
+
+    def size(self):
+        """Return bytes used on disk by base images and overlays
+
+        :rtype: int
+        """
+        paths = [self._base_path(b) for b in self.bases()] + self.overlays()
+        return sum(_disk_usage(p) for p in paths)
+
+    def dependencies(self, overlays=None):
+        """Return the base image of every overlay
+
+        :param overlays: Paths of overlays, defaults to all overlays
+        :type overlays: list, optional
+
+        :return: Overlay path to base image name, None if the backing file
+            is not in THINBOX_BASE_DIR
+        :rtype: dict
+
+        :raises OSError: If the qcow2 header of an overlay cannot be read
+        """
+        if overlays is None:
+            overlays = self.overlays()
+        return {o: self._index.base_of(os.path.basename(o)) for o in overlays}
+
+    def orphans(self, domain_names):
+        """Return overlays with no matching domain
+
+        :param domain_names: Names of defined domains
+        :type domain_names: list
+
+        :rtype: list
+        """
+        now = time.time()
+        orphans = []
+        for overlay in self.overlays():
+            name = os.path.basename(overlay)[:-len('.qcow2')]
+            if name in domain_names:
+                continue
+            if now - os.path.getmtime(overlay) < self._grace:
+                logging.debug("Overlay {} is recent, skipping.".format(overlay))
+                continue
+            orphans.append(overlay)
+        return orphans
+
+    def gc(self, domain_names, dry_run=False):
+        """Remove orphan overlays and evict least recently used bases
+
+        :param domain_names: Names of defined domains
+        :type domain_names: list
+
+        :param dry_run: Only print what would be removed
+        :type dry_run: bool, optional
+
+        :return: Bytes freed
+        :rtype: int
+        """
+        verb = "Would remove" if dry_run else "Removed"
+        used = self.size()
+        freed = 0
+        orphans = self.orphans(domain_names)
+        for overlay in orphans:
+            size = _disk_usage(overlay)
+            if not dry_run:
+                os.remove(overlay)
+                self._index.remove_overlay(os.path.basename(overlay))
+            freed += size
+            print("{} orphan overlay '{}' ({})".format(
+                verb, os.path.basename(overlay), sizeof_fmt(size)))
+
+        cap = self.cap
+        in_use = None
+        if cap and used - freed > cap:
+            try:
+                in_use = set(self.dependencies(
+                    [o for o in self.overlays() if o not in orphans]).values())
+            except OSError as e:
+                # an unreadable overlay may be backed by any of them
+                logging.warning(
+                    "Cannot tell which base images are in use, none is evicted: {}".format(e))
+        if in_use is not None:
+            for base in sorted(self.bases(), key=self.last_used):
+                if used - freed <= cap:
+                    break
+                if base in in_use:
+                    continue
+                size = _disk_usage(self._base_path(base))
+                last = time.localtime(self.last_used(base))
+                if not dry_run:
+                    self._remove_base(base)
+                freed += size
+                print("{} base image '{}' ({}, last used {})".format(
+                    verb, base, sizeof_fmt(size),
+                    time.strftime("%Y-%m-%d %H:%M", last)))
+            if used - freed > cap:
+                logging.warning(
+                    "Cache is {} over its cap, the remaining base images are in use.".format(
+                        sizeof_fmt(used - freed - cap)))
+        print("Freed {}, cache uses {}{}.".format(
+            sizeof_fmt(freed), sizeof_fmt(used - freed),
+            " of " + sizeof_fmt(cap) if cap else ""))
+        return freed
+
+    def _remove_base(self, base_name):
+        os.remove(self._base_path(base_name))
+        for hashfile in glob.glob(os.path.join(
+                self._env.THINBOX_HASH_DIR, glob.escape(base_name) + ".*")):
+            os.remove(hashfile)
+        self.forget(base_name)
+        self._index.remove_base(base_name)
+
+    def _base_path(self, base_name):
+        return os.path.join(self._env.THINBOX_BASE_DIR, base_name)
+
+    def _reload(self):
+        """Read uses saved by other processes since usage was loaded"""
+        usage = _load_json(self._usage_file)
+        if usage is not None:
+            self._usage = usage
+
+    def _save(self):
+        _save_json(self._usage_file, self._usage)
+
+
+class AddressCache(object):
+    """Last known IP and MAC of domains, by UUID
+
+    Kept in THINBOX_CACHE_DIR/addr.json so that connecting again to a
+    long-lived domain does not wait for libvirt to see it in the ARP table.
+
+    :param env: Thinbox environment
+    :type env: thinbox.config.Env
+    """
+
+    def __init__(self, env):
+        super().__init__()
+        self._cache_file = os.path.join(env.THINBOX_CACHE_DIR, 'addr.json')
+        self._cache = _load_json(self._cache_file) or {}
+        self._lock = threading.Lock()
+
+    def get(self, uuid):
+        """Return the last known address of a domain
+
+        :param uuid: UUID of the domain
+        :type uuid: str
+
+        :return: Dict with ip and mac, None if unknown
+        :rtype: dict
+        """
+        return self._cache.get(uuid)
+
+    def set(self, uuid, ip, mac=""):
+        """Record the address of a domain
+
+        :param uuid: UUID of the domain
+        :type uuid: str
+
+        :param ip: IP of the domain
+        :type ip: str
+
+        :param mac: MAC of the domain
+        :type mac: str, optional
+        """
+        with self._lock:
+            if self._cache.get(uuid) == {"ip": ip, "mac": mac}:
+                return
+            self._cache[uuid] = {"ip": ip, "mac": mac}
+            _save_json(self._cache_file, self._cache)
+
+    def forget(self, uuid):
+        """Drop the address of a domain
+
+        :param uuid: UUID of the domain
+        :type uuid: str
+        """
+        with self._lock:
+            if self._cache.pop(uuid, None) is not None:
+                _save_json(self._cache_file, self._cache)
+
+
+def _load_json(path):
+    """Load a json cache file, None if missing or corrupted"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except ValueError as e:
+        logging.warning("Ignoring corrupted {}: {}".format(path, e))
+        return None
+
+
+def _save_json(path, data):
+    """Atomically save a json cache file"""
+    tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as file:
+        json.dump(data, file, indent=4)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock of a cache file, between threads and processes"""
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _disk_usage(path):
+    """Return bytes allocated on disk by a file, sparse files included"""
+    return os.stat(path).st_blocks * 512
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import socket
+import logging
+
+from thinbox.config import Env
+
+# Client side of thinboxd, imported by the CLI before anything heavy.
+SOCKET_NAME = "thinboxd.sock"
+
+# commands thinboxd serves, the others always run in the CLI
+COMMANDS = {"list", "ls", "start", "stop", "run", "copy", "cp"}
+
+
+def socket_path(env=None):
+    """Return the path of the thinboxd socket
+
+    :param env: Thinbox environment, defaults to a new one
+    :type env: thinbox.config.Env, optional
+
+    :rtype: str
+    """
+    env = env or Env()
+    return os.path.join(env.THINBOX_CACHE_DIR, SOCKET_NAME)
+
+
+def call(args, path=None):
+    """Run a command in thinboxd and forward its output
+
+    The working directory is sent along, so relative paths of copy
+    resolve as they would in the CLI.
+
+    :param args: Parsed arguments of the CLI
+    :type args: argparse.Namespace
+
+    :param path: Socket path, defaults to socket_path()
+    :type path: str, optional
+
+    :return: Exit code of the command, None if thinboxd is not running
+    :rtype: int
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        logging.debug("thinboxd not running, running directly.")
+        return None
+
+    request = {"args": vars(args), "cwd": os.getcwd()}
+    with sock, sock.makefile("rb") as frames:
+        sock.sendall(json.dumps(request).encode("utf8") + b"\n")
+        for frame in frames:
+            frame = json.loads(frame)
+            if "exit" in frame:
+                return frame["exit"]
+            stream = sys.stdout if "out" in frame else sys.stderr
+            data = frame.get("out", frame.get("err", ""))
+            stream.buffer.write(data.encode("utf8", "surrogateescape"))
+            stream.buffer.flush()
+    logging.error("thinboxd closed the connection.")
+    return 255
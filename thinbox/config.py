@@ -23,7 +23,8 @@ else:
 THINBOX = os.path.basename(sys.argv[0])
 
 # virtual variables
-THINBOX_MEMORY = "1024"
+THINBOX_MEMORY = 1024
+THINBOX_VCPUS = 1
 THINBOX_SSH_OPTIONS = "-o StrictHostKeyChecking=no -o GlobalKnownHostsFile=/dev/null -o UserKnownHostsFile=/dev/null"
 
 # detect if running in a container
@@ -65,6 +66,60 @@ RHEL_TAGS = {
     "rhel8-latest"
 }
 
+# base image normalization after pull
+NORMALIZE_DEFAULTS = {
+    "enabled": False,
+    "cluster_size": "64k",
+    "compression": False,
+    "extended_l2": False,
+}
+
+# qcow2 options of the per-VM overlay, by profile name
+# preallocation together with a backing file needs extended_l2
+DISK_PROFILES = {
+    "default": {},
+    "lazy": {
+        "lazy_refcounts": True,
+    },
+    "subcluster": {
+        "cluster_size": "128k",
+        "extended_l2": True,
+    },
+    "prealloc": {
+        "cluster_size": "128k",
+        "extended_l2": True,
+        "lazy_refcounts": True,
+        "preallocation": "metadata",
+    },
+}
+
+# fields of `thinbox list`, by name to width in the table
+LIST_FIELDS = {
+    "name": 20,
+    "state": 8,
+    "ip": 16,
+    "mac": 10,
+    "uuid": 36,
+    "id": 4,
+    "reason": 6,
+}
+LIST_DEFAULT_FIELDS = ["name", "state", "ip", "mac"]
+LIST_FORMATS = ["table", "json", "ndjson", "tsv"]
+
+# seconds between checks of host memory while a domain waits to fit
+ADMISSION_INTERVAL = 5
+
+# external tools, by name to command or path
+TOOLS = {
+    "guestfish": "guestfish",
+    "qemu-img": "qemu-img",
+    "qemu-io": "qemu-io",
+    "virt-customize": "virt-customize",
+    "virt-install": "virt-install",
+    "virt-sysprep": "virt-sysprep",
+    "virt-xml": "virt-xml",
+}
+
 # FEDORA CONFIG
 FEDORA_TAGS = {
     "fedora-cloud-34",
@@ -86,6 +141,21 @@ ALLOWED_KEYS = {
     "THINBOX_CONFIG_DIR",
     "RHEL_BASE_URL",
     "THINBOX_MEMORY",
+    "THINBOX_VCPUS",
+    "THINBOX_OVERCOMMIT",
+    "THINBOX_MIRRORS",
+    "THINBOX_NORMALIZE",
+    "THINBOX_DISK_PROFILE",
+    "THINBOX_DISK_PROFILES",
+    "THINBOX_CACHE_SIZE",
+    "THINBOX_SSH_PERSIST",
+    "THINBOX_COPY_MODE",
+    "THINBOX_COPY_TAR_FILES",
+    "THINBOX_COPY_TAR_AVG_SIZE",
+    "THINBOX_COPY_COMPRESSION",
+    "THINBOX_TIMINGS",
+    "THINBOX_TIMINGS_TRACE",
+    "THINBOX_TOOLS",
 }
 
 PRIVATE_KEYS = {
@@ -93,6 +163,7 @@ PRIVATE_KEYS = {
     "THINBOX_BASE_DIR",
     "THINBOX_IMAGE_DIR",
     "THINBOX_HASH_DIR",
+    "THINBOX_SSH_DIR",
 }
 
 KNOWN_KEYS = ALLOWED_KEYS.union(PRIVATE_KEYS)
@@ -130,8 +201,74 @@ class Env(dict):
     :property THINBOX_HASH_DIR: Hash dir, defaults to $THINBOX_CACHE_DIR/hash
     :type THINBOX_HASH_DIR: str
 
-    :property THINBOX_MEMORY: Memory size of thinbox domains
+    :property THINBOX_MEMORY: Memory of created domains in MiB, defaults
+        to 1024
     :type THINBOX_MEMORY: int
+
+    :property THINBOX_VCPUS: Virtual CPUs of created domains, defaults to 1
+    :type THINBOX_VCPUS: int
+
+    :property THINBOX_OVERCOMMIT: Ratio of host memory that memory of
+        running domains may reach, create and start are refused beyond it,
+        0 disables the check, defaults to 1.0
+    :type THINBOX_OVERCOMMIT: float
+
+    :property THINBOX_MIRRORS: Ordered list of local dirs, NFS paths or HTTP
+        caches checked before upstream when pulling, defaults to []
+    :type THINBOX_MIRRORS: list
+
+    :property THINBOX_NORMALIZE: Layout base images are converted to after
+        pull, with keys enabled, cluster_size, compression, extended_l2
+    :type THINBOX_NORMALIZE: dict
+
+    :property THINBOX_DISK_PROFILE: Overlay profile used by create, defaults
+        to "default"
+    :type THINBOX_DISK_PROFILE: str
+
+    :property THINBOX_DISK_PROFILES: Overlay profiles by name, merged over
+        DISK_PROFILES
+    :type THINBOX_DISK_PROFILES: dict
+
+    :property THINBOX_CACHE_SIZE: Size cap of base images and overlays,
+        e.g. "100G", defaults to "0" which means unlimited
+    :type THINBOX_CACHE_SIZE: str
+
+    :property THINBOX_SSH_PERSIST: Seconds an idle ssh connection to a
+        domain is kept for reuse, 0 disables it, defaults to 600
+    :type THINBOX_SSH_PERSIST: int
+
+    :property THINBOX_COPY_MODE: How copy sends files into a domain, "sftp",
+        "tar" or "auto", defaults to "auto"
+    :type THINBOX_COPY_MODE: str
+
+    :property THINBOX_COPY_TAR_FILES: In auto mode, minimum number of files
+        streamed as a tar, defaults to 256
+    :type THINBOX_COPY_TAR_FILES: int
+
+    :property THINBOX_COPY_TAR_AVG_SIZE: In auto mode, maximum average file
+        size streamed as a tar, defaults to "256K"
+    :type THINBOX_COPY_TAR_AVG_SIZE: str
+
+    :property THINBOX_COPY_COMPRESSION: Compression of tar streams, "zstd",
+        "gzip" or "none", defaults to "zstd", gzip is used when the
+        zstandard module is missing
+    :type THINBOX_COPY_COMPRESSION: str
+
+    :property THINBOX_TIMINGS: Print the time spent in each phase of
+        commands, as --timings, defaults to False
+    :type THINBOX_TIMINGS: bool
+
+    :property THINBOX_TIMINGS_TRACE: File timing spans are appended to as
+        JSON lines, as --trace, defaults to "" for none
+    :type THINBOX_TIMINGS_TRACE: str
+
+    :property THINBOX_TOOLS: Commands or paths of external tools by name,
+        e.g. {"qemu-img": "/opt/qemu/bin/qemu-img"}, merged over TOOLS
+    :type THINBOX_TOOLS: dict
+
+    :property THINBOX_SSH_DIR: ssh ControlPath sockets dir, defaults to
+        $THINBOX_CACHE_DIR/ssh
+    :type THINBOX_SSH_DIR: str
     """
     def __init__(self):
         super().__init__()
@@ -298,7 +435,186 @@ class Env(dict):
 
         :rtype: int
         """
-        return self.__dict__['THINBOX_MEMORY']
+        return int(self['THINBOX_MEMORY'])
+
+    @property
+    def THINBOX_VCPUS(self):
+        """Get THINBOX_VCPUS
+
+        :rtype: int
+        """
+        return int(self['THINBOX_VCPUS'])
+
+    @property
+    def THINBOX_OVERCOMMIT(self):
+        """Get THINBOX_OVERCOMMIT
+
+        :rtype: float
+        """
+        return float(self['THINBOX_OVERCOMMIT'])
+
+    @property
+    def THINBOX_MIRRORS(self):
+        """Get THINBOX_MIRRORS
+
+        A comma separated string, as set by `thinbox env set`, is split
+        into a list.
+
+        :rtype: list
+        """
+        mirrors = self['THINBOX_MIRRORS']
+        if isinstance(mirrors, str):
+            mirrors = [m.strip() for m in mirrors.split(",") if m.strip()]
+        return mirrors
+
+    @property
+    def THINBOX_NORMALIZE(self):
+        """Get THINBOX_NORMALIZE
+
+        Missing keys are taken from NORMALIZE_DEFAULTS, a JSON string as
+        set by `thinbox env set` is accepted.
+
+        :rtype: dict
+        """
+        normalize = dict(NORMALIZE_DEFAULTS)
+        custom = self['THINBOX_NORMALIZE']
+        if isinstance(custom, str):
+            try:
+                custom = json.loads(custom)
+            except ValueError:
+                logging.error("THINBOX_NORMALIZE is not a JSON object: {}".format(custom))
+                sys.exit(1)
+        normalize.update(custom)
+        return normalize
+
+    @property
+    def THINBOX_DISK_PROFILE(self):
+        """Get THINBOX_DISK_PROFILE
+
+        :rtype: str
+        """
+        return self['THINBOX_DISK_PROFILE']
+
+    @property
+    def THINBOX_DISK_PROFILES(self):
+        """Get THINBOX_DISK_PROFILES
+
+        Profiles in config override DISK_PROFILES with the same name, a
+        JSON string as set by `thinbox env set` is accepted.
+
+        :rtype: dict
+        """
+        profiles = dict(DISK_PROFILES)
+        custom = self['THINBOX_DISK_PROFILES']
+        if isinstance(custom, str):
+            try:
+                custom = json.loads(custom)
+            except ValueError:
+                logging.error("THINBOX_DISK_PROFILES is not a JSON object: {}".format(custom))
+                sys.exit(1)
+        profiles.update(custom)
+        return profiles
+
+    @property
+    def THINBOX_CACHE_SIZE(self):
+        """Get THINBOX_CACHE_SIZE
+
+        :rtype: str
+        """
+        return self['THINBOX_CACHE_SIZE']
+
+    @property
+    def THINBOX_SSH_PERSIST(self):
+        """Get THINBOX_SSH_PERSIST
+
+        :rtype: int
+        """
+        return int(self['THINBOX_SSH_PERSIST'])
+
+    @property
+    def THINBOX_COPY_MODE(self):
+        """Get THINBOX_COPY_MODE
+
+        :rtype: str
+        """
+        return self['THINBOX_COPY_MODE']
+
+    @property
+    def THINBOX_COPY_TAR_FILES(self):
+        """Get THINBOX_COPY_TAR_FILES
+
+        :rtype: int
+        """
+        return int(self['THINBOX_COPY_TAR_FILES'])
+
+    @property
+    def THINBOX_COPY_TAR_AVG_SIZE(self):
+        """Get THINBOX_COPY_TAR_AVG_SIZE
+
+        :rtype: str
+        """
+        return self['THINBOX_COPY_TAR_AVG_SIZE']
+
+    @property
+    def THINBOX_COPY_COMPRESSION(self):
+        """Get THINBOX_COPY_COMPRESSION
+
+        :rtype: str
+        """
+        return self['THINBOX_COPY_COMPRESSION']
+
+    @property
+    def THINBOX_TIMINGS(self):
+        """Get THINBOX_TIMINGS
+
+        :rtype: bool
+        """
+        timings = self['THINBOX_TIMINGS']
+        return str(timings).lower() in ("1", "true", "yes", "on")
+
+    @property
+    def THINBOX_TIMINGS_TRACE(self):
+        """Get THINBOX_TIMINGS_TRACE
+
+        :rtype: str
+        """
+        return os.path.expanduser(self['THINBOX_TIMINGS_TRACE'])
+
+    @property
+    def THINBOX_TOOLS(self):
+        """Get THINBOX_TOOLS
+
+        Tools in config override TOOLS, a JSON string as set by
+        `thinbox env set` is accepted.
+
+        :rtype: dict
+        """
+        tools = dict(TOOLS)
+        custom = self['THINBOX_TOOLS']
+        if isinstance(custom, str):
+            try:
+                custom = json.loads(custom)
+            except ValueError:
+                logging.error("THINBOX_TOOLS is not a JSON object: {}".format(custom))
+                sys.exit(1)
+        tools.update({k: os.path.expanduser(v) for k, v in custom.items()})
+        return tools
+
+    @property
+    def THINBOX_SSH_DIR(self):
+        """Get THINBOX_SSH_DIR
+
+        :rtype: str
+        """
+        return os.path.expanduser(self['THINBOX_SSH_DIR'])
+
+    @THINBOX_SSH_DIR.setter
+    def THINBOX_SSH_DIR(self, val):
+        """Set THINBOX_SSH_DIR
+
+        :type val: str
+        """
+        self['THINBOX_SSH_DIR'] = val
 
     def get(self, key):
         """
@@ -383,17 +699,36 @@ class Env(dict):
         self.THINBOX_BASE_DIR = os.path.join(self.THINBOX_CACHE_DIR, 'base')
         self.THINBOX_IMAGE_DIR = os.path.join(self.THINBOX_CACHE_DIR, 'images')
         self.THINBOX_HASH_DIR = os.path.join(self.THINBOX_CACHE_DIR, 'hash')
+        self.THINBOX_SSH_DIR = os.path.join(self.THINBOX_CACHE_DIR, 'ssh')
+
+        self['THINBOX_MEMORY'] = THINBOX_MEMORY
+        self['THINBOX_VCPUS'] = THINBOX_VCPUS
+        self['THINBOX_OVERCOMMIT'] = 1.0
+        self['THINBOX_MIRRORS'] = []
+        self['THINBOX_NORMALIZE'] = dict(NORMALIZE_DEFAULTS)
+        self['THINBOX_DISK_PROFILE'] = "default"
+        self['THINBOX_DISK_PROFILES'] = {}
+        self['THINBOX_CACHE_SIZE'] = "0"
+        self['THINBOX_SSH_PERSIST'] = 600
+        self['THINBOX_COPY_MODE'] = "auto"
+        self['THINBOX_COPY_TAR_FILES'] = 256
+        self['THINBOX_COPY_TAR_AVG_SIZE'] = "256K"
+        self['THINBOX_COPY_COMPRESSION'] = "zstd"
+        self['THINBOX_TIMINGS'] = False
+        self['THINBOX_TIMINGS_TRACE'] = ""
+        self['THINBOX_TOOLS'] = {}
 
     def _create_cache_dirs(self):
         self._create_dir(self.THINBOX_CACHE_DIR)
         self._create_dir(self.THINBOX_BASE_DIR)
         self._create_dir(self.THINBOX_IMAGE_DIR)
         self._create_dir(self.THINBOX_HASH_DIR)
+        self._create_dir(self.THINBOX_SSH_DIR, mode=0o700)
 
     def _create_config_dirs(self):
         self._create_dir(self.THINBOX_CONFIG_DIR)
 
-    def _create_dir(self, name):
+    def _create_dir(self, name, mode=0o777):
         if not os.path.exists(name):
-            os.makedirs(name)
+            os.makedirs(name, mode=mode)
             logging.debug("Created dir {}.".format(name))
@@ -0,0 +1,1705 @@
+import json
+import time
+import hashlib
+import shutil
+import fnmatch
+import tempfile
+import functools
+import contextlib
+
+from http.server import ThreadingHTTPServer
+
+from thinbox import bench
+from thinbox import cache
+from thinbox import domain
+from thinbox import events
+from thinbox import inventory
+from thinbox import qemu
+from thinbox import timing
+from thinbox import transfer
+from thinbox.utils import *
+from thinbox.utils import _image_name_wrong
+from thinbox.config import *
+
+ADMISSION_HINT = ("To wait until it fits run again with --wait, "
+                  "to change the limit run: thinbox env set THINBOX_OVERCOMMIT <ratio>")
+
+
+class CreateError(Exception):
+    """A domain could not be created, nothing of it is left behind
+
+    :param message: What failed
+    :type message: str
+
+    :param hint: What can be done about it, printed by create
+    :type hint: str, optional
+    """
+
+    def __init__(self, message, hint=None):
+        super().__init__(message)
+        self.hint = hint
+
+
+class Thinbox(object):
+    """
+    A class made to represent a Thinbox run
+
+    :param doms: Domains of libvirt
+    :type doms: thinbox.domain.Domain
+
+    :param uri: URI of the hypervisor, e.g. "test:///default",
+        defaults to the libvirt default
+    :type uri: str, optional
+    """
+
+    def __init__(self, readonly=True, uri=None):
+        super().__init__()
+        self._env = Env()
+        self._readonly = readonly
+        self._uri = uri
+        self._connection = None
+        # creates of bench boot run in threads
+        self._create_lock = threading.RLock()
+        self._doms = self._get_all_domains(readonly)
+        self._apply_env()
+        self._create_cache_dirs()
+        self._base_images = self._get_base_images()
+        self._image_cache = None
+        self._backing_index = None
+        self._address_cache = None
+
+    def _apply_env(self):
+        """Pass the environment to the ssh pool and the qemu module
+
+        They keep their own copy, the other settings are read from env when
+        used. thinboxd applies the environment of every request.
+        """
+        ssh_pool.idle = self.env.THINBOX_SSH_PERSIST
+        qemu.use_tools(self.env.THINBOX_TOOLS)
+
+    def _create_cache_dirs(self):
+        self._create_dir("Base cache", self.env.THINBOX_BASE_DIR)
+        self._create_dir("Image cache", self.env.THINBOX_IMAGE_DIR)
+        self._create_dir("Hash cache", self.env.THINBOX_HASH_DIR)
+
+    def _create_dir(self, dirname, dirpath):
+        if os.path.exists(dirpath) and not os.path.isdir(dirpath):
+            logging.error(
+                "{} dir {} exists and it's not a directory.".format(dirname, dirpath))
+            sys.exit(1)
+        elif not os.path.exists(dirpath):
+            os.mkdir(dirpath)
+            logging.debug(
+                "{} dir not existing. Created on {}.".format(dirname, dirpath))
+
+    @property
+    def env(self):
+        return self._env
+
+    @property
+    def doms(self):
+        return self._doms
+
+    @property
+    def tools(self):
+        return self.env.THINBOX_TOOLS
+
+    @property
+    def base_images(self):
+        return self._base_images
+
+    @property
+    def backing_index(self):
+        with self._create_lock:
+            if self._backing_index is None:
+                self._backing_index = cache.BackingIndex(self.env)
+        return self._backing_index
+
+    @property
+    def address_cache(self):
+        if self._address_cache is None:
+            self._address_cache = cache.AddressCache(self.env)
+        return self._address_cache
+
+    @property
+    def image_cache(self):
+        with self._create_lock:
+            if self._image_cache is None:
+                self._image_cache = cache.ImageCache(self.env, self.backing_index)
+        return self._image_cache
+
+    def stop(self, name, opt=None):
+        """Stop running domain
+
+        :param name: Name of domain to stop
+        :type name: str
+
+        :param opt: Options to pass to virsh command. Options are None, "--mode=acpi"
+        :type opt: str, optional
+        """
+        dom = self._get_dom_from_name(name)
+        if dom.active == 0:
+            print("Domain '{}' already stopped.".format(dom.name))
+            return
+        # TODO mode acpi
+        # if opt == "--mode=acpi":
+        #    dom.shutdown()
+        dom.shutdown()
+        print("Domain '{}' is being shutdown.".format(dom.name))
+
+    def start(self, name, wait=False):
+        """Start a domain
+
+        It is refused when its memory does not fit in the host, see
+        THINBOX_OVERCOMMIT.
+
+        :param name: Name of domain to start
+        :type name: str
+
+        :param wait: Wait until the domain fits in host memory instead of
+            refusing it, defaults to False
+        :type wait: bool, optional
+        """
+        dom = self._get_dom_from_name(name)
+
+        if dom.active == 1:
+            print("Domain '{}' is already running.".format(dom.name))
+            print("To SSH in it run: thinbox enter {}".format(dom.name))
+            return
+        with self._admission(dom.name, dom.memory, wait):
+            dom.start()
+        print("Domain '{}' started.".format(dom.name))
+        print("To SSH into it run: thinbox enter {}".format(dom.name))
+
+    def remove(self, name):
+        """Remove a domain of given name
+
+        :param name: Name of domain to remove
+        :type name: str
+        """
+        self._remove(self._get_dom_from_name(name))
+        # list again, for later lookups and the completion inventory
+        self._doms = self._get_all_domains(self._readonly)
+
+    def remove_all(self):
+        """Remove all domains
+        """
+        for d in self.doms:
+            self._remove(d)
+        self._doms = self._get_all_domains(self._readonly)
+
+    def _remove(self, dom):
+        name = dom.name
+        if dom.active == 1:
+            if dom.destroy() == 0:
+                logging.debug("Domain {} destroyed".format(dom.name))
+        if dom.undefine() == 0:
+            logging.debug("Domain {} undefined".format(dom.name))
+
+        print("Domain '{}' removed.".format(dom.name))
+        # check if file exists
+        filepath = os.path.join(self.env.THINBOX_IMAGE_DIR, name + ".qcow2")
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        else:
+            logging.warning("File does not exist: {}".format(filepath))
+        self.backing_index.remove_overlay(name + ".qcow2")
+        self.address_cache.forget(dom.uuid)
+
+    def run(self, names, command, jobs=8):
+        """Run a command in one or more running domains
+
+        With more than one domain the command runs concurrently, output
+        lines are prefixed with the domain name and a summary of exit codes
+        and durations is printed at the end.
+
+        :param names: Domain names or glob patterns, e.g. "web-*", comma
+            separated values are split
+        :type names: list
+
+        :param command: Command and arguments
+        :type command: list
+
+        :param jobs: Maximum number of concurrent ssh sessions, defaults to 8
+        :type jobs: int, optional
+
+        :return: Exit code, the highest one with several domains
+        :rtype: int
+        """
+        doms = self._get_doms_from_patterns(names)
+        cmd = " ".join(command)
+        if len(doms) == 1:
+            return self._run_on(doms[0], cmd)
+
+        width = max(len(d.name) for d in doms)
+        results = {}
+
+        def task(dom):
+            start = monotonic()
+            code = self._run_on(dom, cmd, "{:<{}} | ".format(dom.name, width))
+            results[dom.name] = (code, monotonic() - start)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(task, d) for d in doms]:
+                future.result()
+
+        print()
+        print_format = "{:<20} {:<6} {:>10}"
+        print(print_format.format("DOMAIN", "EXIT", "DURATION"))
+        for dom in doms:
+            code, elapsed = results[dom.name]
+            print(print_format.format(
+                dom.name, code, "{:.2f}s".format(elapsed)))
+        return max(code for code, _ in results.values())
+
+    def _run_on(self, dom, cmd, prefix=""):
+        """Run a command in a domain over ssh
+
+        :return: Exit code, 255 if the domain can not be reached or the
+            connection drops, like ssh
+        :rtype: int
+        """
+        self._resolve_address(dom)
+        if dom.ip == "":
+            logging.error("Domain '{}' has no IP, is it running?".format(dom.name))
+            return 255
+        try:
+            with ssh_pool.lease(dom.ip) as ssh:
+                return run_ssh_command(ssh, cmd, prefix)
+        except (paramiko.SSHException, socket.error) as e:
+            # one host failing does not stop the others of a fan-out
+            logging.error("{}{}".format(
+                prefix or "Domain '{}': ".format(dom.name), e))
+            return 255
+
+    def pull_url(self, url, skip=True):
+        """Download a qcow2 image file from url
+
+        :param url: Url of image to download
+        :typr url: str
+
+        :param skip: Skip hash check
+        :type skip: bool, optional
+        """
+        self.pull_urls([url], skip=skip)
+
+    def pull_urls(self, urls, skip=True, jobs=4, rate=0, normalize=None):
+        """Download qcow2 image files from urls concurrently
+
+        :param urls: Urls of images to download
+        :type urls: list
+
+        :param skip: Skip hash check
+        :type skip: bool, optional
+
+        :param jobs: Maximum number of concurrent downloads, defaults to 4
+        :type jobs: int, optional
+
+        :param rate: Global budget in bytes per second, 0 means unlimited
+        :type rate: int, optional
+
+        :param normalize: Convert to the THINBOX_NORMALIZE layout,
+            defaults to THINBOX_NORMALIZE["enabled"]
+        :type normalize: bool, optional
+        """
+        if normalize is None:
+            normalize = self.env.THINBOX_NORMALIZE["enabled"]
+        for url in urls:
+            print("Pulling {}".format(url))
+        existing = set(self.base_images)
+        limiter = BandwidthLimiter(rate)
+        progress = TransferProgress()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                (url, executor.submit(self._download_image, url, limiter, progress))
+                for url in urls]
+        # one failed download does not stop the others
+        filenames = []
+        failed = []
+        for url, future in futures:
+            try:
+                filenames.append(future.result())
+            except (requests.RequestException, OSError) as e:
+                logging.error("Could not pull {}: {}".format(url, e))
+                failed.append(url)
+        # hash checks print, so they run once the progress display is done
+        for filename in filenames:
+            self._verify_image(filename)
+            self.image_cache.touch(filename)
+            # only fresh images, an existing base may already back overlays
+            if normalize and filename not in existing:
+                self._normalize_image(filename)
+        if failed:
+            logging.error("{} of {} images not pulled.".format(len(failed), len(urls)))
+            sys.exit(1)
+
+    def pull_tag(self, tag, skip=True):
+        """Download a qcow2 image file from tag
+
+        :param tag: Tag of image to download (RHEL only)
+        :type tag: str
+
+        :param skip: Skip hash check
+        :type skip: bool, optional
+        """
+        self.pull_tags([tag], skip=skip)
+
+    def pull_tags(self, tags, skip=True, jobs=4, rate=0, normalize=None):
+        """Download qcow2 image files from tags concurrently
+
+        :param tags: Tags of images to download (RHEL only)
+        :type tags: list
+
+        :param skip: Skip hash check
+        :type skip: bool, optional
+
+        :param jobs: Maximum number of concurrent downloads, defaults to 4
+        :type jobs: int, optional
+
+        :param rate: Global budget in bytes per second, 0 means unlimited
+        :type rate: int, optional
+
+        :param normalize: Convert to the THINBOX_NORMALIZE layout,
+            defaults to THINBOX_NORMALIZE["enabled"]
+        :type normalize: bool, optional
+        """
+        if not self.env.RHEL_BASE_URL:
+            logging.warning(
+                "Variable RHEL_BASE_URL. If you know where to pull images please export this variable locally.")
+            sys.exit(1)
+        urls = [self._generate_url_from_tag(tag) for tag in tags]
+        self.pull_urls(urls, skip=skip, jobs=jobs, rate=rate,
+                       normalize=normalize)
+
+    def image_list(self):
+        """Print a list of base images on the system
+        """
+        print(self.env.THINBOX_BASE_DIR)
+        print()
+        print("{:<50} {:<6} {:<20}".format("IMAGE", "DEPS", "HASH"))
+        for name in self.base_images:
+            print("{:<50} {:<6} ".format(
+                name, len(self.backing_index.dependents(name))), end="")
+            none = True
+            hashes = []
+            for hashfunc in sorted(RHEL_BASE_HASH):
+                if os.path.exists(os.path.join(
+                        self.env.THINBOX_HASH_DIR, name + "." + hashfunc + ".OK")):
+                    hashes.append(hashfunc)
+                    none = False
+            if none:
+                print("NONE", end="")
+            else:
+                print(",".join(hashes), end="")
+
+            print()
+
+    def image_remove(self, name, cascade=False):
+        """Remove base image
+
+        Refuses to remove a base image that overlays depend on, unless
+        cascade is set, in which case their domains are removed first.
+
+        :param name: Name of base image to remove
+        :type name: str
+
+        :param cascade: Also remove dependent domains, defaults to False
+        :type cascade: bool, optional
+        """
+        # check if image exist
+        if name not in self.base_images:
+            logging.warning("Image '{}' not found".format(name))
+            return
+
+        dependents = self.backing_index.dependents(name)
+        if dependents and not cascade:
+            logging.error("Image '{}' is used by: {}.".format(
+                name, ", ".join(o[:-len(".qcow2")] for o in dependents)))
+            print("To remove it with its domains run: thinbox image rm --cascade {}".format(name))
+            sys.exit(1)
+        domain_names = [d.name for d in self.doms]
+        for overlay in dependents:
+            dom_name = overlay[:-len(".qcow2")]
+            if dom_name in domain_names:
+                self.remove(dom_name)
+            else:
+                os.remove(os.path.join(self.env.THINBOX_IMAGE_DIR, overlay))
+                self.backing_index.remove_overlay(overlay)
+
+        filepath = os.path.join(self.env.THINBOX_BASE_DIR, name)
+        os.remove(filepath)
+        self.image_cache.forget(name)
+        self.backing_index.remove_base(name)
+        print("Image '{}' removed.".format(name))
+
+    def image_remove_all(self, cascade=False):
+        """Remove all base images
+
+        :param cascade: Also remove dependent domains, defaults to False
+        :type cascade: bool, optional
+        """
+        for name in self.base_images:
+            self.image_remove(name, cascade=cascade)
+
+    def image_reindex(self):
+        """Rebuild the backing index from the overlays qcow2 headers
+        """
+        self.backing_index.rebuild()
+        for name in self.base_images:
+            print("{:<50} {}".format(
+                name, len(self.backing_index.dependents(name))))
+
+    def image_gc(self, dry_run=False):
+        """Collect orphan overlays and evict unused base images
+
+        Overlays in THINBOX_IMAGE_DIR with no matching domain are removed,
+        then base images no overlay depends on are evicted, least recently
+        used first, until the cache fits in THINBOX_CACHE_SIZE.
+
+        :param dry_run: Only print what would be removed
+        :type dry_run: bool, optional
+        """
+        self.image_cache.gc([d.name for d in self.doms], dry_run=dry_run)
+
+    def image_serve(self, bind="", port=8000):
+        """Serve THINBOX_BASE_DIR read-only over HTTP
+
+        Peers can add the served url to their THINBOX_MIRRORS. Normalized
+        images are not served, their digest is not the upstream one peers
+        check.
+
+        :param bind: Address to bind, defaults to all interfaces
+        :type bind: str, optional
+
+        :param port: Port to listen on, defaults to 8000
+        :type port: int, optional
+        """
+        handler = functools.partial(
+            ReadOnlyRequestHandler, directory=self.env.THINBOX_BASE_DIR,
+            hidden=lambda name: os.path.exists(os.path.join(
+                self.env.THINBOX_HASH_DIR, name + ".NORMALIZED.SHA256SUM")))
+        with ThreadingHTTPServer((bind, port), handler) as httpd:
+            print("Serving {} on http://{}:{}/".format(
+                self.env.THINBOX_BASE_DIR, bind or "0.0.0.0", port))
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                print()
+
+    def _get_host_path_split_last_column(self, file):
+        """
+        split at last ':'
+        host:/path
+        Returns file, path
+        """
+        host = file.split(":/")[0]
+        if file.count(":") == 0:
+            host = file
+
+        if file.count(":") > 1:
+            logging.warning(
+                "More than one ':' in '{}', split may be wrong".format(file))
+
+        if host not in [d.name for d in self.doms]:
+            logging.error("Domain '{}' not found.".format(host))
+            sys.exit(1)
+
+        if file.count(":") == 0:
+            return host, "/root"
+
+        path = file.removeprefix(host).removeprefix(":")
+        return host, path
+
+    def copy(self, files, name, jobs=4, sync=False, delete=False, mode=None):
+        """Copy file or files into a running domain
+
+        thinbox file test
+        thinbox file test:/path
+        thinbox file1 /path/file2 test:/path
+        thinbox test:/path/file .
+        thinbox test:/path/file test/path/file2 /path
+
+        Directories are copied recursively and up to `jobs` files are
+        transferred at once over SFTP. When pulling from more than one
+        domain, every domain is copied in parallel into its own
+        subdirectory of the destination.
+
+        Domains that are shut off are not booted: files are copied in and
+        out of their disk with libguestfs.
+
+        With sync, files are copied into the domain rsync-style: unchanged
+        files are skipped and only changed blocks of the others are sent.
+
+        Files copied into a domain can also be streamed as one compressed
+        tar, see THINBOX_COPY_MODE. In "auto" mode, many small files are
+        streamed and the others go over SFTP.
+
+        :parameter files: List of files to copy in the domain
+        :type files: list
+
+        :parameter name: Name of domain to copy file/files in
+        :type name: str
+
+        :parameter jobs: Files transferred at once per domain, defaults to 4
+        :type jobs: int, optional
+
+        :parameter sync: Send only changed files and blocks, defaults to False
+        :type sync: bool, optional
+
+        :parameter delete: With sync, remove files in the domain that do not
+            exist locally, defaults to False
+        :type delete: bool, optional
+
+        :parameter mode: "sftp", "tar" or "auto", defaults to
+            THINBOX_COPY_MODE
+        :type mode: str, optional
+
+        :return: 0 if every file was copied, 1 otherwise
+        :rtype: int
+        """
+        # TODO
+        # is domain running?
+        # do you want to start it?
+
+        # identify if it's put or pull
+        if name in [d.name for d in self.doms] or name.split(
+                ":/")[0] in [d.name for d in self.doms]:
+            # PUT
+            host, path = self._get_host_path_split_last_column(name)
+
+            dom = self._get_dom_from_name(host)
+            self._resolve_address(dom)
+
+            if dom.active == 0:
+                if sync:
+                    logging.error("Sync needs domain '{}' running.".format(host))
+                    return 1
+                return self._copy_offline(host, files, path)
+
+            with ssh_pool.lease(dom.ip) as ssh, \
+                    transfer.TransferEngine(ssh.get_transport(), jobs) as engine:
+                if sync:
+                    failed = engine.sync(files, path, delete=delete)
+                elif self._copy_mode(engine, files, path, mode) == "tar":
+                    failed = engine.put_tar(
+                        files, path, self.env.THINBOX_COPY_COMPRESSION)
+                else:
+                    failed = engine.put(files, path)
+        elif sync:
+            logging.error("Sync only copies files into a domain.")
+            return 1
+        else:
+            paths = {}
+            for file in files:
+                host, path = self._get_host_path_split_last_column(file)
+                paths.setdefault(host, []).append(path)
+            doms = {host: self._get_dom_from_name(host) for host in paths}
+
+            def pull(host):
+                dest = name if len(paths) == 1 else os.path.join(name, host)
+                if doms[host].active == 0:
+                    os.makedirs(dest, exist_ok=True)
+                    if self._copy_offline(host, paths[host], dest, pull=True):
+                        return len(paths[host])
+                    return 0
+                self._resolve_address(doms[host])
+                with ssh_pool.lease(doms[host].ip) as ssh, \
+                        transfer.TransferEngine(ssh.get_transport(), jobs) as engine:
+                    return engine.get(paths[host], dest)
+
+            with ThreadPoolExecutor(
+                    max_workers=len(paths)) as executor:
+                failed = sum(executor.map(pull, paths))
+
+        if failed:
+            logging.error("{} file(s) could not be copied.".format(failed))
+            return 1
+        return 0
+
+    def _copy_offline(self, name, sources, dest, pull=False):
+        """Copy files in or out of the disk of a shut off domain with
+        libguestfs, without booting it
+
+        Everything is done in a single guestfish appliance launch, read
+        only when pulling.
+
+        :param name: Name of the domain
+        :type name: str
+
+        :param sources: Local paths, or paths in the domain when pulling
+        :type sources: list
+
+        :param dest: Directory in the domain, or local when pulling
+        :type dest: str
+
+        :param pull: Copy out of the domain, defaults to False
+        :type pull: bool, optional
+
+        :return: 0 if copied, 1 otherwise
+        :rtype: int
+        """
+        if pull:
+            # read only, the disk is not written to and may be shared
+            cmd = ['--ro', '-d', name, '-i', 'copy-out'] + list(sources) + [dest]
+        else:
+            cmd = ['-d', name, '-i', 'mkdir-p', dest, ':', 'copy-in'] + list(sources) + [dest]
+        p_guestfish = subprocess.Popen(
+            [self.tools['guestfish']] + cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        logging_subprocess(p_guestfish, "guestfish: {}")
+        if p_guestfish.wait() != 0:
+            return 1
+        for source in sources:
+            print("Copied '{}' into '{}' offline.".format(source, dest))
+        return 0
+
+    def _copy_mode(self, engine, files, path, mode=None):
+        mode = mode or self.env.THINBOX_COPY_MODE
+        if mode != "auto":
+            return mode
+        _, tasks = engine.plan_put(files, path)
+        mode = transfer.choose_mode(
+            [os.path.getsize(local) for local, _ in tasks],
+            self.env.THINBOX_COPY_TAR_FILES,
+            parse_size(self.env.THINBOX_COPY_TAR_AVG_SIZE))
+        logging.debug("Copying {} files with {}.".format(len(tasks), mode))
+        return mode
+
+    def list(self, fil="", fmt="table", fields=None):
+        """List domains
+
+        Only the requested fields are resolved. States of all domains come
+        from a single libvirt call, addresses are looked up concurrently
+        and for running domains only, and rows are printed as soon as they
+        are ready.
+
+        :parameter fil: Filter domains by state.
+            Options are "", "running", "stopped", "paused", "other"
+        :type fil: str, optional
+
+        :parameter fmt: Output format, one of LIST_FORMATS, defaults to
+            "table"
+        :type fmt: str, optional
+
+        :parameter fields: Fields of LIST_FIELDS to print, defaults to
+            LIST_DEFAULT_FIELDS
+        :type fields: list, optional
+        """
+        fields = fields or LIST_DEFAULT_FIELDS
+        domains, states = self._list_domains(fil, fields)
+
+        if len(domains) == 0 and fmt == "table":
+            print("To create a domain run: thinbox create -i <image> <name>")
+            return
+
+        self._print_list_header(fmt, fields)
+        if fmt == "json":
+            print("[", end="")
+        for i, row in enumerate(self._list_rows(domains, fields, states)):
+            if fmt == "json":
+                print(",\n" if i else "\n", json.dumps(row), sep="", end="",
+                      flush=True)
+            else:
+                print(self._format_list_row(fmt, fields, row), flush=True)
+        if fmt == "json":
+            print("\n]")
+
+    def watch(self, fil="", fmt="table", fields=None, interval=2):
+        """List domains, then print them again as they change
+
+        Changes come from libvirt lifecycle events, only addresses are
+        polled every interval seconds. On a terminal, the table is kept on
+        screen and only the changed rows are redrawn. Otherwise rows are
+        printed as they change, after an event column: "listed" for the
+        first list, then the event, e.g. "started" or "undefined" for a
+        removed domain. thinbox.events.start_event_loop has to be called
+        before this Thinbox is created.
+
+        :parameter fil: Filter domains by state, as in list
+        :type fil: str, optional
+
+        :parameter fmt: Output format, "table", "ndjson" or "tsv"
+        :type fmt: str, optional
+
+        :parameter fields: Fields of LIST_FIELDS to print, defaults to
+            LIST_DEFAULT_FIELDS
+        :type fields: list, optional
+
+        :parameter interval: Seconds between polls of missing addresses
+        :type interval: float, optional
+        """
+        def stream_line(event, row):
+            if fmt == "ndjson":
+                return json.dumps(dict({"event": event}, **row))
+            line = self._format_list_row(fmt, fields, row)
+            if fmt == "tsv":
+                return event + "\t" + line
+            return "{:<11} {}".format(event, line)
+
+        fields = fields or LIST_DEFAULT_FIELDS
+        domains, states = self._list_domains(fil, fields)
+        rows = dict(zip([d.uuid for d in domains],
+                        self._list_rows(domains, fields, states)))
+        redraw = fmt == "table" and sys.stdout.isatty()
+
+        # rows on screen, by uuid, in order
+        if redraw:
+            self._print_list_header(fmt, fields)
+            shown = {u: self._format_list_row(fmt, fields, r)
+                     for u, r in rows.items()}
+        else:
+            if fmt == "table":
+                print("{:<11} {}".format("EVENT", self._format_list_row(fmt, fields, {
+                    f: "DOMAIN" if f == "name" else f.upper() for f in fields})))
+            shown = {u: stream_line("listed", r) for u, r in rows.items()}
+        for line in shown.values():
+            print(line, flush=True)
+
+        if not states:
+            states = self._connection.states()
+        watcher = events.Watcher(self._connection, self.doms, states, interval)
+        try:
+            for event, d in watcher.changes():
+                visible = (event != "undefined"
+                           and self._list_match(d, fil, watcher.states))
+                row = self._list_row(d, fields, watcher.states)
+                if not redraw:
+                    # also rows leaving the list, with the event telling why
+                    if visible or d.uuid in shown:
+                        print(stream_line(event, row), flush=True)
+                    shown.pop(d.uuid, None)
+                    if visible:
+                        shown[d.uuid] = row
+                    continue
+                line = self._format_list_row(fmt, fields, row)
+                uuids = [u for u in shown]
+                if d.uuid in shown and visible:
+                    if shown[d.uuid] == line:
+                        continue
+                    # up to the row, rewrite it, back down
+                    up = len(uuids) - uuids.index(d.uuid)
+                    shown[d.uuid] = line
+                    print("\x1b[{}A\r\x1b[2K{}\x1b[{}B\r".format(
+                        up, line, up), end="", flush=True)
+                elif d.uuid in shown:
+                    # up to the row, clear to the end, draw the rows below
+                    i = uuids.index(d.uuid)
+                    print("\x1b[{}A\r\x1b[J".format(len(uuids) - i), end="")
+                    del shown[d.uuid]
+                    for u in uuids[i + 1:]:
+                        print(shown[u])
+                    sys.stdout.flush()
+                elif visible:
+                    shown[d.uuid] = line
+                    print(line, flush=True)
+        except KeyboardInterrupt:
+            print()
+
+    def events(self, interval=2):
+        """Print changes of domains as JSON lines, until interrupted
+
+        Every line has the time, the event, e.g. "started", "stopped" or
+        "address" when a running domain got its address, and the name,
+        uuid, state, ip and mac of the domain. thinbox.events.start_event_loop
+        has to be called before this Thinbox is created.
+
+        :parameter interval: Seconds between polls of missing addresses
+        :type interval: float, optional
+        """
+        watcher = events.Watcher(self._connection, self.doms,
+                                 self._connection.states(), interval)
+        fields = ["name", "uuid", "state", "ip", "mac"]
+        try:
+            for event, d in watcher.changes():
+                row = {"time": time.time(), "event": event}
+                row.update(self._list_row(d, fields, watcher.states))
+                print(json.dumps(row), flush=True)
+        except KeyboardInterrupt:
+            pass
+
+    def _list_domains(self, fil, fields):
+        """Return the domains to list and, if needed, the states of all
+        domains by UUID, fetched with a single call
+        """
+        states = {}
+        if fil or set(fields) & {"state", "reason", "ip", "mac"}:
+            states = self._connection.states()
+        return [d for d in self.doms if self._list_match(d, fil, states)], states
+
+    def _list_match(self, d, fil, states):
+        """Return True if domain d passes the state filter fil of list
+        """
+        if fil == "":
+            return True
+        state = states.get(d.uuid, ("", ""))[0]
+        if fil == "stopped":
+            return state == "shutoff"
+        if fil == "other":
+            return state not in ("running", "paused", "shutoff")
+        return state == fil
+
+    def _list_row(self, d, fields, states):
+        """Return the fields of domain d, its state taken from states
+
+        Only running domains are asked for their address.
+        """
+        state, reason = states.get(d.uuid, ("", ""))
+        ip = mac = ""
+        if (set(fields) & {"ip", "mac"}
+                and state in ("running", "blocked", "paused")):
+            ip, mac = d.address()
+        known = {"state": state, "reason": reason, "ip": ip, "mac": mac}
+        return {f: known[f] if f in known else getattr(d, f) for f in fields}
+
+    def _list_rows(self, domains, fields, states):
+        """Yield the rows of domains in order, as soon as they are ready
+
+        Addresses are looked up concurrently.
+        """
+        if not set(fields) & {"ip", "mac"}:
+            for d in domains:
+                yield self._list_row(d, fields, states)
+            return
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            yield from executor.map(
+                lambda d: self._list_row(d, fields, states), domains)
+
+    def _print_list_header(self, fmt, fields):
+        if fmt == "table":
+            print(self._format_list_row(fmt, fields, {
+                f: "DOMAIN" if f == "name" else f.upper() for f in fields}))
+
+    def _format_list_row(self, fmt, fields, row):
+        """Return row as a line of fmt, "table", "tsv" or "ndjson"
+        """
+        if fmt == "table":
+            return " ".join("{:<" + str(LIST_FIELDS[f]) + "}" for f in fields).format(
+                *[row[f] for f in fields])
+        if fmt == "tsv":
+            return "\t".join(str(row[f]) for f in fields)
+        return json.dumps(row)
+
+    def image_rm(self):
+        pass
+
+    def enter(self, name, wait=False):
+        """Enter domain via ssh
+
+        If domain is stopped, start it, it is admitted in host memory as
+        by start
+
+        :parameter dom: Domain to ssh into
+        :type dom: str
+
+        :param wait: Wait until a stopped domain fits in host memory instead
+            of refusing it, defaults to False
+        :type wait: bool, optional
+        """
+        dom = self._get_dom_from_name(name)
+        # if domain is not up, start it
+        if dom.active == 0:
+            with timing.span("boot.start"), \
+                    self._admission(dom.name, dom.memory, wait):
+                dom.start()
+
+        self._wait_for_boot(dom)
+        print("Connecting to domain '{}' as root@{}".format(dom.name, dom.ip))
+        ssh_connect(dom, ssh_mux_options(
+            self.env.THINBOX_SSH_DIR, self.env.THINBOX_SSH_PERSIST))
+
+    def create(self, base_name, name, disk_profile=None, shares=None,
+               injects=None, memory=None, vcpus=None, wait=False):
+        """Create a domain from a base image
+
+        It is refused when its memory does not fit in the host, see
+        THINBOX_OVERCOMMIT, before the disk is built and again before the
+        domain starts.
+
+        :param base_name: Name of the base image
+        :type base_name: str
+
+        :param name: Name of the domain
+        :type name: str
+
+        :param disk_profile: Name of the overlay profile,
+            defaults to THINBOX_DISK_PROFILE
+        :type disk_profile: str, optional
+
+        :param shares: Host directories shared with virtiofs, as host
+            directory and tag pairs, mounted in the guest on /mnt/TAG
+        :type shares: list, optional
+
+        :param injects: Local files and directories copied into the disk
+            by the virt-sysprep run, as local path and guest directory pairs
+        :type injects: list, optional
+
+        :param memory: Memory of the domain in MiB, defaults to
+            THINBOX_MEMORY
+        :type memory: int, optional
+
+        :param vcpus: Virtual CPUs of the domain, defaults to THINBOX_VCPUS
+        :type vcpus: int, optional
+
+        :param wait: Wait until the domain fits in host memory instead of
+            refusing it, defaults to False
+        :type wait: bool, optional
+        """
+        try:
+            self._create(base_name, name, disk_profile, shares, injects,
+                         memory, vcpus, wait)
+        except CreateError as e:
+            logging.error(str(e))
+            if e.hint:
+                print(e.hint)
+            sys.exit(1)
+
+    def _create(self, base_name, name, disk_profile=None, shares=None,
+                injects=None, memory=None, vcpus=None, wait=False):
+        """Create a domain from a base image, see create
+
+        Safe to call from several threads at once.
+
+        :raises CreateError: If the domain could not be created
+        """
+        install_opts, sysprep_opts = share_options(shares)
+        profile = self._get_disk_profile(disk_profile)
+        memory = memory or self.env.THINBOX_MEMORY
+        vcpus = vcpus or self.env.THINBOX_VCPUS
+
+        if not os.path.exists(self.env.THINBOX_IMAGE_DIR):
+            os.makedirs(self.env.THINBOX_IMAGE_DIR)
+        image = os.path.join(self.env.THINBOX_IMAGE_DIR, name + ".qcow2")
+        base = os.path.join(self.env.THINBOX_BASE_DIR, base_name)
+        if not os.path.exists(base):
+            hint = "To list the available images run: thinbox image"
+            if not _image_name_wrong(base):
+                hint = "Maybe the filename is incorrect?\n" + hint
+            raise CreateError("Image {} not found in {}.".format(
+                base, self.env.THINBOX_BASE_DIR), hint)
+
+        if name in [d.name for d in self.doms]:
+            raise CreateError("Domain with name '{}' exists.".format(name))
+
+        def refuse(name, reason):
+            raise CreateError("Domain '{}' does not fit in host memory: {}.".format(
+                name, reason), ADMISSION_HINT)
+
+        # refuse before building the disk what would not fit anyway
+        with self._admission(name, memory, wait, refuse):
+            pass
+
+        print("Creating qemu image from '{}'".format(base_name))
+        with timing.span("create.qemu-img"):
+            p_qemu = subprocess.Popen([
+                self.tools['qemu-img'], 'create',
+                '-f', 'qcow2', '-o',
+                qemu.overlay_options(base, **profile), image],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            logging_subprocess(p_qemu, "qemu: {}")
+        if p_qemu.wait() != 0:
+            self._create_failed(name, "qemu-img")
+        self.backing_index.add(base_name, name + ".qcow2")
+
+        with timing.span("create.virt-sysprep"):
+            p_virt_sysprep = subprocess.Popen([
+                self.tools['virt-sysprep'], '-a', image,
+                '--hostname', name, '--ssh-inject', 'root',
+                '--selinux-relabel'] + sysprep_opts + inject_options(injects),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            logging_subprocess(p_virt_sysprep, "virt-sysprep: {}")
+        if p_virt_sysprep.wait() != 0:
+            self._create_failed(name, "virt-sysprep")
+
+        self.image_cache.touch(base_name)
+
+        osv = os_variant(base_name)
+        print("Detected OS '{}'".format(osv))
+        def refuse_built(name, reason):
+            logging.error("Domain '{}' does not fit in host memory: {}.".format(
+                name, reason))
+            self._create_failed(name, "admission")
+
+        # other domains may have started while the disk was built
+        with self._admission(name, memory, wait, refuse_built):
+            with timing.span("create.virt-install"):
+                p_virt_install = subprocess.Popen([
+                    self.tools['virt-install'], '--network=bridge:virbr0',
+                    '--name', name, '--memory', str(memory),
+                    '--vcpus', str(vcpus),
+                    '--disk', image,
+                    '--import',
+                    '--os-type=linux',
+                    '--os-variant=' + osv,
+                    '--noautoconsole'] + install_opts,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                logging_subprocess(p_virt_install, "virt-install: {}")
+            if p_virt_install.wait() != 0:
+                self._create_failed(name, "virt-install")
+        print("Domain '{}' created".format(name))
+        # list again, for later lookups and the completion inventory
+        with self._create_lock:
+            self._doms = self._get_all_domains(self._readonly)
+
+    def _create_failed(self, name, tool):
+        """Remove the overlay of a domain that could not be created
+
+        :param name: Name of the domain
+        :type name: str
+
+        :param tool: Tool that failed
+        :type tool: str
+
+        :raises CreateError: Always, once the overlay is removed
+        """
+        image = os.path.join(self.env.THINBOX_IMAGE_DIR, name + ".qcow2")
+        if os.path.exists(image):
+            os.remove(image)
+        self.backing_index.remove_overlay(name + ".qcow2")
+        raise CreateError("{} failed, domain '{}' not created.".format(tool, name))
+
+    @contextlib.contextmanager
+    def _admission(self, name, memory, wait=False, refuse=None):
+        """Admit a domain in host memory while the enclosed code starts it
+
+        Memory is checked, see memory_shortfall, under a lock of all
+        thinbox processes held until the domain runs, so concurrent starts
+        do not all count on the same memory. A domain waiting to fit
+        releases the lock between checks.
+
+        :param name: Name of the domain
+        :type name: str
+
+        :param memory: Memory of the domain in MiB
+        :type memory: int
+
+        :param wait: Check again every ADMISSION_INTERVAL seconds until it
+            fits, instead of refusing it, defaults to False
+        :type wait: bool, optional
+
+        :param refuse: Called with the name and the reason when the domain
+            does not fit, has to exit or raise, defaults to _refuse
+        :type refuse: callable, optional
+        """
+        ratio = self.env.THINBOX_OVERCOMMIT
+        if ratio <= 0:
+            yield
+            return
+        lock = os.path.join(self.env.THINBOX_CACHE_DIR, "admission")
+        waiting = False
+        while True:
+            with cache.locked(lock):
+                host = self._connection.host_memory()
+                if host is None:
+                    logging.warning("Host memory unknown, domain '{}' not checked.".format(name))
+                    reason = None
+                else:
+                    reason = memory_shortfall(memory, host, ratio)
+                if reason is None:
+                    if host is not None and memory > host["free"]:
+                        logging.warning(
+                            "Domain '{}' needs {} MiB, {} MiB are free on the host, "
+                            "the rest has to be reclaimed from caches.".format(
+                                name, memory, host["free"]))
+                    yield
+                    return
+            if not wait:
+                (refuse or self._refuse)(name, reason)
+            if not waiting:
+                print("Domain '{}' waits for host memory: {}".format(name, reason))
+                waiting = True
+            time.sleep(ADMISSION_INTERVAL)
+
+    def _refuse(self, name, reason):
+        """Exit as a domain does not fit in host memory"""
+        logging.error("Domain '{}' does not fit in host memory: {}.".format(
+            name, reason))
+        print(ADMISSION_HINT)
+        sys.exit(1)
+
+    def share(self, name, shares):
+        """Share host directories with an existing domain using virtiofs
+
+        The domain definition gets shared memory backing and a virtiofs
+        filesystem per share, effective from the next boot. The fstab of
+        the guest is edited with virt-customize when the domain is shut
+        off, over ssh when it is running. Sharing a tag again does not add
+        its fstab entry twice.
+
+        :param name: Name of the domain
+        :type name: str
+
+        :param shares: Host directory and tag pairs, see parse_share
+        :type shares: list
+        """
+        dom = self._get_dom_from_name(name)
+        install_opts, _ = share_options(shares)
+        p_virt_xml = subprocess.Popen([
+            self.tools['virt-xml'], name, '--edit'] + install_opts[:2],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        logging_subprocess(p_virt_xml, "virt-xml: {}")
+        if p_virt_xml.wait() != 0:
+            sys.exit(1)
+        for host_dir, tag in shares:
+            p_virt_xml = subprocess.Popen([
+                self.tools['virt-xml'], name, '--add-device',
+                '--filesystem', filesystem_option(host_dir, tag)],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            logging_subprocess(p_virt_xml, "virt-xml: {}")
+            if p_virt_xml.wait() != 0:
+                sys.exit(1)
+
+        if dom.active == 1:
+            with ssh_pool.lease(dom.ip) as ssh:
+                for _, tag in shares:
+                    if run_ssh_command(ssh, fstab_command(tag)) != 0:
+                        sys.exit(1)
+        else:
+            customize_opts = []
+            for _, tag in shares:
+                customize_opts += ['--run-command', fstab_command(tag)]
+            p_virt_customize = subprocess.Popen([
+                self.tools['virt-customize'], '-d', name] + customize_opts,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            logging_subprocess(p_virt_customize, "virt-customize: {}")
+            if p_virt_customize.wait() != 0:
+                logging.error("Could not edit the fstab of domain '{}'.".format(name))
+                sys.exit(1)
+
+        for host_dir, tag in shares:
+            print("Shared '{}' with domain '{}' on /mnt/{}".format(host_dir, name, tag))
+        if dom.active == 1:
+            print("Restart the domain to mount: thinbox stop {} && thinbox start {}".format(
+                name, name))
+
+    def bench_disk(self, base_name, profiles=None, size=256 * 1024 * 1024,
+                   ops=2000):
+        """Benchmark overlay disk profiles on a base image
+
+        Overlays are created in a temporary dir of THINBOX_IMAGE_DIR, so
+        they are measured on the filesystem VMs actually use.
+
+        :param base_name: Name of the base image
+        :type base_name: str
+
+        :param profiles: Names of profiles to compare, defaults to all
+        :type profiles: list, optional
+
+        :param size: Bytes of sequential I/O, defaults to 256MiB
+        :type size: int, optional
+
+        :param ops: Number of random requests, defaults to 2000
+        :type ops: int, optional
+        """
+        base = os.path.join(self.env.THINBOX_BASE_DIR, base_name)
+        if base_name not in self.base_images:
+            logging.error("Image {} not found in {}.".format(
+                base, self.env.THINBOX_BASE_DIR))
+            print("To list the available images run: thinbox image")
+            sys.exit(1)
+        if not profiles:
+            profiles = sorted(self.env.THINBOX_DISK_PROFILES)
+        selected = {p: self._get_disk_profile(p) for p in profiles}
+
+        workdir = tempfile.mkdtemp(
+            prefix=".bench-", dir=self.env.THINBOX_IMAGE_DIR)
+        try:
+            results = bench.bench_disk(
+                base, workdir, selected, size=size, ops=ops)
+        finally:
+            shutil.rmtree(workdir)
+        print()
+        bench.print_disk_results(results)
+
+    def bench_boot(self, base_name, count=5, jobs=1, disk_profile=None,
+                   timeout=300, output=None, keep=False):
+        """Benchmark how fast domains created from a base image boot
+
+        count domains are created, at most jobs at a time, and every phase
+        of their boot is timed: create, running, DHCP lease, sshd ready and
+        first command. Percentiles of each phase are printed and domains are
+        removed afterwards.
+
+        :param base_name: Name of the base image
+        :type base_name: str
+
+        :param count: Number of domains, defaults to 5
+        :type count: int, optional
+
+        :param jobs: Domains created and booted at once, defaults to 1
+        :type jobs: int, optional
+
+        :param disk_profile: Overlay profile, defaults to THINBOX_DISK_PROFILE
+        :type disk_profile: str, optional
+
+        :param timeout: Seconds a domain has to boot, defaults to 300
+        :type timeout: int, optional
+
+        :param output: Path the results are saved to as JSON
+        :type output: str, optional
+
+        :param keep: Keep the domains, defaults to False
+        :type keep: bool, optional
+        """
+        if base_name not in self.base_images:
+            logging.error("Image {} not found in {}.".format(
+                base_name, self.env.THINBOX_BASE_DIR))
+            print("To list the available images run: thinbox image")
+            sys.exit(1)
+        names = ["bench-{}-{}".format(os.getpid(), i) for i in range(count)]
+        started = time.time()
+        created = {}
+
+        def boot(name):
+            start = monotonic()
+            try:
+                self._create(base_name, name, disk_profile=disk_profile)
+            except CreateError as e:
+                logging.error(str(e))
+                return {"name": name, "error": str(e)}
+            vm = {"name": name, "create": monotonic() - start}
+            dom = self._connection.lookup(name)
+            created[name] = dom
+            try:
+                vm.update(bench.measure_boot(dom, timeout=timeout))
+            except TimeoutError as e:
+                logging.error(str(e))
+                vm["error"] = str(e)
+            else:
+                print("Domain '{}' ran a first command after {:.1f}s".format(
+                    name, monotonic() - start))
+            return vm
+
+        start = monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                vms = list(executor.map(boot, names))
+            wall = monotonic() - start
+        finally:
+            if not keep:
+                for dom in created.values():
+                    ssh_pool.discard(dom.ip)
+                    self._remove(dom)
+                self._doms = self._get_all_domains(self._readonly)
+
+        report = bench.boot_report(vms, wall)
+        print()
+        bench.print_boot_results(report)
+        if output:
+            report.update({
+                "image": base_name,
+                "count": count,
+                "jobs": jobs,
+                "disk_profile": disk_profile or self.env.THINBOX_DISK_PROFILE,
+                "started": started,
+            })
+            with open(output, "w") as file:
+                json.dump(report, file, indent=4)
+            print("Results saved to {}".format(output))
+
+    def _get_disk_profile(self, name=None):
+        """Return the qcow2 options of an overlay profile
+
+        :param name: Name of the profile, defaults to THINBOX_DISK_PROFILE
+        :type name: str, optional
+
+        :rtype: dict
+        """
+        name = name or self.env.THINBOX_DISK_PROFILE
+        profiles = self.env.THINBOX_DISK_PROFILES
+        if name not in profiles:
+            logging.error("Disk profile '{}' not found. Available: {}.".format(
+                name, ", ".join(sorted(profiles))))
+            sys.exit(1)
+        return profiles[name]
+
+    def _get_doms_from_patterns(self, patterns):
+        """Return domains matching names or glob patterns
+
+        :param patterns: Names or patterns, comma separated values are split
+        :type patterns: list
+
+        :return: Matching domains without duplicates, in given order
+        :rtype: list
+        """
+        doms = []
+        for pattern in ",".join(patterns).split(","):
+            if pattern == "":
+                continue
+            if any(c in pattern for c in "*?["):
+                matches = [d for d in self.doms
+                           if fnmatch.fnmatchcase(d.name, pattern)]
+                if matches == []:
+                    print("No domain matches '{}'".format(pattern))
+                    sys.exit(1)
+            else:
+                matches = [self._get_dom_from_name(pattern)]
+            doms += [d for d in matches if d.name not in [x.name for x in doms]]
+        return doms
+
+    def _get_dom_from_name(self, name):
+        domains = [d for d in self.doms if d.name == name]
+        if domains == []:
+            print("Domain '{}' does not exist".format(name))
+            sys.exit(1)
+        elif len(domains) > 1:
+            logging.error(
+                "Found more than one domain with name '{}'".format(name))
+        return domains[0]
+
+    def _wait_for_boot(self, dom, timeout=120):
+        """Wait for domain to boot, obtain an IP address and accept ssh.
+
+        :param dom: Domain to wait for
+        :type dom: thinbox.domain.Domain
+
+        :param timeout: Maximum seconds to wait before giving up, defaults to 120
+        :type timeout: int, optional
+        """
+        deadline = monotonic() + timeout
+        with timing.span("boot.address"):
+            self._resolve_address(dom)
+        if dom.ip == "":
+            print("Domain '{}' is starting.".format(dom.name))
+            with timing.span("boot.ip"):
+                while dom.ip == "":
+                    if monotonic() >= deadline:
+                        logging.error(
+                            "Domain '{}' did not get an IP within {} seconds.".format(
+                                dom.name, timeout))
+                        sys.exit(1)
+                    sleep(1)
+        with timing.span("boot.sshd"):
+            while not probe_address(dom.ip, dom.mac, timeout=1):
+                if monotonic() >= deadline:
+                    logging.error(
+                        "Domain '{}' did not accept ssh within {} seconds.".format(
+                            dom.name, timeout))
+                    sys.exit(1)
+                sleep(.5)
+        self.address_cache.set(dom.uuid, dom.ip, dom.mac)
+
+    def _resolve_address(self, dom):
+        """Set the address of a running domain
+
+        The address in the address cache is used if it still answers on
+        the ssh port, otherwise libvirt is asked and the cache updated, or
+        the entry dropped when libvirt does not know the address either.
+
+        :param dom: Domain to resolve
+        :type dom: thinbox.domain.Domain
+        """
+        if dom.active == 0:
+            return
+        cached = self.address_cache.get(dom.uuid)
+        if cached is not None and probe_address(cached["ip"], cached["mac"]):
+            logging.debug("Domain '{}' answers on cached {}.".format(
+                dom.name, cached["ip"]))
+            dom.use_address(cached["ip"], cached["mac"])
+            return
+        # dom.ip may be an address used earlier that no longer answers
+        ip, mac = dom.address()
+        dom.use_address(ip, mac)
+        if ip != "":
+            self.address_cache.set(dom.uuid, ip, mac)
+        elif cached is not None:
+            self.address_cache.forget(dom.uuid)
+
+    def _get_all_domains(self, readonly):
+        if self._connection is None:
+            self._connection = domain.LibVirtConnection(readonly, self._uri)
+        else:
+            self._connection.refresh()
+        self._update_inventory(self._connection.doms)
+        return self._connection.doms
+
+    def _get_base_images(self):
+        image_list = []
+        for root, dirs, files in os.walk(self.env.THINBOX_BASE_DIR):
+            for file in files:
+                # still being written by _normalize_image
+                if file.endswith(".normalizing"):
+                    continue
+                image_list.append(file)
+        inventory.update(self.env.THINBOX_CACHE_DIR, images=image_list)
+        return image_list
+
+    def _update_inventory(self, domains):
+        """Save domain names for shell completion
+
+        :param domains: Domains
+        :type domains: list
+        """
+        inventory.update(self.env.THINBOX_CACHE_DIR,
+                         domains=[d.name for d in domains])
+
+    def _get_rhel_tags(self):
+        url = self.env.RHEL_BASE_URL
+        page = requests.get(url)
+        soup = BeautifulSoup(page.content, 'html.parser')
+        tags = []
+        for l in soup.select("a"):
+            if "RHEL" in l.text:
+                tags.append(l.text[:-1])
+        return tags
+
+    def _generate_url_from_tag(self, tag):
+        url = os.path.join(
+            self.env.RHEL_BASE_URL,
+            tag,
+            "compose/BaseOS/x86_64/images/"
+        )
+        page = requests.get(url)
+        soup = BeautifulSoup(page.content, 'html.parser')
+        links = soup.select("a")
+        return os.path.join(url, links[12].text)
+
+    def _download_image(self, url, limiter=None, progress=None):
+        """Download a base image and its hash file
+
+        :param url: Url of image to download
+        :type url: str
+
+        :param limiter: Bandwidth budget shared with other downloads
+        :type limiter: thinbox.utils.BandwidthLimiter, optional
+
+        :param progress: Progress display shared with other downloads
+        :type progress: thinbox.utils.TransferProgress, optional
+
+        :return: Name of the downloaded image
+        :rtype: str
+        """
+        filename = os.path.split(url)[-1]
+        filepath = os.path.join(self.env.THINBOX_BASE_DIR, filename)
+        # check dir exist
+        if not os.path.exists(self.env.THINBOX_BASE_DIR):
+            os.makedirs(self.env.THINBOX_BASE_DIR)
+        # TODO download hash
+        # this works for only for rhel
+        hashpath = os.path.join(self.env.THINBOX_HASH_DIR, filename)
+        ext = "SHA256SUM"
+        paths = [p for p in (hashpath + "." + ext, filepath) if not os.path.exists(p)]
+        try:
+            # the hash is fetched first so that mirrors can be checked by digest
+            download_file(url + "." + ext, hashpath + "." + ext, limiter, progress)
+            if not self._pull_from_mirrors(
+                    filename, filepath, hashpath + "." + ext, limiter, progress):
+                download_file(url, filepath, limiter, progress)
+        except (requests.RequestException, OSError):
+            # a partial file would be taken for a download next time
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        return filename
+
+    def _verify_image(self, filename):
+        """Check the hash of a downloaded base image and report it
+
+        :param filename: Name of the base image
+        :type filename: str
+        """
+        if self.check_hash(filename, "sha256"):
+            print("Image '{}' downloaded, verified, and ready to use".format(filename))
+        else:
+            print("Image '{}' downloaded and ready to use but not verified.".format(filename))
+
+    def _normalize_image(self, filename):
+        """Convert a base image to the THINBOX_NORMALIZE qcow2 layout
+
+        The converted image replaces the downloaded one and its sha256 is
+        recorded in THINBOX_HASH_DIR as NAME.NORMALIZED.SHA256SUM, next to
+        NAME.ORIGINAL.SHA256SUM with the sha256 of the downloaded image, so
+        that it can still be checked against upstream. Read throughput is
+        measured before and after the conversion.
+
+        :param filename: Name of the base image
+        :type filename: str
+
+        :return: True if the image was normalized
+        :rtype: bool
+        """
+        opts = self.env.THINBOX_NORMALIZE
+        filepath = os.path.join(self.env.THINBOX_BASE_DIR, filename)
+        tmppath = filepath + ".normalizing"
+        print("Normalizing '{}' (cluster_size={}, compression={}, extended_l2={})".format(
+            filename, opts["cluster_size"], opts["compression"], opts["extended_l2"]))
+        before = qemu.read_throughput(filepath)
+        if not qemu.normalize(filepath, tmppath,
+                              cluster_size=opts["cluster_size"],
+                              compression=opts["compression"],
+                              extended_l2=opts["extended_l2"]):
+            logging.error("Could not normalize '{}', keeping it as is.".format(filename))
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return False
+        after = qemu.read_throughput(tmppath)
+        self._write_digest(filename, "ORIGINAL", filepath)
+        self._write_digest(filename, "NORMALIZED", tmppath)
+        os.replace(tmppath, filepath)
+
+        if before and after:
+            print("Read throughput: {}/s before, {}/s after".format(
+                sizeof_fmt(before), sizeof_fmt(after)))
+        print("Image '{}' normalized.".format(filename))
+        return True
+
+    def _write_digest(self, filename, kind, filepath):
+        """Record the sha256 of filepath as NAME.KIND.SHA256SUM in
+        THINBOX_HASH_DIR, in the format of upstream hash files
+        """
+        hashpath = os.path.join(
+            self.env.THINBOX_HASH_DIR, filename + "." + kind + ".SHA256SUM")
+        with open(hashpath, 'w') as file:
+            file.write("# {}: {} bytes\n".format(
+                filename, os.path.getsize(filepath)))
+            file.write("SHA256 ({}) = {}\n".format(
+                filename, file_digest(filepath, "sha256")))
+
+    def _pull_from_mirrors(self, filename, filepath, hashpath,
+                           limiter=None, progress=None):
+        """Fetch a base image from the first mirror that has it
+
+        Mirrors are tried in THINBOX_MIRRORS order. A candidate is accepted
+        only if its sha256 matches the upstream hash file, in which case the
+        hash check is marked as passed.
+
+        :param filename: Name of the base image
+        :type filename: str
+
+        :param filepath: Path where the image will be saved
+        :type filepath: str
+
+        :param hashpath: Path of the upstream SHA256SUM file
+        :type hashpath: str
+
+        :param limiter: Bandwidth budget for HTTP mirrors
+        :type limiter: thinbox.utils.BandwidthLimiter, optional
+
+        :param progress: Progress display for HTTP mirrors
+        :type progress: thinbox.utils.TransferProgress, optional
+
+        :return: True if the image was fetched from a mirror
+        :rtype: bool
+        """
+        if os.path.exists(filepath) or not self.env.THINBOX_MIRRORS:
+            return False
+        digest = read_hash_file(hashpath)
+        if digest == "":
+            logging.info(
+                "No upstream digest for '{}', skipping mirrors.".format(filename))
+            return False
+        for mirror in self.env.THINBOX_MIRRORS:
+            if fetch_from_mirror(mirror, filename, filepath, digest,
+                                 limiter=limiter, progress=progress):
+                shutil.copyfile(hashpath, hashpath + ".OK")
+                logging.info("Pulled '{}' from mirror {}".format(filename, mirror))
+                return True
+        logging.info("'{}' not found on any mirror.".format(filename))
+        return False
+
+    def _check_hash(self, filename, ext, hashfunc):
+        """"This function checks the hash of a file
+        with some hash contained in a filename
+
+        hash file should be in format
+        # NAME: NUM bytes
+        HASH_TYPE (NAME) = HASH
+        """
+
+        h = hashfunc
+
+        filepath = os.path.join(self.env.THINBOX_BASE_DIR, filename)
+        hashpath = os.path.join(
+            self.env.THINBOX_HASH_DIR,
+            filename + "." + ext)
+
+        if not os.path.exists(filepath):
+            logging.error("Image file {} does not exists.".format(filepath))
+            if not _image_name_wrong(filepath):
+                print("Maybe the filename is incorrect?")
+            print("To list the available images run: thinbox image")
+            sys.exit(1)
+        if not os.path.exists(hashpath):
+            logging.warning("Hash file {} does not exists.".format(filepath))
+            return False, "", ""
+        # if hash/imagename.hash.OK exists return True
+        if os.path.exists(hashpath + ".OK"):
+            with open(hashpath + ".OK", 'r') as file:
+                file.readline()
+                last = file.readline()
+            hf = last.strip().split(' ')[-1]
+            print("Found file that verifies a previous hash check for {}".format(ext))
+            return True, hf, hf
+
+        with open(hashpath, 'r') as file:
+            file.readline()
+            last = file.readline()
+        with open(filepath, 'rb') as file:
+            chunk = 0
+            while chunk != b'':
+                chunk = file.read(1024)
+                h.update(chunk)
+        hh = h.hexdigest()
+        hf = last.strip().split(' ')[-1]
+        # a normalized image is checked through the image it was made from
+        normalized = os.path.join(
+            self.env.THINBOX_HASH_DIR, filename + ".NORMALIZED." + ext)
+        if os.path.exists(normalized) and hh == read_hash_file(normalized):
+            hh = read_hash_file(os.path.join(
+                self.env.THINBOX_HASH_DIR, filename + ".ORIGINAL." + ext))
+
+        # if hash is good create hash/imagename.hash.OK
+        if hh == hf:
+            shutil.copyfile(hashpath, hashpath + ".OK")
+        return hh == hf, hh, hf
+
+    def check_hash(self, filename, hashname="md5"):
+        """Check hash of file
+
+        :parameter filename: Name of the file to check
+        :type filename: str
+
+        :parameter hashname: Type of hash
+        :type hashname: str, optional
+
+        :return: True if hashes match
+        :rtype: bool
+        """
+        if hashname == "md5" or hashname == "md5sum":
+            hashfunc = hashlib.md5()
+            ext = "MD5SUM"
+        elif hashname == "sha1" or hashname == "sha1sum":
+            hashfunc = hashlib.sha1()
+            ext = "SHA1SUM"
+        elif hashname == "sha256" or hashname == "sha256sum":
+            hashfunc = hashlib.sha256()
+            ext = "SHA256SUM"
+        else:
+            logging.error("Not a valid hash function: {}".format(hashname))
+        with timing.span("pull.hash", file=filename):
+            result, hh, hf = self._check_hash(filename, ext, hashfunc)
+
+        logging.debug("File hash is {}.".format(hf))
+        logging.debug("Expected {} is {}.".format(hashname, hh))
+        if not result:
+            logging.info("Continue withouth hash verification")
+            return result
+        if not hh == hf:
+            logging.error("Hashes do not match")
+            sys.exit(1)
+
+        return result
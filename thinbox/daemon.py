@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import argparse
+import threading
+import contextvars
+import socketserver
+
+import libvirt
+
+from thinbox import domain
+from thinbox import events
+from thinbox.client import COMMANDS, socket_path
+from thinbox.config import Env
+from thinbox.core import Thinbox
+
+# stream of the request served by the current thread
+_client = contextvars.ContextVar("client", default=None)
+# environment of the request served by the current thread
+_env = contextvars.ContextVar("env", default=None)
+
+class _Frames(object):
+    """Write what a request prints as frames to its client
+
+    Installed as sys.stdout and sys.stderr of the daemon. Writes of threads
+    serving no request go to the original stream.
+    """
+
+    def __init__(self, stream, kind):
+        self._stream = stream
+        self._kind = kind
+        self.buffer = _FramesBuffer(self)
+
+    def write(self, text):
+        client = _client.get()
+        if client is None:
+            return self._stream.write(text)
+        client.send({self._kind: text})
+        return len(text)
+
+    def flush(self):
+        if _client.get() is None:
+            self._stream.flush()
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        return self._stream.fileno()
+
+
+class _FramesBuffer(object):
+    """Binary side of _Frames, for output forwarded from domains"""
+
+    def __init__(self, frames):
+        self._frames = frames
+
+    def write(self, data):
+        self._frames.write(data.decode("utf8", "surrogateescape"))
+        return len(data)
+
+    def flush(self):
+        self._frames.flush()
+
+
+class _Client(object):
+    """Connection of a CLI to thinboxd"""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+
+    def send(self, frame):
+        data = json.dumps(frame).encode("utf8") + b"\n"
+        with self._lock:
+            self._wfile.write(data)
+            self._wfile.flush()
+
+
+class DaemonThinbox(Thinbox):
+    """Thinbox kept by thinboxd across requests
+
+    Domains are listed once and kept, with their addresses, until a
+    lifecycle event of libvirt changes them.
+
+    :param connection: Read-write libvirt connection with lifecycle events
+    :type connection: thinbox.domain.LibVirtConnection
+    """
+
+    def __init__(self, connection):
+        self._conn = connection.conn
+        self._lock = threading.Lock()
+        self._cache = None
+        super().__init__(readonly=False)
+        self._connection = connection
+
+    @property
+    def doms(self):
+        return self._get_all_domains(False)
+
+    def invalidate(self):
+        """Forget domains, they are listed again on next use
+        """
+        with self._lock:
+            self._cache = None
+
+    @property
+    def env(self):
+        """Environment of the request being served, read as it came in, so
+        `thinbox env` changes apply without disturbing running requests
+        """
+        return _env.get() or self._env
+
+    def use_env(self, env):
+        """Serve the current request with an environment
+
+        The ssh pool is shared by all requests, it keeps the
+        THINBOX_SSH_PERSIST of the latest one.
+
+        :param env: Environment of the request
+        :type env: thinbox.config.Env
+        """
+        _env.set(env)
+        self._apply_env()
+
+    def _get_all_domains(self, readonly):
+        with self._lock:
+            if self._cache is None:
+                self._cache = [domain.Domain(d) for d in self._conn.listAllDomains()]
+                logging.debug("Listed {} domains.".format(len(self._cache)))
+                self._update_inventory(self._cache)
+            return self._cache
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        client = _Client(self.wfile)
+        _client.set(client)
+        code = self.server.execute(request)
+        try:
+            client.send({"exit": code})
+        except OSError:
+            logging.debug("Client went away.")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """thinboxd, serving CLI commands over a Unix socket
+
+    It keeps a libvirt connection, the domains and their addresses, updated
+    by libvirt lifecycle events, and the pool of ssh connections to domains.
+    Every request runs in its own thread.
+
+    :param path: Socket path
+    :type path: str
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        self._path = path
+        events.start_event_loop()
+        connection = domain.LibVirtConnection(readonly=False)
+        self._conn = connection.conn
+        self._conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle, None)
+        self._conn.setKeepAlive(5, 3)
+        self.thinbox = DaemonThinbox(connection)
+
+        from thinbox.parser import get_parser
+        self._parser = get_parser()
+
+        if os.path.exists(path):
+            os.remove(path)
+        # the socket is created by bind, only accessible by its owner
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def execute(self, request):
+        """Execute a request, return its exit code"""
+        from thinbox.run import execute
+        args = argparse.Namespace(**request["args"])
+        if getattr(args, "command", None) not in COMMANDS \
+                or getattr(args, "watch", False):
+            print("thinboxd does not serve '{}'.".format(
+                getattr(args, "command", None)), file=sys.stderr)
+            return 2
+        _absolute_paths(args, request.get("cwd", "/"),
+                        [d.name for d in self.thinbox.doms])
+        self.thinbox.use_env(Env())
+        logging.debug("Request: {}".format(request))
+        try:
+            execute(self._parser, args, thinbox=lambda readonly=True: self.thinbox)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print(e.code, file=sys.stderr)
+            return 1
+        except Exception as e:
+            logging.exception("Request failed: {}".format(e))
+            return 1
+        return 0
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _lifecycle(self, conn, dom, event, detail, opaque):
+        logging.debug("Domain '{}' lifecycle event {}.".format(dom.name(), event))
+        self.thinbox.invalidate()
+
+
+def _absolute_paths(args, cwd, names):
+    """Make local paths of a copy request absolute
+
+    Paths with a colon, or equal to a domain name, are in a domain.
+    """
+    if getattr(args, "command", None) not in ("copy", "cp"):
+        return
+
+    def absolute(path):
+        if ":" in path or path in names:
+            return path
+        return os.path.join(cwd, os.path.expanduser(path))
+
+    args.file = [absolute(f) for f in args.file]
+    args.dest = absolute(args.dest)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve thinbox commands over a Unix socket in THINBOX_CACHE_DIR.")
+    parser.add_argument(
+        "-v", "--verbose",
+        help="increase output verbosity",
+        action="store_true"
+    )
+    args = parser.parse_args()
+
+    # output of requests goes to their client, logging included
+    sys.stdout = _Frames(sys.stdout, "out")
+    sys.stderr = _Frames(sys.stderr, "err")
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    path = socket_path()
+    if _is_running(path):
+        logging.error("thinboxd is already running on {}.".format(path))
+        sys.exit(1)
+
+    server = Server(path)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print("thinboxd listening on {}".format(path))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+
+
+def _is_running(path):
+    """Return True if a thinboxd answers on path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
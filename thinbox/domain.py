@@ -1,5 +1,21 @@
+import sys
+import logging
+
 import libvirt
 
+from thinbox import rpc
+
+# virConnect methods returning domains, wrapped for accounting as well
+DOMAIN_METHODS = {
+    "listAllDomains": "virDomain",
+    "lookupByName": "virDomain",
+    "lookupByUUIDString": "virDomain",
+    "lookupByID": "virDomain",
+    "defineXML": "virDomain",
+    "createXML": "virDomain",
+    "getAllDomainStats": "virDomain",
+}
+
 
 class Domain(object):
     """Class made to represent a libvirt domain
@@ -37,10 +53,10 @@ class Domain(object):
         self._dom = domain
         self._name = domain.name()
         self._id = domain.ID()
-        self._active = domain.isActive()
         self._uuid = domain.UUIDString()
 
         # need to be updated more than once
+        self._active = None
         self._state = ""
         self._reason = ""
         self._addr = {}
@@ -81,6 +97,15 @@ class Domain(object):
         """
         return self._uuid
 
+    @property
+    def memory(self):
+        """Return domain's maximum memory
+
+        :return: Memory in MiB
+        :rtype: int
+        """
+        return self._dom.maxMemory() // 1024
+
     @property
     def ip(self):
         """Return domain's IP
@@ -121,6 +146,53 @@ class Domain(object):
         self._set_state_reason()
         return self._reason
 
+    def state_reason(self):
+        """Return domain's state and reason with a single call
+
+        :rtype: tuple
+        """
+        self._set_state_reason()
+        return self._state, self._reason
+
+    def address(self, lease=False):
+        """Ask libvirt for domain's IP and MAC with a single call
+
+        Unlike ip and mac, nothing is kept and the domain is not checked to
+        be active first: the caller knows it runs.
+
+        :param lease: Look in the DHCP leases of libvirt networks instead of
+            the ARP table of the host, defaults to False
+        :type lease: bool, optional
+
+        :return: IP and MAC, empty strings if not found
+        :rtype: tuple
+        """
+        if lease:
+            source = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE
+        else:
+            source = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP
+        try:
+            addr = self._dom.interfaceAddresses(source)
+        except libvirt.libvirtError as e:
+            logging.debug("libvirt: {}".format(e))
+            return "", ""
+        if not addr:
+            return "", ""
+        tapx = list(addr)[0]
+        return addr[tapx]['addrs'][0]['addr'], addr[tapx]['hwaddr']
+
+    def use_address(self, ip, mac=""):
+        """Use a known address instead of asking libvirt
+
+        :param ip: IP of the domain
+        :type ip: str
+
+        :param mac: MAC of the domain
+        :type mac: str, optional
+        """
+        self._ip = ip
+        self._mac = mac
+
     def shutdown(self):
         """Shutdown domain
 
@@ -166,25 +238,7 @@ class Domain(object):
         :rtype: tuple
         """
         state, reason = self._dom.state()
-
-        if state == libvirt.VIR_DOMAIN_NOSTATE:
-            self._state = "nostate"
-        elif state == libvirt.VIR_DOMAIN_RUNNING:
-            self._state = "running"
-        elif state == libvirt.VIR_DOMAIN_BLOCKED:
-            self._state = "blocked"
-        elif state == libvirt.VIR_DOMAIN_PAUSED:
-            self._state = "paused"
-        elif state == libvirt.VIR_DOMAIN_SHUTDOWN:
-            self._state = "shutdown"
-        elif state == libvirt.VIR_DOMAIN_SHUTOFF:
-            self._state = "shutoff"
-        elif state == libvirt.VIR_DOMAIN_CRASHED:
-            self._state = "crashed"
-        elif state == libvirt.VIR_DOMAIN_PMSUSPENDED:
-            self._state = "pmsuspended"
-        else:
-            self._state = "unknown"
+        self._state = _state_name(state)
         self._reason = str(reason)
 
     def _set_addr(self):
@@ -219,18 +273,48 @@ class Domain(object):
         self._mac = self._addr[tapx]['hwaddr']
 
 
+def _state_name(state):
+    """Return the name of a libvirt.VIR_DOMAIN_* state"""
+    if state == libvirt.VIR_DOMAIN_NOSTATE:
+        return "nostate"
+    elif state == libvirt.VIR_DOMAIN_RUNNING:
+        return "running"
+    elif state == libvirt.VIR_DOMAIN_BLOCKED:
+        return "blocked"
+    elif state == libvirt.VIR_DOMAIN_PAUSED:
+        return "paused"
+    elif state == libvirt.VIR_DOMAIN_SHUTDOWN:
+        return "shutdown"
+    elif state == libvirt.VIR_DOMAIN_SHUTOFF:
+        return "shutoff"
+    elif state == libvirt.VIR_DOMAIN_CRASHED:
+        return "crashed"
+    elif state == libvirt.VIR_DOMAIN_PMSUSPENDED:
+        return "pmsuspended"
+    return "unknown"
+
+
 class LibVirtConnection(object):
     """Represent libvirt.virConnection object
 
+    Calls to the connection and its domains are accounted by thinbox.rpc.
+
     :param conn: Connection to libvirt
     :type conn: libvirt.virConnectiion
 
     :param doms: Domains
     :type doms: list
+
+    :param uri: URI of the hypervisor, e.g. "test:///default",
+        defaults to the libvirt default
+    :type uri: str, optional
+
+    :param conn: Connection already open, from _get_connection
+    :type conn: thinbox.rpc.Proxy, optional
     """
-    def __init__(self, readonly=True):
+    def __init__(self, readonly=True, uri=None, conn=None):
         super().__init__()
-        self._conn = self._get_connection(readonly)
+        self._conn = conn or self._get_connection(readonly, uri)
         self._doms = self._get_all_domains()
 
     @property
@@ -241,24 +325,91 @@ class LibVirtConnection(object):
     def doms(self):
         return self._doms
 
-    def _get_connection(self, readonly):
+    def states(self):
+        """Return the state of every domain with a single call
+
+        The states are not kept on the Domains, which may be shared by
+        several callers.
+
+        :return: Tuples of state name and reason, by UUID
+        :rtype: dict
+        """
+        stats = self.conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        return {d.UUIDString(): (_state_name(s["state.state"]),
+                                 str(s["state.reason"]))
+                for d, s in stats}
+
+    def host_memory(self):
+        """Return memory of the host and memory committed to running domains
+
+        Committed memory is the maximum memory of every running domain,
+        fetched with a single call.
+
+        :return: Memory in MiB, with keys total, free and committed, None
+            if the driver can not tell
+        :rtype: dict
+        """
+        try:
+            total = self.conn.getInfo()[1]
+            free = self.conn.getFreeMemory() // 1024 ** 2
+            stats = self.conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_BALLOON,
+                libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except libvirt.libvirtError as e:
+            logging.debug("libvirt: {}".format(e))
+            return None
+        committed = 0
+        for dom, stat in stats:
+            if "balloon.maximum" in stat:
+                committed += stat["balloon.maximum"] // 1024
+            else:
+                try:
+                    committed += dom.maxMemory() // 1024
+                except libvirt.libvirtError as e:
+                    logging.debug("libvirt: {}".format(e))
+                    return None
+        return {"total": total, "free": free, "committed": committed}
+
+    def refresh(self):
+        """List domains again
+
+        :return: All Domains
+        :rtype: list
+        """
+        self._doms = self._get_all_domains()
+        return self._doms
+
+    def _get_connection(self, readonly, uri=None):
         """Open a libvirt connection and return it
 
         :param readonly: Open readonly connection
         :type readonly: bool
 
+        :param uri: URI of the hypervisor
+        :type uri: str, optional
+
         :return: Libvirt connection
         :rtype: libvirt.virConnection
         """
         try:
             if readonly:
-                conn = libvirt.openReadOnly(None)
+                conn = rpc.call("virConnect.openReadOnly", libvirt.openReadOnly, uri)
             else:
-                conn = libvirt.open()
+                conn = rpc.call("virConnect.open", libvirt.open, uri)
         except libvirt.libvirtError as e:
             logging.error("libvirt: {}".format(e))
             sys.exit(1)
-        return conn
+        return rpc.Proxy(conn, "virConnect", DOMAIN_METHODS)
+
+    def lookup(self, name):
+        """Return the domain of given name, even if not listed yet
+
+        :param name: Name of domain
+        :type name: str
+
+        :rtype: thinbox.domain.Domain
+        """
+        return Domain(self._get_domain(name))
 
     def _get_domain(self, name):
         """Get domain by name
@@ -0,0 +1,148 @@
+import time
+import queue
+import logging
+import threading
+
+import libvirt
+
+from thinbox import domain
+from thinbox import rpc
+
+# Domain changes driven by libvirt lifecycle events, for `thinbox list
+# --watch` and `thinbox events`. libvirt has no event for DHCP leases, so the
+# addresses of running domains that have none yet are polled instead.
+
+# names of libvirt.VIR_DOMAIN_EVENT_* lifecycle events, by value
+EVENT_NAMES = [
+    "defined",
+    "undefined",
+    "started",
+    "suspended",
+    "resumed",
+    "stopped",
+    "shutdown",
+    "pmsuspended",
+    "crashed",
+]
+
+_loop_lock = threading.Lock()
+_loop_started = False
+
+
+def start_event_loop():
+    """Run the default libvirt event loop in a thread
+
+    It has to be started before the connections events are registered on
+    are opened. Later calls do nothing.
+    """
+    global _loop_started
+    with _loop_lock:
+        if _loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        threading.Thread(target=_event_loop, daemon=True).start()
+        _loop_started = True
+
+
+def _event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def event_name(event):
+    """Return the name of a libvirt.VIR_DOMAIN_EVENT_* lifecycle event
+
+    :param event: Lifecycle event
+    :type event: int
+
+    :rtype: str
+    """
+    if 0 <= event < len(EVENT_NAMES):
+        return EVENT_NAMES[event]
+    return "unknown"
+
+
+class Watcher(object):
+    """Follow the domains of a connection through lifecycle events
+
+    :param connection: Connection opened after start_event_loop
+    :type connection: thinbox.domain.LibVirtConnection
+
+    :param doms: Domains known so far
+    :type doms: list
+
+    :param states: States of doms by UUID, from
+        thinbox.domain.LibVirtConnection.states, kept up to date in
+        the states attribute
+    :type states: dict
+
+    :param interval: Seconds between polls of missing addresses,
+        defaults to 2
+    :type interval: float, optional
+    """
+
+    def __init__(self, connection, doms, states, interval=2):
+        self._interval = interval
+        self._queue = queue.Queue()
+        self.doms = {d.uuid: d for d in doms}
+        self.states = dict(states)
+        # running domains whose address is not known yet
+        self._pending = {d.uuid for d in doms
+                         if self._running(d) and d.address()[0] == ""}
+        connection.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle, None)
+        connection.conn.setKeepAlive(5, 3)
+
+    def changes(self):
+        """Yield changes of domains as they happen, forever
+
+        A domain changed by a lifecycle event is looked up again, with one
+        call for its state, kept in states until the domain is undefined.
+        "address" is yielded when a running domain got its address.
+
+        :return: Tuples of the event name and the changed Domain
+        :rtype: generator
+        """
+        deadline = time.monotonic() + self._interval
+        while True:
+            # poll on time even while events keep coming
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                yield from self._poll()
+                deadline = time.monotonic() + self._interval
+                continue
+            try:
+                dom, event = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            uuid = dom.UUIDString()
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                self._pending.discard(uuid)
+                d = self.doms.pop(uuid, None)
+                if d is not None:
+                    yield event_name(event), d
+                self.states.pop(uuid, None)
+                continue
+            d = domain.Domain(rpc.Proxy(dom, "virDomain"))
+            self.states[uuid] = d.state_reason()
+            self.doms[uuid] = d
+            if self._running(d) and d.address()[0] == "":
+                self._pending.add(uuid)
+            else:
+                self._pending.discard(uuid)
+            yield event_name(event), d
+
+    def _poll(self):
+        for uuid in list(self._pending):
+            d = self.doms[uuid]
+            if d.address()[0] != "":
+                self._pending.discard(uuid)
+                yield "address", d
+
+    def _running(self, d):
+        return self.states.get(d.uuid, ("", ""))[0] == "running"
+
+    def _lifecycle(self, conn, dom, event, detail, opaque):
+        logging.debug("Domain '{}' lifecycle event {}.".format(
+            dom.name(), event_name(event)))
+        self._queue.put((dom, event))
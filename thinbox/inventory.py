@@ -0,0 +1,70 @@
+import os
+import json
+import logging
+import threading
+
+from thinbox.config import Env
+
+# Snapshot of domain and base image names for shell completion, written by
+# commands that list them anyway. Only the standard library and
+# thinbox.config are imported so that completion stays fast.
+INVENTORY_FILE = "inventory.json"
+
+
+def load(cache_dir):
+    """Return the inventory snapshot
+
+    :param cache_dir: THINBOX_CACHE_DIR
+    :type cache_dir: str
+
+    :return: Dict with lists "domains" and "images", empty if missing
+    :rtype: dict
+    """
+    try:
+        with open(os.path.join(cache_dir, INVENTORY_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def update(cache_dir, **names):
+    """Update the inventory snapshot, written only when it changes
+
+    :param cache_dir: THINBOX_CACHE_DIR
+    :type cache_dir: str
+
+    :param names: Names by kind, "domains" or "images"
+    :type names: list
+    """
+    inventory = load(cache_dir)
+    new = dict(inventory)
+    new.update({kind: sorted(n) for kind, n in names.items()})
+    if new == inventory:
+        return
+    path = os.path.join(cache_dir, INVENTORY_FILE)
+    # unique, concurrent commands and daemon threads update it too
+    tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, "w") as file:
+            json.dump(new, file)
+        os.replace(tmp, path)
+    except OSError as e:
+        # completion goes without the new names, commands go on
+        logging.warning("Cannot update {}: {}".format(path, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _complete(kind, prefix):
+    names = load(Env().THINBOX_CACHE_DIR).get(kind, [])
+    return [n for n in names if n.startswith(prefix)]
+
+
+def domain_completer(prefix, **kwargs):
+    """argcomplete completer of domain names"""
+    return _complete("domains", prefix)
+
+
+def image_completer(prefix, **kwargs):
+    """argcomplete completer of base image names"""
+    return _complete("images", prefix)
@@ -1,6 +1,7 @@
 import argparse
 
-from thinbox.config import IMAGE_TAGS
+from thinbox.config import IMAGE_TAGS, LIST_FIELDS, LIST_FORMATS
+from thinbox.inventory import domain_completer, image_completer
 
 try:
     import argcomplete
@@ -23,13 +24,52 @@ class Formatter(argparse.HelpFormatter):
         return super(Formatter, self)._format_action(action)
 
 
+def _fields(value):
+    """Parse comma separated fields of `thinbox list`"""
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in LIST_FIELDS]
+    if unknown or not fields:
+        raise argparse.ArgumentTypeError(
+            "unknown fields {}, choose from {}".format(
+                ",".join(unknown), ",".join(LIST_FIELDS)))
+    return fields
+
+
+def _add_list_output(parser):
+    """Add output options of `thinbox list` to parser"""
+    parser.add_argument(
+        "--format",
+        choices=LIST_FORMATS,
+        default="table",
+        help="output format, defaults to table"
+    )
+    parser.add_argument(
+        "--fields",
+        type=_fields,
+        help="comma separated fields to print, of {}, defaults to "
+             "name,state,ip,mac".format(",".join(LIST_FIELDS))
+    )
+    parser.add_argument(
+        "-w", "--watch",
+        action="store_true",
+        help="keep listing, redrawing the VMs that change"
+    )
+    parser.add_argument(
+        "-i", "--interval",
+        type=float,
+        default=2,
+        help="with --watch, seconds between polls of missing addresses, defaults to 2"
+    )
+
+
 def get_parser():
     """
     Returns parser.
 
     Note: choices= for VM names and base images are not restricted at parse
     time to avoid opening a libvirt connection on every invocation (including
-    --help). Validation happens inside the Thinbox methods.
+    --help). Validation happens inside the Thinbox methods. They are
+    completed from the snapshot kept by thinbox.inventory instead.
     """
 
     parser = argparse.ArgumentParser(  # usage="%(prog)s <command> [opts] [args]",
@@ -42,6 +82,26 @@ def get_parser():
         help="increase output verbosity",
         action="store_true"
     )
+    parser.add_argument(
+        "--no-daemon",
+        help="do not use thinboxd even if it is running",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--stats",
+        help="print the number of libvirt calls and their time, -v logs each call",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--timings",
+        help="print the time spent in each phase of the command",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--trace",
+        help="append timing spans to FILE as JSON lines, implies --timings",
+        metavar="FILE"
+    )
     # parser.add_argument(
     #     "-c",
     #     "--config",
@@ -69,8 +129,9 @@ def get_parser():
     pull_tag_parser_gr.add_argument(
         "name",
         metavar="TAG",
+        nargs="+",
         choices=IMAGE_TAGS,  # _get_rhel_tags(),
-        help="TAG to download"
+        help="TAG or TAGs to download"
     )
     pull_tag_parser_gr.add_argument(
         "-s", "--skip-check",
@@ -85,7 +146,8 @@ def get_parser():
     pull_url_parser_gr = pull_url_parser.add_argument_group()
     pull_url_parser_gr.add_argument(
         "name",
-        help="URL to download"
+        nargs="+",
+        help="URL or URLs to download"
     )
     pull_url_parser_gr.add_argument(
         "-s", "--skip-check",
@@ -93,6 +155,24 @@ def get_parser():
         const=True,
         help="skip hash check"
     )
+    for group in (pull_tag_parser_gr, pull_url_parser_gr):
+        group.add_argument(
+            "-j", "--jobs",
+            type=int,
+            default=4,
+            help="maximum number of concurrent downloads, defaults to 4"
+        )
+        group.add_argument(
+            "-n", "--normalize",
+            action="store_const",
+            const=True,
+            help="convert to the THINBOX_NORMALIZE qcow2 layout after pull"
+        )
+        group.add_argument(
+            "-l", "--limit-rate",
+            default="0",
+            help="global bandwidth budget per second, e.g. 10M, defaults to unlimited"
+        )
 
     # create
     create_parser = subparsers.add_parser(
@@ -103,17 +183,71 @@ def get_parser():
         "image",
         metavar="IMG_NAME",
         help="Name of image already downloaded"
-    )
+    ).completer = image_completer
     create_parser.add_argument(
         "name",
         help="name of the VM"
     )
+    create_parser.add_argument(
+        "-d", "--disk-profile",
+        help="overlay profile from THINBOX_DISK_PROFILES"
+    )
+    create_parser.add_argument(
+        "-s", "--share",
+        action="append",
+        metavar="HOST_DIR[:TAG]",
+        help="share a host directory with virtiofs, mounted on /mnt/TAG, can be repeated"
+    )
+    create_parser.add_argument(
+        "-i", "--inject",
+        action="append",
+        metavar="SRC:DEST",
+        help="copy a local file or directory into DEST on the VM disk before first boot, can be repeated"
+    )
+    create_parser.add_argument(
+        "-m", "--memory",
+        type=int,
+        metavar="MiB",
+        help="memory of the VM in MiB, defaults to THINBOX_MEMORY"
+    )
+    create_parser.add_argument(
+        "-c", "--vcpus",
+        type=int,
+        help="virtual CPUs of the VM, defaults to THINBOX_VCPUS"
+    )
+    create_parser.add_argument(
+        "-w", "--wait",
+        action="store_true",
+        help="wait until the VM fits in host memory instead of failing"
+    )
     # copy
     copy_parser = subparsers.add_parser(
         "copy",
         aliases=["cp"],
         help="copy files into specified VM"
     )
+    copy_parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=4,
+        help="files transferred at once per VM, defaults to 4"
+    )
+    copy_parser.add_argument(
+        "-m", "--mode",
+        choices=["auto", "sftp", "tar"],
+        help="send files one by one over SFTP or as one compressed tar stream, "
+             "defaults to THINBOX_COPY_MODE"
+    )
+    copy_parser.add_argument(
+        "-s", "--sync",
+        action="store_true",
+        help="send only changed files and blocks into the VM"
+    )
+    copy_parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="with --sync, delete files in the VM that do not exist locally"
+    )
     copy_parser.add_argument(
         "file",
         nargs="+",
@@ -128,14 +262,20 @@ def get_parser():
         "run",
         help="run command into specified VM"
     )
+    run_parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=8,
+        help="maximum number of VMs running the command at once, defaults to 8"
+    )
     run_parser.add_argument(
         "name",
         metavar="VM_NAME",
-        help="name of VM"
-    )
+        help="name of VM, names separated by commas or a glob like 'web-*'"
+    ).completer = domain_completer
     run_parser.add_argument(
         "cmd",
-        nargs="+",
+        nargs=argparse.REMAINDER,
         help="command to run"
     )
     # env
@@ -216,6 +356,7 @@ def get_parser():
         const=True,
         help="List all stopped VMs"
     )
+    _add_list_output(list_parser)
     # remove
     remove_parser = subparsers.add_parser(
         "remove",
@@ -234,7 +375,7 @@ def get_parser():
         "name",
         nargs="?",
         help="Remove a VM of name"
-    )
+    ).completer = domain_completer
     # image
     image_parser = subparsers.add_parser(
         "image",
@@ -266,6 +407,41 @@ def get_parser():
         "name",
         nargs="?",
         help="Remove a VM of name"
+    ).completer = image_completer
+    image_remove_parser.add_argument(
+        "-c", "--cascade",
+        action='store_const',
+        const=True,
+        help="Also remove VMs using the image"
+    )
+    image_subparser.add_parser(
+        "reindex",
+        help="Rebuild the index of VMs using each image"
+    )
+    image_gc_parser = image_subparser.add_parser(
+        "gc",
+        help="Remove orphan overlays and evict unused images"
+    )
+    image_gc_parser.add_argument(
+        "-n", "--dry-run",
+        action="store_const",
+        const=True,
+        help="only print what would be removed"
+    )
+    image_serve_parser = image_subparser.add_parser(
+        "serve",
+        help="Serve base images over HTTP"
+    )
+    image_serve_parser.add_argument(
+        "-b", "--bind",
+        default="",
+        help="address to bind, defaults to all interfaces"
+    )
+    image_serve_parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=8000,
+        help="port to listen on, defaults to 8000"
     )
     # vm
     vm_parser = subparsers.add_parser(
@@ -312,6 +488,7 @@ def get_parser():
         const=True,
         help="List all stopped VMs"
     )
+    _add_list_output(vm_list_parser)
     vm_remove_parser = vm_subparser.add_parser(
         "remove",
         aliases=['rm'],
@@ -329,6 +506,92 @@ def get_parser():
         "name",
         nargs="?",
         help="Remove a VM of name"
+    ).completer = domain_completer
+    # bench
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="run benchmarks on this host"
+    )
+    bench_subparser = bench_parser.add_subparsers(
+        dest="bench_parser",
+        required=True
+    )
+    bench_disk_parser = bench_subparser.add_parser(
+        "disk",
+        help="Compare overlay disk profiles"
+    )
+    bench_disk_parser.add_argument(
+        "image",
+        metavar="IMG_NAME",
+        help="Name of image already downloaded"
+    ).completer = image_completer
+    bench_disk_parser.add_argument(
+        "-p", "--profile",
+        action="append",
+        help="profile to benchmark, can be repeated, defaults to all"
+    )
+    bench_disk_parser.add_argument(
+        "-s", "--size",
+        default="256M",
+        help="bytes of sequential I/O, defaults to 256M"
+    )
+    bench_disk_parser.add_argument(
+        "--ops",
+        type=int,
+        default=2000,
+        help="number of random 4K requests, defaults to 2000"
+    )
+    bench_boot_parser = bench_subparser.add_parser(
+        "boot",
+        help="Time how fast VMs boot from an image"
+    )
+    bench_boot_parser.add_argument(
+        "image",
+        metavar="IMG_NAME",
+        help="Name of image already downloaded"
+    ).completer = image_completer
+    bench_boot_parser.add_argument(
+        "-n", "--count",
+        type=int,
+        default=5,
+        help="number of VMs to boot, defaults to 5"
+    )
+    bench_boot_parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="VMs created and booted at once, defaults to 1"
+    )
+    bench_boot_parser.add_argument(
+        "-d", "--disk-profile",
+        help="overlay profile, defaults to THINBOX_DISK_PROFILE"
+    )
+    bench_boot_parser.add_argument(
+        "-t", "--timeout",
+        type=int,
+        default=300,
+        help="seconds a VM has to boot, defaults to 300"
+    )
+    bench_boot_parser.add_argument(
+        "-o", "--output",
+        metavar="FILE",
+        help="save results as JSON to FILE"
+    )
+    bench_boot_parser.add_argument(
+        "-k", "--keep",
+        action="store_true",
+        help="keep the VMs instead of removing them"
+    )
+    # events
+    events_parser = subparsers.add_parser(
+        "events",
+        help="stream VM state changes as JSON lines"
+    )
+    events_parser.add_argument(
+        "-i", "--interval",
+        type=float,
+        default=2,
+        help="seconds between polls of missing addresses, defaults to 2"
     )
     # enter
     enter_parser = subparsers.add_parser(
@@ -339,6 +602,27 @@ def get_parser():
         "name",
         metavar="VM_NAME",
         help="name of the VM to enter"
+    ).completer = domain_completer
+    enter_parser.add_argument(
+        "-w", "--wait",
+        action="store_true",
+        help="wait until a stopped VM fits in host memory instead of failing"
+    )
+    # share
+    share_parser = subparsers.add_parser(
+        "share",
+        help="share host directories with an existing VM"
+    )
+    share_parser.add_argument(
+        "name",
+        metavar="VM_NAME",
+        help="name of the VM"
+    ).completer = domain_completer
+    share_parser.add_argument(
+        "share",
+        nargs="+",
+        metavar="HOST_DIR[:TAG]",
+        help="host directory shared with virtiofs, mounted on /mnt/TAG"
     )
     # start
     start_parser = subparsers.add_parser(
@@ -349,6 +633,11 @@ def get_parser():
         "name",
         metavar="VM_NAME",
         help="name of the VM to start"
+    ).completer = domain_completer
+    start_parser.add_argument(
+        "-w", "--wait",
+        action="store_true",
+        help="wait until the VM fits in host memory instead of failing"
     )
     # stop
     stop_parser = subparsers.add_parser(
@@ -359,7 +648,7 @@ def get_parser():
         "name",
         metavar="VM_NAME",
         help="name of the VM to stop"
-    )
+    ).completer = domain_completer
     stop_parser_mg = stop_parser.add_mutually_exclusive_group(required=False)
     stop_parser_mg.add_argument(
         "-f", "--force",
@@ -0,0 +1,331 @@
+import re
+import json
+import random
+import struct
+import logging
+import subprocess
+import contextvars
+
+from time import monotonic
+
+# default commands of the qemu tools
+tools = {
+    "qemu-img": "qemu-img",
+    "qemu-io": "qemu-io",
+}
+
+# commands set by Thinbox from THINBOX_TOOLS, per thinboxd request
+_tools = contextvars.ContextVar("tools", default=None)
+
+
+def use_tools(commands):
+    """Run the qemu tools with these commands in the current context
+
+    :param commands: Command by tool name, e.g. THINBOX_TOOLS
+    :type commands: dict
+    """
+    _tools.set(commands)
+
+
+def _tool(name):
+    """Return the command of a qemu tool in the current context"""
+    return (_tools.get() or tools)[name]
+
+
+def qemu_img(*args, log_errors=True):
+    """Run qemu-img and return the completed process
+
+    stdout and stderr are captured, stderr is logged on failure.
+
+    :param args: Arguments to pass to qemu-img
+    :type args: str
+
+    :param log_errors: Log stderr as errors on failure, defaults to True
+    :type log_errors: bool, optional
+
+    :rtype: subprocess.CompletedProcess
+    """
+    cmd = [_tool('qemu-img')] + list(args)
+    logging.debug("qemu-img: {}".format(" ".join(cmd)))
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        log = logging.error if log_errors else logging.debug
+        for line in p.stderr.decode('utf8').split('\n'):
+            if line != '':
+                log("qemu-img: {}".format(line))
+    return p
+
+
+def image_info(path):
+    """Return `qemu-img info` of an image
+
+    :param path: Path of the image
+    :type path: str
+
+    :return: Parsed json output, empty dict on failure
+    :rtype: dict
+    """
+    p = qemu_img('info', '-U', '--output=json', path)
+    if p.returncode != 0:
+        return {}
+    return json.loads(p.stdout)
+
+
+QCOW2_MAGIC = b'QFI\xfb'
+
+
+def read_backing_file(path):
+    """Read the backing file name from a qcow2 header, in-process
+
+    Header fields are big endian: magic (4 bytes), version (4),
+    backing_file_offset (8) and backing_file_size (4).
+
+    :param path: Path of the image
+    :type path: str
+
+    :return: Backing file as stored in the header, None if the image has
+        no backing file or is not a qcow2
+    :rtype: str
+    """
+    with open(path, 'rb') as file:
+        header = file.read(20)
+        if len(header) < 20 or header[:4] != QCOW2_MAGIC:
+            return None
+        offset, size = struct.unpack('>QI', header[8:20])
+        if offset == 0 or size == 0:
+            return None
+        file.seek(offset)
+        return file.read(size).decode('utf8')
+
+
+def format_options(cluster_size=None, extended_l2=False,
+                   compression_type=None, **options):
+    """Build the -o option string for a qcow2 image
+
+    :param cluster_size: Cluster size, e.g. "64k"
+    :type cluster_size: str, optional
+
+    :param extended_l2: Use subclusters, needs cluster_size >= 16k
+    :type extended_l2: bool, optional
+
+    :param compression_type: "zlib" or "zstd"
+    :type compression_type: str, optional
+
+    :param options: Other qcow2 options, e.g. lazy_refcounts=True
+    :type options: dict
+
+    :return: Comma separated options
+    :rtype: str
+    """
+    opts = []
+    if cluster_size:
+        opts.append("cluster_size={}".format(cluster_size))
+    if extended_l2:
+        opts.append("extended_l2=on")
+    if compression_type:
+        opts.append("compression_type={}".format(compression_type))
+    for key, value in options.items():
+        if value is True:
+            value = "on"
+        elif value is False or value is None:
+            continue
+        opts.append("{}={}".format(key, value))
+    return ",".join(opts)
+
+
+def overlay_options(base, **profile):
+    """Build the -o option string of an overlay backed by base
+
+    :param base: Path of the backing qcow2 image
+    :type base: str
+
+    :param profile: qcow2 options of a disk profile, see format_options
+    :type profile: dict
+
+    :return: Comma separated options
+    :rtype: str
+    """
+    opts = ['backing_file=' + base, 'backing_fmt=qcow2']
+    extra = format_options(**profile)
+    if extra:
+        opts.append(extra)
+    return ",".join(opts)
+
+
+def create_overlay(base, path, **profile):
+    """Create a qcow2 overlay backed by base
+
+    :param base: Path of the backing qcow2 image
+    :type base: str
+
+    :param path: Path of the overlay to create
+    :type path: str
+
+    :param profile: qcow2 options of a disk profile, see format_options
+    :type profile: dict
+
+    :return: True if created
+    :rtype: bool
+    """
+    p = qemu_img('create', '-f', 'qcow2', '-o',
+                 overlay_options(base, **profile), path)
+    return p.returncode == 0
+
+
+def normalize(src, dest, cluster_size="64k", compression=False,
+              extended_l2=False):
+    """Convert an image of any layout into a tuned qcow2
+
+    :param src: Path of the source image, raw or qcow2
+    :type src: str
+
+    :param dest: Path of the converted image
+    :type dest: str
+
+    :param cluster_size: qcow2 cluster size, defaults to "64k"
+    :type cluster_size: str, optional
+
+    :param compression: False, "zlib" or "zstd", defaults to False
+    :type compression: bool or str, optional
+
+    :param extended_l2: Enable subclusters, defaults to False
+    :type extended_l2: bool, optional
+
+    :return: True if converted
+    :rtype: bool
+    """
+    compression_type = compression if compression not in (True, False) else None
+    opts = format_options(cluster_size=cluster_size, extended_l2=extended_l2,
+                          compression_type=compression_type)
+    args = ['convert', '-O', 'qcow2']
+    if opts:
+        args += ['-o', opts]
+    if compression:
+        args.append('-c')
+    p = qemu_img(*args, src, dest)
+    return p.returncode == 0
+
+
+def bench(path, count, bufsize=64 * 1024, depth=16, step=None, write=False,
+          cache="none"):
+    """Run `qemu-img bench` and return elapsed seconds
+
+    When the cache mode is not supported by the filesystem, e.g. O_DIRECT
+    on tmpfs, it retries with "writeback".
+
+    :param path: Path of the image
+    :type path: str
+
+    :param count: Number of requests
+    :type count: int
+
+    :param bufsize: Size of each request in bytes, defaults to 64KiB
+    :type bufsize: int, optional
+
+    :param depth: Requests in flight, defaults to 16
+    :type depth: int, optional
+
+    :param step: Offset increment, defaults to bufsize
+    :type step: int, optional
+
+    :param write: Benchmark writes instead of reads, defaults to False
+    :type write: bool, optional
+
+    :param cache: Cache mode, defaults to "none"
+    :type cache: str, optional
+
+    :return: Elapsed seconds, None on failure
+    :rtype: float
+    """
+    args = ['bench', '-c', str(count), '-d', str(depth), '-s', str(bufsize),
+            '-t', cache]
+    if step:
+        args += ['-S', str(step)]
+    if write:
+        args.append('-w')
+    p = qemu_img(*args, path, log_errors=(cache == "writeback"))
+    if p.returncode != 0:
+        if cache != "writeback":
+            return bench(path, count, bufsize, depth, step, write, "writeback")
+        return None
+    match = re.search(r'Run completed in ([\d.]+) seconds', p.stdout.decode('utf8'))
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def read_throughput(path, limit=512 * 1024 * 1024, bufsize=1024 * 1024):
+    """Measure sequential read throughput of an image
+
+    Reads at most `limit` bytes of the guest visible disk.
+
+    :param path: Path of the image
+    :type path: str
+
+    :param limit: Maximum bytes to read, defaults to 512MiB
+    :type limit: int, optional
+
+    :param bufsize: Size of each request, defaults to 1MiB
+    :type bufsize: int, optional
+
+    :return: Bytes per second, None on failure
+    :rtype: float
+    """
+    size = image_info(path).get('virtual-size', 0)
+    count = min(size, limit) // bufsize
+    if count == 0:
+        return None
+    elapsed = bench(path, count, bufsize=bufsize)
+    if not elapsed:
+        return None
+    return count * bufsize / elapsed
+
+
+def random_io(path, count, bufsize=4096, write=False, cache="none", seed=None):
+    """Issue requests at random aligned offsets with qemu-io
+
+    All requests run in one qemu-io process so that opening the image is
+    paid once.
+
+    :param path: Path of the image
+    :type path: str
+
+    :param count: Number of requests
+    :type count: int
+
+    :param bufsize: Size of each request in bytes, defaults to 4KiB
+    :type bufsize: int, optional
+
+    :param write: Issue writes instead of reads, defaults to False
+    :type write: bool, optional
+
+    :param cache: Cache mode, defaults to "none"
+    :type cache: str, optional
+
+    :param seed: Seed of the offsets, for repeatable runs
+    :type seed: int, optional
+
+    :return: Elapsed seconds, None on failure
+    :rtype: float
+    """
+    size = image_info(path).get('virtual-size', 0)
+    if size < bufsize:
+        return None
+    rng = random.Random(seed)
+    op = 'write' if write else 'read'
+    cmd = [_tool('qemu-io'), '-f', 'qcow2', '-t', cache]
+    for _ in range(count):
+        offset = rng.randrange(size // bufsize) * bufsize
+        cmd += ['-c', '{} {} {}'.format(op, offset, bufsize)]
+    cmd.append(path)
+    start = monotonic()
+    p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = monotonic() - start
+    if p.returncode != 0:
+        if cache != "writeback":
+            return random_io(path, count, bufsize, write, "writeback", seed)
+        for line in p.stderr.decode('utf8').split('\n'):
+            if line != '':
+                logging.error("qemu-io: {}".format(line))
+        return None
+    return elapsed
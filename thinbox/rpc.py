@@ -0,0 +1,165 @@
+import sys
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+
+# Accounting of libvirt calls. Connections and domains are wrapped in a
+# Proxy that counts and times every method call while a Stats is recorded in
+# the current context, e.g. by --stats or by tests asserting RPC budgets.
+
+# accessors libvirt answers from the client side object, without an RPC
+LOCAL_METHODS = {"name", "ID", "UUID", "UUIDString", "connect"}
+
+# stats of the command running in this context, None if not recorded
+_stats = contextvars.ContextVar("rpc_stats", default=None)
+
+
+class Stats(object):
+    """Number of calls and time spent per libvirt method
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        """Account a call
+
+        :param name: Method, e.g. "virDomain.state"
+        :type name: str
+
+        :param duration: Seconds the call took
+        :type duration: float
+        """
+        with self._lock:
+            count, total = self._calls.get(name, (0, 0.0))
+            self._calls[name] = (count + 1, total + duration)
+
+    def count(self, name=None):
+        """Return the number of calls
+
+        :param name: Method, all methods if None
+        :type name: str, optional
+
+        :rtype: int
+        """
+        with self._lock:
+            if name is not None:
+                return self._calls.get(name, (0, 0.0))[0]
+            return sum(count for count, _ in self._calls.values())
+
+    def report(self, file=None):
+        """Print calls per method, most expensive first
+
+        :param file: Stream to print to, defaults to sys.stderr
+        :type file: file, optional
+        """
+        file = file or sys.stderr
+        with self._lock:
+            calls = sorted(self._calls.items(), key=lambda c: -c[1][1])
+        print("{:<36} {:>6} {:>9}".format("LIBVIRT CALL", "COUNT", "SECONDS"),
+              file=file)
+        for name, (count, total) in calls:
+            print("{:<36} {:>6} {:>9.3f}".format(name, count, total), file=file)
+        print("{:<36} {:>6} {:>9.3f}".format(
+            "total", sum(c for c, _ in self._calls.values()),
+            sum(t for _, t in self._calls.values())), file=file)
+
+
+@contextlib.contextmanager
+def record(file=None, report=True):
+    """Account libvirt calls of the enclosed code
+
+    :param file: Stream the report is printed to, defaults to sys.stderr
+    :type file: file, optional
+
+    :param report: Print the report at the end, defaults to True
+    :type report: bool, optional
+    """
+    stats = Stats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+        if report:
+            stats.report(file)
+
+
+def call(name, func, *args, **kwargs):
+    """Call func, accounted as name if calls are being recorded
+
+    :param name: Method, e.g. "virConnect.open"
+    :type name: str
+
+    :param func: Function to call with args and kwargs
+    :type func: callable
+    """
+    stats = _stats.get()
+    if stats is None:
+        return func(*args, **kwargs)
+    start = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        duration = time.monotonic() - start
+        stats.add(name, duration)
+        logging.debug("libvirt: {} {:.1f}ms".format(name, duration * 1000))
+
+
+class Proxy(object):
+    """Account the method calls of a libvirt object
+
+    :param obj: Object to wrap, e.g. a libvirt.virConnect
+    :type obj: object
+
+    :param kind: Name of its class in the accounting, e.g. "virConnect"
+    :type kind: str
+
+    :param returns: Methods returning libvirt objects to wrap as well,
+        mapped to their kind, e.g. {"lookupByName": "virDomain"}
+    :type returns: dict, optional
+    """
+
+    def __init__(self, obj, kind, returns=None):
+        self._obj = obj
+        self._kind = kind
+        self._returns = returns or {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name in LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            result = call("{}.{}".format(self._kind, name), attr, *args, **kwargs)
+            if name in self._returns:
+                result = _wrap(result, self._returns[name])
+            return result
+        return method
+
+    def __repr__(self):
+        return "<Proxy {!r}>".format(self._obj)
+
+
+def _wrap(result, kind):
+    """Wrap libvirt objects returned alone, in lists or as first item of
+    tuples, like the domains of getAllDomainStats"""
+    if isinstance(result, list):
+        return [_wrap(r, kind) for r in result]
+    if isinstance(result, tuple):
+        return (_wrap(result[0], kind),) + tuple(result[1:])
+    if result is None:
+        return None
+    return Proxy(result, kind)
+
+
+def _unwrap(arg):
+    if isinstance(arg, Proxy):
+        return arg._obj
+    if isinstance(arg, list):
+        return [_unwrap(a) for a in arg]
+    return arg
@@ -1,27 +1,28 @@
 #!/usr/bin/env python
 # PYTHON_ARGCOMPLETE_OK
-import argcomplete
 import argparse
+import contextlib
 import logging
+import os
 import sys
-import paramiko
-
-import thinbox as thb
 
+from thinbox import client
 from thinbox.parser import get_parser, USE_ARGCOMPLETE
-from thinbox.utils import is_virt_enabled
+
+if USE_ARGCOMPLETE:
+    import argcomplete
 
 
 def run():
-    if not is_virt_enabled():
-        print("Virtualization not enabled")
-        exit(1)
     parser = get_parser()
+    # completion exits here, and commands served by thinboxd below, before
+    # libvirt, paramiko and requests are imported
     if USE_ARGCOMPLETE:
         argcomplete.autocomplete(parser)
     args = parser.parse_args()
 
     if args.verbose:
+        import paramiko
         logging.basicConfig(level=logging.DEBUG)
         paramiko.common.logging.basicConfig(level=paramiko.common.DEBUG)
 
@@ -33,33 +34,124 @@ def run():
         parser.print_help()
         parser.error("Please specify a command")
 
+    if args.trace:
+        # thinboxd writes the trace, from another working directory
+        args.trace = os.path.abspath(args.trace)
+
+    # watching keeps its own event subscription, in the CLI
+    if args.command in client.COMMANDS and not args.no_daemon \
+            and not getattr(args, "watch", False):
+        code = client.call(args)
+        if code is not None:
+            sys.exit(code)
+
+    from thinbox.utils import is_virt_enabled
+    if not is_virt_enabled():
+        print("Virtualization not enabled")
+        exit(1)
+
+    execute(parser, args)
+
+
+def execute(parser, args, thinbox=None):
+    """Execute a parsed command
+
+    :param parser: Parser args come from, used to report errors
+    :type parser: argparse.ArgumentParser
+
+    :param args: Parsed arguments
+    :type args: argparse.Namespace
+
+    :param thinbox: Called with readonly to get the Thinbox to run the
+        command on, defaults to thinbox.Thinbox, thinboxd passes its
+        long-lived one
+    :type thinbox: callable, optional
+    """
+    from thinbox import rpc
+    from thinbox import timing
+    from thinbox.config import Env
+
+    env = Env()
+    with contextlib.ExitStack() as stack:
+        if args.timings or args.trace or env.THINBOX_TIMINGS:
+            stack.enter_context(timing.record(
+                args.command, trace=args.trace or env.THINBOX_TIMINGS_TRACE))
+        if args.stats:
+            stack.enter_context(rpc.record())
+        _execute(parser, args, thinbox)
+
+
+def _execute(parser, args, thinbox):
+    from thinbox.core import Thinbox
+    from thinbox.utils import parse_inject, parse_share, parse_size
+    thinbox = thinbox or Thinbox
+
     # set not read only
     if args.command == "pull":
-        tb = thb.Thinbox()
+        tb = thinbox()
+        try:
+            rate = parse_size(args.limit_rate)
+        except ValueError as e:
+            parser.error(str(e))
         if args.pull_parser == "tag":
-            tb.pull_tag(args.name, skip=args.skip_check)
+            tb.pull_tags(args.name, skip=args.skip_check,
+                         jobs=args.jobs, rate=rate, normalize=args.normalize)
         elif args.pull_parser == "url":
-            tb.pull_url(args.name, skip=args.skip_check)
+            tb.pull_urls(args.name, skip=args.skip_check,
+                         jobs=args.jobs, rate=rate, normalize=args.normalize)
     elif args.command == "image":
-        tb = thb.Thinbox()
+        # cascade removes domains
+        tb = thinbox(readonly=not getattr(args, "cascade", False))
         if args.image_parser in ("list", "ls"):
             tb.image_list()
         elif args.image_parser in ("remove", "rm"):
             if args.all:
-                tb.image_remove_all()
+                tb.image_remove_all(cascade=args.cascade)
             else:
                 print(args.name)
-                tb.image_remove(args.name)
+                tb.image_remove(args.name, cascade=args.cascade)
+        elif args.image_parser == "reindex":
+            tb.image_reindex()
+        elif args.image_parser == "gc":
+            tb.image_gc(dry_run=args.dry_run)
+        elif args.image_parser == "serve":
+            tb.image_serve(args.bind, args.port)
         else:
             tb.image_list()
     elif args.command == "create":
-        tb = thb.Thinbox(readonly=False)
-        tb.create(args.image, args.name)
+        try:
+            shares = [parse_share(s) for s in args.share or []]
+            injects = [parse_inject(i) for i in args.inject or []]
+        except ValueError as e:
+            parser.error(str(e))
+        tb = thinbox(readonly=False)
+        tb.create(args.image, args.name, disk_profile=args.disk_profile,
+                  shares=shares, injects=injects, memory=args.memory,
+                  vcpus=args.vcpus, wait=args.wait)
+    elif args.command == "bench":
+        # boot creates and removes domains
+        tb = thinbox(readonly=args.bench_parser != "boot")
+        if args.bench_parser == "disk":
+            try:
+                size = parse_size(args.size)
+            except ValueError as e:
+                parser.error(str(e))
+            tb.bench_disk(args.image, profiles=args.profile,
+                          size=size, ops=args.ops)
+        elif args.bench_parser == "boot":
+            if args.count < 1 or args.jobs < 1:
+                parser.error("--count and --jobs must be at least 1")
+            tb.bench_boot(args.image, count=args.count, jobs=args.jobs,
+                          disk_profile=args.disk_profile, timeout=args.timeout,
+                          output=args.output, keep=args.keep)
     elif args.command == "copy":
-        tb = thb.Thinbox()
-        tb.copy(args.file, args.dest)
+        tb = thinbox()
+        if args.delete and not args.sync:
+            parser.error("--delete requires --sync")
+        sys.exit(tb.copy(args.file, args.dest, jobs=args.jobs,
+                         sync=args.sync, delete=args.delete, mode=args.mode))
     elif args.command == "env":
-        tb = thb.Thinbox()
+        tb = thinbox()
         if args.env_parser == "clear":
             if args.key:
                 tb.env.clear_key(args.key)
@@ -77,63 +169,79 @@ def run():
 
 
     elif args.command == "run":
-        tb = thb.Thinbox()
-        tb.run(args.name, args.cmd)
+        if not args.cmd:
+            parser.error("Please specify a command to run")
+        tb = thinbox()
+        sys.exit(tb.run([args.name], args.cmd, jobs=args.jobs))
     elif args.command == "enter":
-        tb = thb.Thinbox(readonly=False)
-        tb.enter(args.name)
+        tb = thinbox(readonly=False)
+        tb.enter(args.name, wait=args.wait)
+    elif args.command == "share":
+        try:
+            shares = [parse_share(s) for s in args.share]
+        except ValueError as e:
+            parser.error(str(e))
+        tb = thinbox(readonly=False)
+        tb.share(args.name, shares)
     elif args.command == "start":
-        tb = thb.Thinbox(readonly=False)
-        tb.start(args.name)
+        tb = thinbox(readonly=False)
+        tb.start(args.name, wait=args.wait)
     elif args.command == "stop":
-        tb = thb.Thinbox(readonly=False)
+        tb = thinbox(readonly=False)
         if args.force:
             tb.stop(args.name, "--mode=acpi")
         else:
             tb.stop(args.name)
     elif args.command == "list" or args.command == "ls":
-        tb = thb.Thinbox()
-        if args.all:
-            tb.list()
-        elif args.other:
-            tb.list(fil="other")
-        elif args.paused:
-            tb.list(fil="paused")
-        elif args.running:
-            tb.list(fil="running")
-        elif args.stopped:
-            tb.list(fil="stopped")
-        else:
-            tb.list()
+        _list(parser, args, thinbox)
     elif args.command == "remove" or args.command == "rm":
-        tb = thb.Thinbox(readonly=False)
+        tb = thinbox(readonly=False)
         if args.all:
             tb.remove_all()
         else:
             tb.remove(args.name)
     elif args.command == "vm":
-        tb = thb.Thinbox()
         if args.vm_parser == "list" or args.vm_parser == "ls":
-            if args.all:
-                tb.list()
-            elif args.other:
-                tb.list(fil="other")
-            elif args.paused:
-                tb.list(fil="paused")
-            elif args.running:
-                tb.list(fil="running")
-            elif args.stopped:
-                tb.list(fil="stopped")
-            else:
-                tb.list()
+            _list(parser, args, thinbox)
         elif args.vm_parser == "remove" or args.vm_parser == "rm":
-            tb = thb.Thinbox(readonly=False)
+            tb = thinbox(readonly=False)
             if args.all:
                 tb.remove_all()
             else:
                 tb.remove(args.name)
         else:
-            tb.list()
+            thinbox().list()
+    elif args.command == "events":
+        from thinbox import events
+        # before the connection events are registered on is opened
+        events.start_event_loop()
+        thinbox().events(interval=args.interval)
+
+
+def _list(parser, args, thinbox):
+    """Run list, or vm list, with the options in args"""
+    if args.all:
+        fil = ""
+    elif args.other:
+        fil = "other"
+    elif args.paused:
+        fil = "paused"
+    elif args.running:
+        fil = "running"
+    elif args.stopped:
+        fil = "stopped"
+    else:
+        fil = ""
+    if not args.watch:
+        thinbox().list(fil=fil, fmt=args.format, fields=args.fields)
+        return
+    if args.format == "json":
+        parser.error("--watch streams rows, use --format ndjson")
+    from thinbox import events
+    # before the connection events are registered on is opened
+    events.start_event_loop()
+    thinbox().watch(fil=fil, fmt=args.format, fields=args.fields,
+                    interval=args.interval)
 
 
 if __name__ == "__main__":
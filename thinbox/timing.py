@@ -0,0 +1,137 @@
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+
+# Timing spans of the phases of a command, enabled by --timings or
+# THINBOX_TIMINGS. Spans are recorded by the Recorder of the current context,
+# so concurrent thinboxd requests and the worker threads of one command,
+# started with thinbox.utils.ThreadPoolExecutor, each report their own.
+
+# recorder of the command running in this context, None if not timed
+_recorder = contextvars.ContextVar("recorder", default=None)
+
+
+class Recorder(object):
+    """Spans timed while a command runs
+
+    :param command: Name of the command, saved in the trace
+    :type command: str, optional
+
+    :param trace: Path of a file spans are appended to as JSON lines
+    :type trace: str, optional
+    """
+
+    def __init__(self, command=None, trace=None):
+        self.spans = []
+        self._command = command
+        self._trace = trace
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def add(self, name, start, duration, **attrs):
+        """Record a span
+
+        :param name: Phase, e.g. "create.virt-install"
+        :type name: str
+
+        :param start: Wall clock time the span started at
+        :type start: float
+
+        :param duration: Seconds spent in the span
+        :type duration: float
+        """
+        span = {"name": name, "start": start, "duration": duration}
+        span.update(attrs)
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self):
+        """Return the time spent per phase, in order of first occurrence
+
+        :return: Tuples of phase, number of spans and total seconds
+        :rtype: list
+        """
+        phases = {}
+        with self._lock:
+            for span in self.spans:
+                count, total = phases.get(span["name"], (0, 0.0))
+                phases[span["name"]] = (count + 1, total + span["duration"])
+        return [(name, count, total) for name, (count, total) in phases.items()]
+
+    def report(self, file=None):
+        """Print the breakdown of phases and the wall clock time
+
+        :param file: Stream to print to, defaults to sys.stderr
+        :type file: file, optional
+        """
+        file = file or sys.stderr
+        wall = time.monotonic() - self._start
+        print("{:<24} {:>5} {:>9} {:>6}".format(
+            "PHASE", "COUNT", "SECONDS", "WALL%"), file=file)
+        for name, count, total in self.breakdown():
+            print("{:<24} {:>5} {:>9.3f} {:>5.1f}%".format(
+                name, count, total, 100 * total / wall if wall else 0),
+                file=file)
+        print("{:<24} {:>5} {:>9.3f}".format("total", "", wall), file=file)
+
+    def write_trace(self):
+        """Append spans to the trace file as JSON lines
+        """
+        if not self._trace:
+            return
+        try:
+            with open(self._trace, "a") as file:
+                for span in self.spans:
+                    span = dict(span, command=self._command)
+                    file.write(json.dumps(span) + "\n")
+        except OSError as e:
+            logging.warning("Cannot write trace {}: {}".format(self._trace, e))
+
+
+@contextlib.contextmanager
+def record(command=None, trace=None, file=None):
+    """Time spans of the enclosed code, then report them
+
+    :param command: Name of the command, saved in the trace
+    :type command: str, optional
+
+    :param trace: Path of a file spans are appended to as JSON lines
+    :type trace: str, optional
+
+    :param file: Stream the breakdown is printed to, defaults to sys.stderr
+    :type file: file, optional
+    """
+    recorder = Recorder(command, trace)
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+        recorder.report(file)
+        recorder.write_trace()
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Time the enclosed code as phase name
+
+    It does nothing unless a command is being recorded. The yielded dict
+    of attributes can be updated, e.g. with the bytes transferred.
+
+    :param name: Phase, e.g. "create.virt-install"
+    :type name: str
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        yield attrs
+        return
+    start = time.time()
+    begin = time.monotonic()
+    try:
+        yield attrs
+    finally:
+        recorder.add(name, start, time.monotonic() - begin, **attrs)
@@ -0,0 +1,515 @@
+import os
+import gzip
+import stat
+import shlex
+import tarfile
+import hashlib
+import logging
+import posixpath
+import threading
+import concurrent.futures
+
+import paramiko
+
+from thinbox.utils import print_line, sizeof_fmt, ThreadPoolExecutor
+
+try:
+    import zstandard
+    USE_ZSTD = True
+except ImportError:
+    USE_ZSTD = False
+
+# bigger than paramiko defaults so that a single file keeps many
+# pipelined requests in flight
+WINDOW_SIZE = 16 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+# granularity of delta sync, a changed byte resends one block
+SYNC_BLOCK_SIZE = 128 * 1024
+
+
+def choose_mode(sizes, min_files, max_avg_size):
+    """Choose how to send files, per-file SFTP or a single tar stream
+
+    Many small files are dominated by per-file round trips and go as a
+    tar stream, few or big files are sent over SFTP.
+
+    :param sizes: Size in bytes of every file to send
+    :type sizes: list
+
+    :param min_files: Minimum number of files sent as a tar stream
+    :type min_files: int
+
+    :param max_avg_size: Maximum average file size sent as a tar stream
+    :type max_avg_size: int
+
+    :return: "tar" or "sftp"
+    :rtype: str
+    """
+    if sizes and len(sizes) >= min_files and sum(sizes) / len(sizes) <= max_avg_size:
+        return "tar"
+    return "sftp"
+
+
+class _ChannelWriter(object):
+    """Minimal writable file object over an ssh channel"""
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.written = 0
+
+    def write(self, data):
+        self._channel.sendall(data)
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _StderrReader(threading.Thread):
+    """Read the stderr of an ssh channel until EOF in a thread
+
+    A remote command writing much to stderr can not fill the window of the
+    channel while its stdout is read or its stdin written.
+    """
+
+    def __init__(self, channel):
+        super().__init__(daemon=True)
+        self._channel = channel
+        self._chunks = []
+        self.start()
+
+    def run(self):
+        while True:
+            data = self._channel.recv_stderr(MAX_PACKET_SIZE)
+            if not data:
+                break
+            self._chunks.append(data)
+
+    def read(self):
+        """Wait for EOF and return stderr as text"""
+        self.join()
+        return b"".join(self._chunks).decode("utf8", "replace")
+
+
+class TransferEngine(object):
+    """Concurrent SFTP transfers over one ssh connection
+
+    Files are transferred by a pool of workers, each with its own SFTP
+    channel on the shared transport. paramiko pipelines writes and
+    prefetches reads, and channels are opened with a large window, so
+    both big files and many small files keep the link busy. Directories
+    are copied recursively.
+
+    :param transport: Transport of an authenticated ssh connection
+    :type transport: paramiko.Transport
+
+    :param jobs: Number of files transferred at once, defaults to 4
+    :type jobs: int, optional
+
+    :param window_size: SSH window of each SFTP channel
+    :type window_size: int, optional
+
+    :param max_packet_size: Maximum SSH packet of each SFTP channel
+    :type max_packet_size: int, optional
+    """
+
+    def __init__(self, transport, jobs=4, window_size=WINDOW_SIZE,
+                 max_packet_size=MAX_PACKET_SIZE):
+        super().__init__()
+        self._transport = transport
+        self._jobs = jobs
+        self._window_size = window_size
+        self._max_packet_size = max_packet_size
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def sftp(self):
+        """Return the SFTP client of the calling thread
+
+        :rtype: paramiko.SFTPClient
+        """
+        client = getattr(self._local, "sftp", None)
+        if client is None:
+            client = paramiko.SFTPClient.from_transport(
+                self._transport,
+                window_size=self._window_size,
+                max_packet_size=self._max_packet_size)
+            self._local.sftp = client
+            with self._lock:
+                self._clients.append(client)
+        return client
+
+    def close(self):
+        """Close every SFTP channel, the ssh connection stays open
+        """
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, sources, dest_dir):
+        """Copy local files and directories into a remote directory
+
+        :param sources: Local paths
+        :type sources: list
+
+        :param dest_dir: Remote directory
+        :type dest_dir: str
+
+        :return: Number of files that failed
+        :rtype: int
+        """
+        dirs, tasks = self.plan_put(sources, dest_dir)
+        for d in dirs:
+            self._remote_makedirs(d)
+        return self._run(self._put_file, tasks)
+
+    def get(self, sources, dest):
+        """Copy remote files and directories to a local path
+
+        With one source dest can be a file name, otherwise it is a
+        directory, created if missing.
+
+        :param sources: Remote paths
+        :type sources: list
+
+        :param dest: Local path
+        :type dest: str
+
+        :return: Number of files that failed
+        :rtype: int
+        """
+        into_dir = len(sources) > 1 or os.path.isdir(dest)
+        if into_dir:
+            os.makedirs(dest, exist_ok=True)
+        dirs, tasks = [], []
+        failed = 0
+        for src in sources:
+            src = src.rstrip("/") or "/"
+            target = os.path.join(dest, posixpath.basename(src)) if into_dir else dest
+            try:
+                attr = self.sftp.stat(src)
+            except IOError as e:
+                logging.error("Cannot copy '{}': {}".format(src, e))
+                failed += 1
+                continue
+            if stat.S_ISDIR(attr.st_mode):
+                self._plan_get_dir(src, target, dirs, tasks)
+            else:
+                tasks.append((src, target, attr))
+        for d in dirs:
+            os.makedirs(d, exist_ok=True)
+        return failed + self._run(self._get_file, tasks)
+
+    def sync(self, sources, dest_dir, delete=False, block_size=SYNC_BLOCK_SIZE):
+        """Copy local files and directories into a remote directory,
+        sending only what changed
+
+        Files with the same size and mtime on both sides are skipped.
+        Other files that exist remotely are compared by sha256 of
+        `block_size` blocks, computed on the remote side, and only the
+        blocks that differ are written. Remote mtimes are set to the local
+        ones so that the next sync skips unchanged files.
+
+        :param sources: Local paths
+        :type sources: list
+
+        :param dest_dir: Remote directory
+        :type dest_dir: str
+
+        :param delete: Remove remote files and directories that do not
+            exist locally, defaults to False
+        :type delete: bool, optional
+
+        :param block_size: Size of compared blocks, defaults to 128KiB
+        :type block_size: int, optional
+
+        :return: Number of files that failed
+        :rtype: int
+        """
+        dirs, tasks = self.plan_put(sources, dest_dir)
+        remote = {}
+        for src in sources:
+            src = src.rstrip(os.sep) or os.sep
+            remote.update(self._remote_tree(
+                posixpath.join(dest_dir, os.path.basename(src))))
+
+        self._stats = {"skipped": 0, "sent": 0, "total": 0}
+        for d in dirs:
+            if remote.get(d, ("",))[0] != "d":
+                self._remote_makedirs(d)
+        tasks = [(local, path, remote.get(path), block_size)
+                 for local, path in tasks]
+        failed = self._run(self._sync_file, tasks)
+
+        deleted = 0
+        if delete:
+            keep = set(dirs) | {path for _, path, _, _ in tasks}
+            # deepest first so that directories are empty when removed
+            for path in sorted(set(remote) - keep, reverse=True):
+                try:
+                    if remote[path][0] == "d":
+                        self.sftp.rmdir(path)
+                    else:
+                        self.sftp.remove(path)
+                except IOError as e:
+                    logging.error("Cannot delete '{}': {}".format(path, e))
+                    failed += 1
+                    continue
+                print_line("Deleted '{}'.".format(path))
+                deleted += 1
+
+        print("Synced {} file(s), {} unchanged, {} deleted: sent {} of {} bytes.".format(
+            len(tasks) - self._stats["skipped"], self._stats["skipped"], deleted,
+            self._stats["sent"], self._stats["total"]))
+        return failed
+
+    def put_tar(self, sources, dest_dir, compression="zstd"):
+        """Stream local files and directories into a remote directory as
+        one compressed tar
+
+        The tar is written to `tar -x` running on the remote side over a
+        single exec channel, so there is no round trip per file. zstd
+        needs the zstandard module locally and zstd remotely, otherwise
+        gzip is used.
+
+        :param sources: Local paths
+        :type sources: list
+
+        :param dest_dir: Remote directory
+        :type dest_dir: str
+
+        :param compression: "zstd", "gzip" or "none", defaults to "zstd"
+        :type compression: str, optional
+
+        :return: Number of files that failed, all of them if tar failed
+        :rtype: int
+        """
+        if compression == "zstd" and (
+                not USE_ZSTD or self._remote_output("command -v zstd")[0] != 0):
+            logging.debug("zstd not available, streaming gzip.")
+            compression = "gzip"
+        decompress = {"zstd": "zstd -dc | ", "gzip": "gzip -dc | "}.get(compression, "")
+        dest = shlex.quote(dest_dir)
+        cmd = "mkdir -p {} && {}tar -x --no-same-owner -C {} -f -".format(
+            dest, decompress, dest)
+        logging.debug("Command: {}".format(cmd))
+
+        _, tasks = self.plan_put(sources, dest_dir)
+        channel = self._transport.open_session()
+        channel.exec_command(cmd)
+        stderr = _StderrReader(channel)
+        writer = _ChannelWriter(channel)
+        try:
+            if compression == "zstd":
+                stream = zstandard.ZstdCompressor(level=3).stream_writer(
+                    writer, closefd=False)
+            elif compression == "gzip":
+                stream = gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=6)
+            else:
+                stream = writer
+            with tarfile.open(fileobj=stream, mode="w|") as tar:
+                for src in sources:
+                    src = src.rstrip(os.sep) or os.sep
+                    tar.add(src, arcname=os.path.basename(src))
+            if stream is not writer:
+                stream.close()
+            channel.shutdown_write()
+            errors = stderr.read()
+            code = channel.recv_exit_status()
+        except (OSError, paramiko.SSHException) as e:
+            logging.error("Cannot stream into '{}': {}".format(dest_dir, e))
+            return len(tasks)
+        finally:
+            channel.close()
+
+        if code != 0:
+            for line in errors.splitlines():
+                logging.error("tar: {}".format(line))
+            return len(tasks)
+        total = sum(os.path.getsize(local) for local, _ in tasks)
+        print("Streamed {} file(s), {}, into '{}' as {} tar of {}.".format(
+            len(tasks), sizeof_fmt(total), dest_dir,
+            "uncompressed" if compression == "none" else compression,
+            sizeof_fmt(writer.written)))
+        return 0
+
+    def plan_put(self, sources, dest_dir):
+        """Return remote dirs to create and (local, remote) files to copy
+
+        :param sources: Local paths
+        :type sources: list
+
+        :param dest_dir: Remote directory
+        :type dest_dir: str
+
+        :rtype: tuple
+        """
+        dirs, tasks = [], []
+        for src in sources:
+            src = src.rstrip(os.sep) or os.sep
+            target = posixpath.join(dest_dir, os.path.basename(src))
+            if not os.path.isdir(src):
+                tasks.append((src, target))
+                continue
+            for root, subdirs, files in os.walk(src):
+                subdirs.sort()
+                rel = os.path.relpath(root, src)
+                rdir = target if rel == "." else posixpath.join(
+                    target, *rel.split(os.sep))
+                dirs.append(rdir)
+                for f in sorted(files):
+                    tasks.append((os.path.join(root, f), posixpath.join(rdir, f)))
+        return dirs, tasks
+
+    def _plan_get_dir(self, src, target, dirs, tasks):
+        dirs.append(target)
+        for attr in self.sftp.listdir_attr(src):
+            path = posixpath.join(src, attr.filename)
+            local = os.path.join(target, attr.filename)
+            if stat.S_ISDIR(attr.st_mode):
+                self._plan_get_dir(path, local, dirs, tasks)
+            elif stat.S_ISREG(attr.st_mode):
+                tasks.append((path, local, attr))
+
+    def _run(self, func, tasks):
+        """Run transfers on the worker pool
+
+        :return: Number of tasks that failed
+        :rtype: int
+        """
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = {executor.submit(func, *t): t for t in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except (IOError, OSError, paramiko.SSHException) as e:
+                    logging.error("Cannot copy '{}': {}".format(futures[future][0], e))
+                    failed += 1
+        return failed
+
+    def _put_file(self, local, remote):
+        self.sftp.put(local, remote)
+        self.sftp.chmod(remote, stat.S_IMODE(os.stat(local).st_mode))
+        print_line("Copied file '{}' into '{}'.".format(local, remote))
+
+    def _get_file(self, remote, local, attr):
+        self.sftp.get(remote, local)
+        os.chmod(local, stat.S_IMODE(attr.st_mode))
+        print_line("Copied file '{}' into '{}'.".format(remote, local))
+
+    def _sync_file(self, local, remote, attr, block_size):
+        st = os.stat(local)
+        with self._lock:
+            self._stats["total"] += st.st_size
+        if attr is not None and attr[0] == "f" and attr[1] == st.st_size \
+                and int(attr[2]) == int(st.st_mtime):
+            with self._lock:
+                self._stats["skipped"] += 1
+            return
+
+        blocks = None
+        if attr is not None and attr[0] == "f":
+            blocks = self._remote_blocks(remote, block_size)
+        if blocks is None:
+            self.sftp.put(local, remote)
+            sent = st.st_size
+        else:
+            sent = 0
+            with open(local, "rb") as src, self.sftp.open(remote, "r+") as dest:
+                dest.set_pipelined(True)
+                index = 0
+                while True:
+                    data = src.read(block_size)
+                    if not data:
+                        break
+                    if index >= len(blocks) or \
+                            hashlib.sha256(data).hexdigest() != blocks[index]:
+                        dest.seek(index * block_size)
+                        dest.write(data)
+                        sent += len(data)
+                    index += 1
+            if attr[1] > st.st_size:
+                self.sftp.truncate(remote, st.st_size)
+        self.sftp.chmod(remote, stat.S_IMODE(st.st_mode))
+        self.sftp.utime(remote, (st.st_atime, st.st_mtime))
+        with self._lock:
+            self._stats["sent"] += sent
+        print_line("Synced file '{}' into '{}' ({} bytes sent).".format(
+            local, remote, sent))
+
+    def _remote_tree(self, path):
+        """Return type, size and mtime of every remote path under path
+
+        :return: Path to ("d" or "f", size, mtime), empty if path is missing
+        :rtype: dict
+        """
+        code, out = self._remote_output(
+            "find {} -printf '%y %s %T@ %p\\0'".format(shlex.quote(path)))
+        tree = {}
+        for entry in out.split(b"\0"):
+            if not entry:
+                continue
+            kind, size, mtime, name = entry.decode("utf8").split(" ", 3)
+            if kind in ("d", "f"):
+                tree[name] = (kind, int(size), float(mtime))
+        return tree
+
+    def _remote_blocks(self, path, block_size):
+        """Return sha256 of every block of a remote file
+
+        :return: Hex digests, None if they can not be computed remotely
+        :rtype: list
+        """
+        code, out = self._remote_output(
+            "split -b {} --filter=sha256sum {}".format(
+                block_size, shlex.quote(path)))
+        if code != 0:
+            logging.debug("Block checksums of '{}' failed, sending it whole.".format(path))
+            return None
+        return [line.split()[0] for line in out.decode("utf8").splitlines()]
+
+    def _remote_output(self, cmd):
+        """Run a command on the remote side and return its exit code and
+        stdout, stderr is logged"""
+        logging.debug("Command: {}".format(cmd))
+        channel = self._transport.open_session()
+        try:
+            channel.exec_command(cmd)
+            channel.shutdown_write()
+            stderr = _StderrReader(channel)
+            chunks = []
+            while True:
+                data = channel.recv(MAX_PACKET_SIZE)
+                if not data:
+                    break
+                chunks.append(data)
+            for line in stderr.read().splitlines():
+                logging.debug("{}: {}".format(cmd.split()[0], line))
+            return channel.recv_exit_status(), b"".join(chunks)
+        finally:
+            channel.close()
+
+    def _remote_makedirs(self, path):
+        """Create a remote directory and its parents if missing"""
+        try:
+            if stat.S_ISDIR(self.sftp.stat(path).st_mode):
+                return
+        except IOError:
+            pass
+        parent = posixpath.dirname(path)
+        if parent not in ("", "/", path):
+            self._remote_makedirs(parent)
+        self.sftp.mkdir(path)
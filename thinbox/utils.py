@@ -1,17 +1,26 @@
 import re
+import atexit
+import contextlib
 import socket
+import select
+import hashlib
+import shutil
 import requests
 import os
 import subprocess
 import sys
 import logging
 import paramiko
+import threading
+import contextvars
+import concurrent.futures
 
 from bs4 import BeautifulSoup
-from scp import SCPClient
-from urllib.parse import urlparse
-from time import sleep
+from http.server import SimpleHTTPRequestHandler
+from urllib.parse import unquote, urlparse
+from time import sleep, monotonic
 
+from thinbox import timing
 from thinbox.config import THINBOX_SSH_OPTIONS
 
 
@@ -89,27 +98,268 @@ def create_ssh_connection(hostname, username="root", port=22):
     return client
 
 
-def run_ssh_command(session, cmd):
+class SSHPool(object):
+    """Authenticated ssh connections kept open for reuse
+
+    Clients are keyed by host, user and port. A paramiko transport carries
+    many channels at once, so the same client serves concurrent commands
+    and transfers. Clients are leased: a client is held from `acquire` to
+    `release`, and only a client nobody holds that was released longer
+    than `idle` seconds ago is closed. Dead transports are replaced on the
+    next `acquire`.
+
+    :param idle: Seconds a connection is kept without being used,
+        defaults to 600
+    :type idle: int, optional
+    """
+
+    def __init__(self, idle=600):
+        super().__init__()
+        self.idle = idle
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lease(self, hostname, username="root", port=22):
+        """Hold an open ssh connection while the enclosed code runs
+
+        :param hostname: Hostname to ssh in
+        :type hostname: str
+
+        :parmam username: Username for ssh connection, defaults to "root"
+        :type username: str
+
+        :param port: Port to connect, defaults to 22
+        :type port: int
+        """
+        client = self.acquire(hostname, username, port)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def acquire(self, hostname, username="root", port=22):
+        """Return an open ssh connection, reusing a live one
+
+        Every acquire needs a release once the connection is not used
+        anymore.
+
+        :param hostname: Hostname to ssh in
+        :type hostname: str
+
+        :parmam username: Username for ssh connection, defaults to "root"
+        :type username: str
+
+        :param port: Port to connect, defaults to 22
+        :type port: int
+
+        :rtype: paramiko.SSHClient
+        """
+        key = (hostname, username, port)
+        with self._lock:
+            self._expire()
+            client = self._hold(key)
+            if client is not None:
+                logging.debug("Reusing ssh connection to {}".format(hostname))
+                return client
+        client = create_ssh_connection(hostname, username, port)
+        with self._lock:
+            # another thread may have connected meanwhile, keep one
+            live = self._hold(key)
+            if live is not None:
+                client.close()
+                return live
+            self._clients[key] = {
+                "client": client, "holders": 1, "last": monotonic()}
+        return client
+
+    def release(self, client):
+        """Release a connection returned by acquire
+
+        :param client: Connection to release
+        :type client: paramiko.SSHClient
+        """
+        with self._lock:
+            for entry in self._clients.values():
+                if entry["client"] is client and entry["holders"] > 0:
+                    entry["holders"] -= 1
+                    entry["last"] = monotonic()
+                    return
+
+    def discard(self, hostname, username="root", port=22):
+        """Close and forget the connection to a host
+
+        :param hostname: Hostname of the connection
+        :type hostname: str
+        """
+        with self._lock:
+            entry = self._clients.pop((hostname, username, port), None)
+        if entry is not None:
+            entry["client"].close()
+
+    def close_all(self):
+        """Close every connection
+        """
+        with self._lock:
+            for entry in self._clients.values():
+                entry["client"].close()
+            self._clients = {}
+
+    def _hold(self, key):
+        """Return the live client of key with one more holder, or None"""
+        entry = self._clients.get(key)
+        if entry is None:
+            return None
+        transport = entry["client"].get_transport()
+        if transport is not None and transport.is_active():
+            entry["holders"] += 1
+            return entry["client"]
+        entry["client"].close()
+        del self._clients[key]
+        return None
+
+    def _expire(self):
+        now = monotonic()
+        for key, entry in list(self._clients.items()):
+            if entry["holders"] == 0 and now - entry["last"] > self.idle:
+                logging.debug("Closing idle ssh connection to {}".format(key[0]))
+                entry["client"].close()
+                del self._clients[key]
+
+
+ssh_pool = SSHPool()
+atexit.register(ssh_pool.close_all)
+
+
+class _StreamWriter(object):
+    """Write bytes of a remote stream to a local one as they arrive
+
+    Without a prefix bytes are written untouched. With a prefix output is
+    split in lines, each printed with the prefix; a partial line longer
+    than `limit` bytes is printed as is so the buffer stays bounded.
+    """
+
+    def __init__(self, stream, prefix="", limit=64 * 1024):
+        super().__init__()
+        self._stream = stream
+        self._prefix = prefix
+        self._limit = limit
+        self._partial = b""
+
+    def write(self, data):
+        if not self._prefix:
+            self._stream.buffer.write(data)
+            self._stream.buffer.flush()
+            return
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        if len(self._partial) > self._limit:
+            lines.append(self._partial)
+            self._partial = b""
+        for line in lines:
+            self._print(line)
+
+    def close(self):
+        if self._partial:
+            self._print(self._partial)
+            self._partial = b""
+
+    def _print(self, line):
+        print_line(self._prefix + line.decode('utf8', errors='replace'),
+                   file=self._stream)
+
+
+def run_ssh_command(session, cmd, prefix="", bufsize=32 * 1024):
     """Run command in ssh session
 
+    stdout and stderr are forwarded to the local ones as bytes arrive, so
+    long running commands behave like local ones. Reading at most bufsize
+    bytes at a time keeps buffers bounded and the channel window open.
+
     :param session: SSH session
     :type session: paramiko.SSHClient
 
     :param cmd: Command to run
     :type cmd: str
-    """
-    logging.debug("Command", cmd)
 
-    ssh_stdin, ssh_stdout, ssh_stderr = session.exec_command(cmd)
-    exit_code = ssh_stdout.channel.recv_exit_status()  # handles async exit error
+    :param prefix: String printed in front of every output line, used
+        when several hosts run at once
+    :type prefix: str, optional
+
+    :param bufsize: Maximum bytes read from the channel at once
+    :type bufsize: int, optional
 
-    for line in ssh_stdout:
-        print(line.strip())
+    :return: Exit code of the command, 255 if the connection is lost
+    :rtype: int
+    """
+    logging.debug("Command: {}".format(cmd))
 
+    channel = session.get_transport().open_session()
+    channel.exec_command(cmd)
+    channel.shutdown_write()
+    stdout = _StreamWriter(sys.stdout, prefix)
+    stderr = _StreamWriter(sys.stderr, prefix)
+    try:
+        while True:
+            # both streams every time, stdout can not starve stderr
+            ready = False
+            if channel.recv_ready():
+                stdout.write(channel.recv(bufsize))
+                ready = True
+            if channel.recv_stderr_ready():
+                stderr.write(channel.recv_stderr(bufsize))
+                ready = True
+            if ready:
+                continue
+            if channel.exit_status_ready() and channel.eof_received:
+                break
+            if channel.closed:
+                break
+            select.select([channel], [], [], 1.0)
+    except KeyboardInterrupt:
+        channel.close()
+        return 130
+    finally:
+        stdout.close()
+        stderr.close()
+
+    exit_code = channel.recv_exit_status() if channel.exit_status_ready() else -1
+    if exit_code == -1:
+        logging.error("Connection lost before '{}' exited.".format(cmd))
+        return 255
     if exit_code != 0:
-        logging.warning("paramiko error: {}".format(exit_code))
-        for line in ssh_stderr:
-            logging.warning("paramiko stderr: {}".format(line.strip()))
+        logging.debug("paramiko exit code: {}".format(exit_code))
+    return exit_code
+
+
+class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor running tasks in the context of the submitter
+
+    Context variables, such as the client output of a thinboxd request,
+    follow the work into the pool threads.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        ctx = contextvars.copy_context()
+        return super().submit(ctx.run, fn, *args, **kwargs)
+
+
+_print_lock = threading.Lock()
+
+
+def print_line(line, file=None):
+    """Print a line without interleaving with other threads
+
+    :param line: Line to print, without newline
+    :type line: str
+
+    :param file: Stream to print to, defaults to sys.stdout
+    :type file: file, optional
+    """
+    file = file or sys.stdout
+    with _print_lock:
+        file.write(line + "\n")
+        file.flush()
 
 
 def _image_name_wrong(name):
@@ -135,17 +385,396 @@ def logging_subprocess(process, output):
         logging.error(output.format(se))
 
 
-def ssh_connect(dom):
+def ssh_mux_options(control_dir, persist=600):
+    """Return OpenSSH options to multiplex connections over a master
+
+    The first ssh to a host becomes the master and keeps running in the
+    background for `persist` seconds after the last session, later ones
+    reuse its authenticated connection through a socket in control_dir.
+
+    :parameter control_dir: Directory of the ControlPath sockets
+    :type control_dir: str
+
+    :parameter persist: Seconds the master stays up when idle, 0 disables
+        multiplexing, defaults to 600
+    :type persist: int, optional
+
+    :return: Options for the ssh command line
+    :rtype: str
+    """
+    if not persist:
+        return ""
+    return "-o ControlMaster=auto -o ControlPath={} -o ControlPersist={}".format(
+        os.path.join(control_dir, "%C"), persist)
+
+
+def probe_address(ip, mac="", port=22, timeout=0.3):
+    """Return True if ip accepts TCP connections and still belongs to mac
+
+    After connecting, the host neighbour table has the MAC that answered
+    for ip; when it is there and differs, ip was given to another machine.
+
+    :parameter ip: Address to probe
+    :type ip: str
+
+    :parameter mac: Expected MAC, not checked if empty
+    :type mac: str, optional
+
+    :parameter port: TCP port, defaults to 22
+    :type port: int, optional
+
+    :parameter timeout: Seconds to wait for the connection, defaults to 0.3
+    :type timeout: float, optional
+
+    :rtype: bool
+    """
+    try:
+        socket.create_connection((ip, port), timeout=timeout).close()
+    except OSError:
+        return False
+    if not mac:
+        return True
+    try:
+        with open("/proc/net/arp") as arp:
+            for line in arp.readlines()[1:]:
+                fields = line.split()
+                if fields[0] == ip and fields[3] != "00:00:00:00:00:00":
+                    return fields[3].lower() == mac.lower()
+    except OSError:
+        pass
+    return True
+
+
+def ssh_connect(dom, options=""):
     """Connect and open interactive ssh shell
 
     :parameter name: Machine name
     :type name: str
+
+    :parameter options: More options for ssh, e.g. ssh_mux_options()
+    :type options: str, optional
+    """
+    options = " ".join(o for o in (THINBOX_SSH_OPTIONS, options) if o)
+    logging.debug("options: {}".format(options))
+    os.system("ssh {} root@{}".format(options, dom.ip))
+
+
+def sizeof_fmt(num, suffix="B"):
+    """Format a number of bytes in a human readable way
+
+    :parameter num: Number of bytes
+    :type num: int
+
+    :return: Formatted size, e.g. 1.5GiB
+    :rtype: str
+    """
+    for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
+        if abs(num) < 1024.0:
+            return f"{num:3.1f}{unit}{suffix}"
+        num /= 1024.0
+    return f"{num:.1f}Yi{suffix}"
+
+
+def parse_size(size):
+    """Parse a human readable size into bytes
+
+    Accepts plain numbers and K, M, G, T suffixes in powers of 1024,
+    optionally followed by "iB" or "B", e.g. "512K", "10M", "1GiB".
+
+    :parameter size: Size to parse
+    :type size: str or int
+
+    :return: Number of bytes
+    :rtype: int
+    """
+    if isinstance(size, int):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', size,
+                     re.IGNORECASE)
+    if match is None:
+        raise ValueError("Not a valid size: {}".format(size))
+    number, unit = match.groups()
+    power = " KMGT".index(unit.upper() or " ")
+    return int(float(number) * 1024 ** power)
+
+
+def memory_shortfall(memory, host, ratio):
+    """Return why a domain does not fit in host memory
+
+    It fits when guest memory committed by running domains, with its own,
+    stays within ratio times the host memory. Free memory is not part of
+    it, as it leaves out page cache the host reclaims when guests need it.
+
+    :parameter memory: Memory of the domain, in MiB
+    :type memory: int
+
+    :parameter host: Host memory in MiB, with keys total and committed
+    :type host: dict
+
+    :parameter ratio: Overcommit ratio, 0 disables the check
+    :type ratio: float
+
+    :return: Reason, None if the domain fits
+    :rtype: str
     """
-    logging.debug("options: {}".format(THINBOX_SSH_OPTIONS))
-    os.system("ssh {} root@{}".format(THINBOX_SSH_OPTIONS, dom.ip))
+    if ratio <= 0:
+        return None
+    limit = host["total"] * ratio
+    if host["committed"] + memory > limit:
+        return "{} MiB committed to running domains, {} MiB more exceed {:.0f} MiB, {} times the host memory".format(
+            host["committed"], memory, limit, ratio)
+    return None
 
 
-def download_file(url, filepath):
+def parse_share(spec):
+    """Parse a HOST_DIR:TAG share of a host directory
+
+    TAG defaults to the name of the directory. The directory is mounted
+    in the guest on /mnt/TAG.
+
+    :parameter spec: Share to parse, e.g. "~/src/project:project"
+    :type spec: str
+
+    :return: Absolute host directory and tag
+    :rtype: tuple
+    """
+    host_dir, _, tag = spec.rpartition(":")
+    if host_dir == "":
+        host_dir, tag = tag, ""
+    host_dir = os.path.abspath(os.path.expanduser(host_dir))
+    tag = tag or os.path.basename(host_dir)
+    if not os.path.isdir(host_dir):
+        raise ValueError("Not a directory: {}".format(host_dir))
+    if "," in host_dir:
+        raise ValueError("Shared directory can not contain commas: {}".format(host_dir))
+    if not re.match(r'^[A-Za-z0-9_.-]+$', tag):
+        raise ValueError("Not a valid share tag: {}".format(tag))
+    return host_dir, tag
+
+
+def share_options(shares):
+    """Return virt-install options and virt-sysprep operations of shares
+
+    Shares are exported with virtiofs, which needs shared memory backing,
+    and mounted in the guest on /mnt/TAG through fstab.
+
+    :parameter shares: Host directory and tag pairs, see parse_share
+    :type shares: list
+
+    :return: virt-install arguments and virt-sysprep arguments
+    :rtype: tuple
+    """
+    if not shares:
+        return [], []
+    install = ['--memorybacking', 'source.type=memfd,access.mode=shared']
+    sysprep = []
+    for host_dir, tag in shares:
+        install += ['--filesystem', filesystem_option(host_dir, tag)]
+        sysprep += ['--mkdir', '/mnt/' + tag,
+                    '--append-line', '/etc/fstab:' + fstab_line(tag)]
+    return install, sysprep
+
+
+def parse_inject(spec):
+    """Parse a SRC:DEST file injection
+
+    :parameter spec: Local file or directory and directory in the guest,
+        e.g. "payload/:/opt/payload"
+    :type spec: str
+
+    :return: Absolute local path and guest directory
+    :rtype: tuple
+    """
+    src, _, dest = spec.rpartition(":")
+    if src == "" or not dest.startswith("/"):
+        raise ValueError("Expected SRC:/GUEST/DIR, got: {}".format(spec))
+    src = os.path.abspath(os.path.expanduser(src))
+    if not os.path.exists(src):
+        raise ValueError("No such file or directory: {}".format(src))
+    return src, dest
+
+
+def inject_options(injects):
+    """Return virt-sysprep operations copying files into the disk
+
+    :parameter injects: Local path and guest directory pairs, see
+        parse_inject
+    :type injects: list
+
+    :rtype: list
+    """
+    opts = []
+    for src, dest in injects or []:
+        opts += ['--mkdir', dest, '--copy-in', '{}:{}'.format(src, dest)]
+    return opts
+
+
+def filesystem_option(host_dir, tag):
+    """Return the virt-install --filesystem value of a virtiofs share"""
+    return "source.dir={},target.dir={},driver.type=virtiofs".format(host_dir, tag)
+
+
+def fstab_line(tag):
+    """Return the guest fstab entry of a virtiofs share"""
+    return "{} /mnt/{} virtiofs defaults,nofail 0 0".format(tag, tag)
+
+
+def fstab_command(tag):
+    """Return a guest shell command creating the mount point of a virtiofs
+    share and adding its fstab entry, unless already there"""
+    return "mkdir -p /mnt/{0} && (grep -qxF '{1}' /etc/fstab || echo '{1}' >> /etc/fstab)".format(
+        tag, fstab_line(tag))
+
+
+class BandwidthLimiter(object):
+    """Token bucket shared by concurrent transfers
+
+    Every transfer calls `consume` with the bytes it just moved and sleeps
+    until the aggregate stays under the budget.
+
+    :param rate: Budget in bytes per second, 0 means unlimited
+    :type rate: int
+    """
+
+    def __init__(self, rate=0):
+        super().__init__()
+        self._rate = rate
+        self._allowance = rate
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def chunk_size(self, default):
+        """Return a chunk size small enough to keep throttling smooth
+
+        :param default: Chunk size used when unlimited
+        :type default: int
+
+        :rtype: int
+        """
+        if self._rate <= 0:
+            return default
+        return min(default, max(self._rate // 8, 64 * 1024))
+
+    def consume(self, nbytes):
+        """Account for transferred bytes, sleeping if over budget
+
+        :param nbytes: Bytes just transferred
+        :type nbytes: int
+        """
+        if self._rate <= 0:
+            return
+        with self._lock:
+            now = monotonic()
+            self._allowance = min(
+                self._rate,
+                self._allowance + (now - self._last) * self._rate)
+            self._last = now
+            self._allowance -= nbytes
+            wait = -self._allowance / self._rate
+        if wait > 0:
+            sleep(wait)
+
+
+class TransferProgress(object):
+    """Multi-line progress display for concurrent transfers
+
+    Draws one status bar per transfer and, when more than one transfer is
+    running, a last line with the aggregate throughput. When stdout is not
+    a terminal only a final line per transfer is printed.
+
+    :param stream: Stream to draw on, defaults to sys.stdout
+    :type stream: file, optional
+    """
+    width = 40
+
+    def __init__(self, stream=None):
+        super().__init__()
+        self._stream = stream or sys.stdout
+        self._tty = self._stream.isatty()
+        self._transfers = {}
+        self._lines = 0
+        self._start = monotonic()
+        self._last_draw = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, total=None):
+        """Register a new transfer
+
+        :param name: Name shown in front of the status bar
+        :type name: str
+
+        :param total: Expected bytes, None if unknown
+        :type total: int, optional
+        """
+        with self._lock:
+            self._transfers[name] = [0, total]
+            self._draw(force=True)
+
+    def update(self, name, nbytes):
+        """Add transferred bytes to a transfer
+
+        :param name: Name of the transfer
+        :type name: str
+
+        :param nbytes: Bytes just transferred
+        :type nbytes: int
+        """
+        with self._lock:
+            self._transfers[name][0] += nbytes
+            self._draw()
+
+    def finish(self, name):
+        """Mark a transfer as completed
+
+        :param name: Name of the transfer
+        :type name: str
+        """
+        with self._lock:
+            done, total = self._transfers[name]
+            self._transfers[name][1] = done
+            if self._tty:
+                self._draw(force=True)
+            else:
+                self._stream.write(self._format(name, done, done) + "\n")
+                self._stream.flush()
+
+    def _format(self, name, done, total):
+        if not total:
+            return "{:<32.32} {}".format(name, sizeof_fmt(done))
+        bar = int(self.width * done / total)
+        return "{:<32.32} |{}{}| {} / {}".format(
+            name, '█' * bar, '.' * (self.width - bar),
+            sizeof_fmt(done), sizeof_fmt(total))
+
+    def _format_total(self):
+        done = sum(t[0] for t in self._transfers.values())
+        elapsed = max(monotonic() - self._start, 1e-6)
+        return "{:<32.32} {} at {}/s".format(
+            "total ({})".format(len(self._transfers)),
+            sizeof_fmt(done), sizeof_fmt(done / elapsed))
+
+    def _draw(self, force=False):
+        if not self._tty:
+            return
+        now = monotonic()
+        if not force and now - self._last_draw < 0.2:
+            return
+        self._last_draw = now
+        lines = [self._format(n, d, t) for n, (d, t) in self._transfers.items()]
+        if len(lines) > 1:
+            lines.append(self._format_total())
+        out = "\x1b[{}F".format(self._lines) if self._lines else ""
+        out += "".join("\x1b[K" + line + "\n" for line in lines)
+        self._lines = len(lines)
+        self._stream.write(out)
+        self._stream.flush()
+
+
+def download_file(url, filepath, limiter=None, progress=None):
     """Download file from url to specific path
 
     Prints nice status bar
@@ -156,16 +785,17 @@ def download_file(url, filepath):
     :parameter path: Path where the file will be saved
     :type path: str
 
+    :parameter limiter: Bandwidth budget shared with other transfers
+    :type limiter: thinbox.utils.BandwidthLimiter, optional
+
+    :parameter progress: Display shared with other transfers
+    :type progress: thinbox.utils.TransferProgress, optional
+
     :return: True if file is successfully downloaded
     :rtype: bool
-    """
-    def sizeof_fmt(num, suffix="B"):
-        for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
-            if abs(num) < 1024.0:
-                return f"{num:3.1f}{unit}{suffix}"
-            num /= 1024.0
-        return f"{num:.1f}Yi{suffix}"
 
+    :raises requests.HTTPError: When the server answers with an error status
+    """
     if not _url_is_valid(url):
         logging.warning("URL may be in not valid format.")
 
@@ -173,30 +803,162 @@ def download_file(url, filepath):
     if os.path.exists(filepath):
         logging.debug("File {} exists.".format(filepath))
         return False
-    with open(filepath, 'wb') as f:
+    limiter = limiter or BandwidthLimiter()
+    progress = progress or TransferProgress()
+    name = os.path.basename(filepath)
+    with timing.span("pull.download", file=name) as span, \
+            open(filepath, 'wb') as f:
         response = requests.get(url, stream=True)
+        # an error page is not the file, the caller removes what was opened
+        response.raise_for_status()
         total = response.headers.get('content-length')
-        width = 40
-        print(os.path.basename(filepath))
-        if total is None:
-            f.write(response.content)
-        else:
-            downloaded = 0
+        if total is not None:
             total = int(total)
-            for data in response.iter_content(
-                    chunk_size=max(int(total / 1000), 1024 * 1024)):
-                downloaded += len(data)
-                f.write(data)
-                done = int(width * downloaded / total)
-                sys.stdout.write('\r    |{}{}| {} / {}'.format(
-                    '█' * done, '.' * (width - done),
-                    sizeof_fmt(downloaded),
-                    sizeof_fmt(total)))
-                sys.stdout.flush()
-    sys.stdout.write('\n')
+        progress.add(name, total)
+        chunk_size = limiter.chunk_size(
+            max(int((total or 0) / 1000), 1024 * 1024))
+        span["bytes"] = 0
+        for data in response.iter_content(chunk_size=chunk_size):
+            f.write(data)
+            limiter.consume(len(data))
+            progress.update(name, len(data))
+            span["bytes"] += len(data)
+        progress.finish(name)
+    return True
+
+
+def file_digest(filepath, hashname="sha256"):
+    """Compute the hex digest of a file
+
+    :parameter filepath: Path of the file to hash
+    :type filepath: str
+
+    :parameter hashname: Name of a hashlib algorithm, defaults to "sha256"
+    :type hashname: str, optional
+
+    :return: Hex digest
+    :rtype: str
+    """
+    h = hashlib.new(hashname)
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_hash_file(hashpath):
+    """Read the expected hash from a hash file
+
+    hash file should be in format
+    # NAME: NUM bytes
+    HASH_TYPE (NAME) = HASH
+
+    :parameter hashpath: Path of the hash file
+    :type hashpath: str
+
+    :return: Expected hash, empty string if not found
+    :rtype: str
+    """
+    if not os.path.exists(hashpath):
+        return ""
+    with open(hashpath, 'r') as file:
+        file.readline()
+        last = file.readline()
+    return last.strip().split(' ')[-1]
+
+
+def fetch_from_mirror(mirror, filename, filepath, digest, hashname="sha256",
+                      limiter=None, progress=None):
+    """Fetch a file from a mirror if the mirror has it with the right digest
+
+    A mirror is either a local directory (NFS mounts included) or an
+    HTTP(S) url serving files with the same names as THINBOX_BASE_DIR.
+
+    :parameter mirror: Local path or url of the mirror
+    :type mirror: str
+
+    :parameter filename: Name of the file to look for
+    :type filename: str
+
+    :parameter filepath: Path where the file will be saved
+    :type filepath: str
+
+    :parameter digest: Expected hex digest of the file
+    :type digest: str
+
+    :parameter hashname: Name of a hashlib algorithm, defaults to "sha256"
+    :type hashname: str, optional
+
+    :parameter limiter: Bandwidth budget for HTTP mirrors
+    :type limiter: thinbox.utils.BandwidthLimiter, optional
+
+    :parameter progress: Progress display for HTTP mirrors
+    :type progress: thinbox.utils.TransferProgress, optional
+
+    :return: True if the file was fetched and verified
+    :rtype: bool
+    """
+    scheme = urlparse(mirror).scheme
+    if scheme in ("http", "https"):
+        url = mirror.rstrip("/") + "/" + filename
+        try:
+            response = requests.head(url, timeout=5)
+        except requests.RequestException as e:
+            logging.debug("mirror {}: {}".format(mirror, e))
+            return False
+        if response.status_code != 200:
+            logging.debug("mirror {}: {} {}".format(
+                mirror, response.status_code, filename))
+            return False
+        download_file(url, filepath, limiter, progress)
+        if file_digest(filepath, hashname) != digest:
+            logging.warning(
+                "Digest of '{}' from {} does not match.".format(filename, mirror))
+            os.remove(filepath)
+            return False
+        return True
+
+    if scheme == "file":
+        mirror = urlparse(mirror).path
+    src = os.path.join(os.path.expanduser(mirror), filename)
+    if not os.path.isfile(src):
+        logging.debug("mirror {}: {} not found".format(mirror, filename))
+        return False
+    if file_digest(src, hashname) != digest:
+        logging.warning(
+            "Digest of '{}' from {} does not match.".format(filename, mirror))
+        return False
+    shutil.copyfile(src, filepath)
     return True
 
 
+class ReadOnlyRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files of a directory over HTTP, GET and HEAD only
+
+    Access logs go through logging instead of stderr.
+
+    :param hidden: Called with the name of a requested file, files it
+        returns True for are not found
+    :type hidden: callable, optional
+    """
+
+    def __init__(self, *args, hidden=None, **kwargs):
+        # the request is handled by the base constructor
+        self._hidden = hidden or (lambda name: False)
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        name = unquote(urlparse(self.path).path).rstrip("/").split("/")[-1]
+        if name and self._hidden(name):
+            self.send_error(404, "File not found")
+            return None
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        logging.debug("serve: {} {}".format(
+            self.address_string(), format % args))
+
+
 def printd(text, condition=True, delay=.8):
     """Prints string with ending dots
 